@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+'''
+Micro-benchmarks for the mailer
+
+    $ python bench_mailer.py hold
+    $ python bench_mailer.py prefilter --stream messages.jsonl
+    $ python bench_mailer.py store --rate 1000 --duration 5
+    $ python bench_mailer.py e2e --rules 10 100 1000 --rate 200 --duration 10
+'''
+import argparse
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+import resource
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from email.header import decode_header, make_header
+
+import mailer
+from alertaclient.models.alert import Alert
+from kombu import Connection, Exchange, Producer
+from mock import MagicMock, patch
+
+
+def _timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_hold(args):
+    '''Per-tick cost of the hold queue versus a full scan of every held alert'''
+    print('%10s %16s %16s' % ('held', 'scan tick (us)', 'heap tick (us)'))
+    for size in args.sizes:
+        now = time.time()
+        deadlines = [now + mailer.HOLD_TIME + (i % 1000) / 1000.0
+                     for i in range(size)]
+
+        # the previous implementation: walk every key of a dict per tick
+        legacy = {'alert-%d' % i: (None, d) for i, d in enumerate(deadlines)}
+
+        def scan_tick():
+            for alertid in list(legacy.keys()):
+                (_, hold_time) = legacy[alertid]
+                if now > hold_time:
+                    pass
+
+        held = mailer.HoldQueue()
+        for i, d in enumerate(deadlines):
+            held.hold('alert-%d' % i, None, d)
+
+        def heap_tick():
+            held.pop_due(now)
+            held.next_deadline()
+
+        print('%10d %16.1f %16.1f' % (
+            size,
+            _timeit(scan_tick, args.repeat) * 1e6,
+            _timeit(heap_tick, args.repeat * 100) * 1e6
+        ))
+
+
+class _Message(object):
+    '''Stands in for a kombu message, cheaper than a MagicMock'''
+
+    def ack(self, multiple=False):
+        pass
+
+
+def _synthetic_stream(count):
+    '''Mostly repeats and low severities, like a busy notify topic'''
+    rand = random.Random(42)
+    stream = []
+    for i in range(count):
+        stream.append({
+            'id': 'alert-%d' % (i % 5000),
+            'resource': 'server-%d' % (i % 500),
+            'event': 'NodeDown',
+            'environment': 'Production',
+            'service': ['Web'],
+            'severity': rand.choice(['critical', 'major', 'minor', 'warning',
+                                     'warning', 'normal']),
+            'previousSeverity': rand.choice(['major', 'minor', 'normal', 'normal']),
+            'status': rand.choice(['open'] * 8 + ['ack', 'closed']),
+            'repeat': rand.random() < 0.7,
+            'createTime': '2020-01-01T00:00:00.000Z',
+            'receiveTime': '2020-01-01T00:00:00.000Z',
+            'lastReceiveTime': '2020-01-01T00:00:00.000Z',
+        })
+    return stream
+
+
+def bench_prefilter(args):
+    '''Consumer cost per message, parsing everything versus the raw body pre-filter'''
+    if args.stream:
+        with open(args.stream) as f:
+            stream = [json.loads(line) for line in f if line.strip()]
+    else:
+        stream = _synthetic_stream(args.sizes[0])
+
+    sevs = ['critical', 'major']
+
+    def parse_first(body, message):
+        # the previous implementation: build the alert, then filter it
+        alert = Alert.parse(body)
+        alertid = alert.get_id()
+        if alert.repeat or alert.status not in ['open', 'closed'] or (
+                alert.severity not in sevs and alert.previous_severity not in sevs):
+            message.ack()
+            return
+        mailer.on_hold.hold(alertid, alert, time.time() + mailer.HOLD_TIME)
+        message.ack()
+
+    message = _Message()
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS):
+        consumer = mailer.FanoutConsumer(connection=MagicMock())
+        for name, on_message in [('parse first', parse_first),
+                                 ('pre-filter', consumer.on_message)]:
+            # an unbounded hand-off queue, nothing drains it during the run
+            with patch.object(mailer, 'on_hold', mailer.HoldQueue()), \
+                    patch.object(mailer, 'handoff', queue.Queue()):
+                start = time.perf_counter()
+                for body in stream:
+                    on_message(body, message)
+                elapsed = time.perf_counter() - start
+            print('%-12s %8d msgs %10.2f us/msg' % (
+                name, len(stream), elapsed / len(stream) * 1e6))
+    print('ignored: %s' % ', '.join('%s=%d' % kv for kv in sorted(consumer.ignored.items())))
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def bench_store(args):
+    '''Consumer throughput and latency with the durable hold store enabled'''
+    stream = [dict(body, repeat=False, status='open', severity='major')
+              for body in _synthetic_stream(args.rate * args.duration)]
+    message = _Message()
+    print('%-10s %10s %10s %10s %12s %12s' % (
+        'mode', 'msgs', 'msgs/s', 'commits', 'p50 (us)', 'p99 (us)'))
+    for mode, rate in [('paced', args.rate), ('unpaced', None)]:
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS):
+            store = mailer.HoldStore(os.path.join(tmp, 'held.db'))
+            with patch.object(mailer, 'hold_store', store), \
+                    patch.object(mailer, 'handoff', queue.Queue()):
+                consumer = mailer.FanoutConsumer(connection=MagicMock())
+                latencies = []
+                start = time.perf_counter()
+                for i, body in enumerate(stream):
+                    if rate:
+                        # keep to the target rate, as a broker would deliver
+                        delay = start + float(i) / rate - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    t0 = time.perf_counter()
+                    consumer.on_message(body, message)
+                    consumer.acks.maybe_flush()
+                    latencies.append(time.perf_counter() - t0)
+                consumer.acks.flush()
+                elapsed = time.perf_counter() - start
+            print('%-10s %10d %10.0f %10d %12.1f %12.1f' % (
+                mode, len(stream), len(stream) / elapsed, store.commits,
+                _percentile(latencies, 50) * 1e6, _percentile(latencies, 99) * 1e6))
+            store.close()
+
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+    '''Just enough SMTP to accept mail from smtplib, without TLS or AUTH'''
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 sink ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line[:4].upper()
+            if verb == b'EHLO':
+                self.reply('250-sink')
+                self.reply('250 8BITMIME')
+            elif verb == b'DATA':
+                self.reply('354 end with .')
+                subject = None
+                for data in iter(self.rfile.readline, b''):
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    if subject is None and data.startswith(b'Subject: '):
+                        subject = str(make_header(decode_header(
+                            data[9:].strip().decode('ascii'))))
+                self.server.received(subject)
+                self.reply('250 queued')
+            elif verb == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET and NOOP
+                self.reply('250 ok')
+
+
+class _SMTPSink(socketserver.ThreadingTCPServer):
+    '''Records when each email arrives, keyed by its subject'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _SMTPSinkHandler)
+        self.arrivals = {}
+        self.lock = threading.Lock()
+
+    def received(self, subject):
+        with self.lock:
+            self.arrivals[subject] = time.time()
+
+    def count(self):
+        with self.lock:
+            return len(self.arrivals)
+
+
+def _synthetic_rules(count):
+    '''Rules on resource and event, of which only a few match any alert'''
+    return [{
+        'name': 'rule-%d' % i,
+        'fields': [{'field': 'resource', 'regex': r'^server-%d$' % i},
+                   {'field': 'event', 'regex': 'Node(Down|Up)'}],
+        'contacts': ['team-%d@example.com' % (i % 20)]
+    } for i in range(count)]
+
+
+class _RecordingHoldQueue(mailer.HoldQueue):
+    '''Remembers the deadline each alert was first held with'''
+
+    def __init__(self):
+        mailer.HoldQueue.__init__(self)
+        self.deadlines = {}
+
+    def hold(self, alertid, alert, deadline):
+        self.deadlines.setdefault(alertid, deadline)
+        mailer.HoldQueue.hold(self, alertid, alert, deadline)
+
+
+def bench_e2e(args):
+    '''Alerts published on an in-memory broker until emails arrive at a local SMTP sink'''
+    if args.stream:
+        with open(args.stream) as f:
+            template = [json.loads(line) for line in f if line.strip()]
+    else:
+        template = _synthetic_stream(min(args.rate * args.duration, 5000))
+
+    sink = _SMTPSink()
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+
+    print('peak RSS is for the whole process, run rule counts in ascending order')
+    print('%8s %8s %10s %10s %12s %12s %12s' % (
+        'rules', 'alerts', 'emails', 'emails/s', 'p50 (ms)', 'p99 (ms)', 'peak RSS (MB)'))
+    for rules in args.rules:
+        # every alert is unique and due, so each one should produce an email
+        stream = []
+        for i in range(args.rate * args.duration):
+            body = dict(template[i % len(template)], id='e2e-%d-%d' % (rules, i),
+                        repeat=False, status='open', severity='major')
+            stream.append(body)
+
+        held = _RecordingHoldQueue()
+        with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+                patch.object(mailer, 'on_hold', held), \
+                patch.object(mailer, 'handoff', queue.Queue(mailer.DEFAULT_OPTIONS['handoff_queue_size'])), \
+                patch.object(mailer, 'HOLD_TIME', args.hold), \
+                Connection('memory://localhost/', transport_options={'polling_interval': 0.01}) as conn:
+            mailer.OPTIONS.update({
+                'amqp_topic': 'bench-%d' % rules,
+                'smtp_host': '127.0.0.1',
+                'smtp_port': sink.server_address[1],
+                'smtp_starttls': False,
+                'mail_from': 'alerta@example.com',
+                'mail_to': ['ops@example.com'],
+                'mail_subject': '{{ alert.id }}',
+                'group_rules': _synthetic_rules(rules),
+            })
+            ready = threading.Event()
+            consumer = mailer.FanoutConsumer(connection=conn)
+            consumer.on_consume_ready = lambda *a, **kw: ready.set()
+            sender = mailer.MailSender()
+            sender.start()
+            threading.Thread(target=consumer.run,
+                             kwargs={'safety_interval': 0.05}, daemon=True).start()
+            ready.wait(10)
+
+            with conn.channel() as channel:
+                producer = Producer(channel, exchange=Exchange(
+                    mailer.OPTIONS['amqp_topic'], type='fanout', durable=True),
+                    serializer='json')
+                start = time.time()
+                for i, body in enumerate(stream):
+                    delay = start + float(i) / args.rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+                    body.update(createTime=now, receiveTime=now, lastReceiveTime=now)
+                    producer.publish(body, routing_key='')
+
+            timeout = time.time() + args.hold + args.duration + 30
+            while sink.count() < len(stream) and time.time() < timeout:
+                time.sleep(0.05)
+            consumer.should_stop = True
+            sender.stop()
+            sender.join()
+
+        arrivals = dict((k, v) for k, v in sink.arrivals.items() if k in held.deadlines)
+        sink.arrivals.clear()
+        latencies = [arrivals[k] - held.deadlines[k] for k in arrivals]
+        sent = max(arrivals.values()) - min(held.deadlines.values()) if arrivals else 0
+        print('%8d %8d %10d %10.0f %12.1f %12.1f %12.1f' % (
+            rules, len(stream), len(arrivals), len(arrivals) / sent if sent > 0 else 0,
+            _percentile(latencies, 50) * 1e3, _percentile(latencies, 99) * 1e3,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    sink.shutdown()
+
+
+BENCHMARKS = {
+    'hold': bench_hold,
+    'prefilter': bench_prefilter,
+    'store': bench_store,
+    'e2e': bench_e2e,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--stream', help='recorded alert bodies, one JSON object per line')
+    parser.add_argument('--rate', type=int, default=1000, help='messages per second')
+    parser.add_argument('--duration', type=int, default=5, help='seconds')
+    parser.add_argument('--rules', type=int, nargs='+', default=[10, 100, 1000],
+                        help='number of group rules')
+    parser.add_argument('--hold', type=float, default=1, help='hold time in seconds')
+    args = parser.parse_args()
+    # mailer.py logs at DEBUG, which would dominate every timing
+    logging.getLogger().setLevel(logging.WARNING)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,25 @@
 #!/usr/bin/env python
 
+import bisect
+import copy
 import datetime
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
 import platform
+import queue
+import random
 import re
 import signal
 import smtplib
 import socket
+import sqlite3
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from configparser import RawConfigParser
-from functools import reduce
 import six
 
 import sys
@@ -36,6 +45,22 @@ try:
 except:
     sys.stdout.write('Python dns.resolver unavailable. The skip_mta option will be forced to False\n')  # nopep8
 
+REDIS_AVAILABLE = False
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    pass
+
+PROMETHEUS_AVAILABLE = False
+
+try:
+    import prometheus_client
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    pass
+
 
 logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
@@ -50,6 +75,16 @@ DEFAULT_OPTIONS = {
     'amqp_topic':    'notify',
     'amqp_queue_name':    '', # Name of the AMQP queue. Default is no name (default queue destination).
     'amqp_queue_exclusive': True, # Exclusive queues may only be consumed by the current connection.
+    'amqp_prefetch_count': 100,  # unacknowledged messages the broker may deliver, 0 is unlimited
+    'amqp_ack_batch_size': 50,  # acknowledge messages in batches of up to this many...
+    'amqp_ack_interval': 200,  # ...or after this many milliseconds
+    'handoff_queue_size': 1000,  # alerts waiting between the consumer and the hold queue
+    'max_held_alerts': 100000,  # stop taking alerts from the broker while this many are held
+    'hold_store':    '',  # SQLite file to keep held alerts in across restarts, empty to disable
+    'shared_hold_store': '',  # redis:// URL shared by mailer replicas, empty for a single mailer
+    'replica_ttl':   15,  # seconds a replica keeps its share of alerts without a heartbeat
+    'shared_poll_interval': 1,  # seconds between checks of the shared store for due alerts
+    'metrics_port':  0,  # serve Prometheus metrics on this port (needs prometheus_client), 0 to disable
     'smtp_host':     'smtp.gmail.com',
     'smtp_port':     587,
     'smtp_username': '', # application-specific username if it differs from the specified 'mail_from' user
@@ -58,27 +93,1035 @@ DEFAULT_OPTIONS = {
     'smtp_use_ssl': False,  # whether or not SSL is being used for the SMTP connection
     'ssl_key_file': None, # a PEM formatted private key file for the SSL connection
     'ssl_cert_file': None, # a certificate chain file for the SSL connection
+    'smtp_pool_idle_timeout': 60,  # seconds before an idle SMTP session is closed, 0 disables reuse
     'mail_from':     '',  # alerta@example.com
     'mail_to':       [],  # devops@example.com, support@example.com
     'mail_localhost': None,  # fqdn to use in the HELO/EHLO command
     'mail_template':  os.path.dirname(__file__) + os.sep + 'email.tmpl',
     'mail_template_html': os.path.dirname(__file__) + os.sep + 'email.html.tmpl',  # nopep8
+    'template_cache_dir': '',  # directory for compiled templates, empty for a per-user temporary directory
     'mail_subject':  ('[{{ alert.status|capitalize }}] {{ alert.environment }}: '
                       '{{ alert.severity|capitalize }} {{ alert.event }} on '
                       '{{ alert.service|join(\',\') }} {{ alert.resource }}'),
+    'digest':        False,  # send one email per contact list for alerts released together
+    'digest_max_alerts': 50,  # send a digest as soon as it has this many alerts
+    'digest_max_latency': 60,  # seconds a released alert may wait for others to join its digest
+    'mail_template_digest': os.path.dirname(__file__) + os.sep + 'digest.tmpl',
+    'mail_template_digest_html': os.path.dirname(__file__) + os.sep + 'digest.html.tmpl',  # nopep8
+    'mail_subject_digest': ('[Digest] {{ alerts|length }} alerts: '
+                            '{{ alerts|map(attribute=\'event\')|unique|join(\', \')|truncate(100) }}'),
     'dashboard_url': 'http://try.alerta.io',
     'debug':         False,
     'skip_mta':      False,
+    'mx_max_workers': 8,  # concurrent deliveries to MX hosts when skip_mta is used
+    'smtp_rate_limit': 0.0,  # emails per second to the SMTP relay, 0 is unlimited
+    'domain_rate_limit': 0.0,  # emails per second to each recipient domain, 0 is unlimited
+    'rate_limit_burst': 10,  # emails that may be sent at once before the rate limits apply
+    'retry_max_attempts': 5,  # retries of an email after a temporary (4xx or connection) failure
+    'retry_initial_delay': 30,  # seconds before the first retry, doubled for each one after it
+    'retry_max_delay': 900,  # longest wait between two retries, in seconds
+    'max_deferred_emails': 1000,  # stop releasing held alerts while this many emails wait to be sent
     'email_type':    'text',  # options are: text, html
-    'severities': []
+    'severities': [],
+    'group_rules_cache_size': 1024,  # number of resolved contact lists to remember
+    'config_reload_interval': 5  # seconds between checks for changed config and rules files, 0 disables
 }
 
+# options that take effect without a restart when the config files change
+RELOADABLE_OPTIONS = frozenset([
+    'mail_from', 'mail_to', 'mail_subject', 'mail_subject_digest',
+    'dashboard_url', 'severities', 'group_rules_cache_size'
+])
+
 OPTIONS = {}
+LOADED_OPTIONS = {}  # options as read from the config files, before main() derives any
 
 # seconds (hold alert until sending, delete if cleared before end of hold time)
 HOLD_TIME = 30
 
-on_hold = dict()
+# seconds between heartbeats sent by the mailer thread
+HEARTBEAT_INTERVAL = 20
+
+# seconds a pooled SMTP session can sit idle before it is checked with NOOP
+SMTP_NOOP_AFTER = 5
+
+# MX deliveries that may wait for a worker, per worker, before the sender blocks
+MX_PENDING_PER_WORKER = 4
+
+
+class Metrics(object):
+    '''Prometheus metrics for the mailer.
+
+    Every recording method returns straight away until enable() has been
+    called, so instrumentation costs a single attribute check when metrics
+    are turned off or prometheus_client is not installed.
+    '''
+
+    LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+    LAG_BUCKETS = (1, 5, 10, 30, 45, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self):
+        self.enabled = False
+
+    def enable(self, port=None, registry=None):
+        if not PROMETHEUS_AVAILABLE:
+            LOG.warning('Python prometheus_client unavailable, metrics are disabled')
+            return False
+        if registry is None:
+            registry = prometheus_client.CollectorRegistry()
+        self.registry = registry
+        self._held = prometheus_client.Gauge(
+            'alerta_mailer_held_alerts', 'Alerts waiting for their hold time to expire',
+            registry=registry)
+        self._held.set_function(lambda: len(on_hold))
+        self._consumed = prometheus_client.Counter(
+            'alerta_mailer_messages_consumed_total', 'Messages received from the broker',
+            registry=registry)
+        self._acked = prometheus_client.Counter(
+            'alerta_mailer_messages_acked_total', 'Messages acknowledged to the broker',
+            registry=registry)
+        self._ignored = prometheus_client.Counter(
+            'alerta_mailer_messages_ignored_total', 'Messages not held, by reason',
+            ['reason'], registry=registry)
+        self._rules = prometheus_client.Histogram(
+            'alerta_mailer_rule_evaluation_seconds', 'Time to resolve the contacts for an alert',
+            buckets=self.LATENCY_BUCKETS, registry=registry)
+        self._render = prometheus_client.Histogram(
+            'alerta_mailer_template_render_seconds', 'Time to render the templates of an email',
+            buckets=self.LATENCY_BUCKETS, registry=registry)
+        self._connect = prometheus_client.Histogram(
+            'alerta_mailer_smtp_connect_seconds', 'Time to open and authenticate an SMTP session',
+            buckets=self.LATENCY_BUCKETS, registry=registry)
+        self._send = prometheus_client.Histogram(
+            'alerta_mailer_smtp_send_seconds', 'Time of an SMTP mail transaction',
+            buckets=self.LATENCY_BUCKETS, registry=registry)
+        self._failures = prometheus_client.Counter(
+            'alerta_mailer_send_failures_total', 'Emails that could not be sent, by exception',
+            ['exception'], registry=registry)
+        self._deferred = prometheus_client.Counter(
+            'alerta_mailer_deferred_emails_total', 'Emails put off by a rate limit or for a retry',
+            ['reason'], registry=registry)
+        self._lag = prometheus_client.Histogram(
+            'alerta_mailer_send_lag_seconds', 'Time from the alert receiveTime to its email',
+            buckets=self.LAG_BUCKETS, registry=registry)
+        if port:
+            prometheus_client.start_http_server(port, registry=registry)
+            LOG.info('Serving metrics on port %d', port)
+        self.enabled = True
+        return True
+
+    def consumed(self):
+        if self.enabled:
+            self._consumed.inc()
+
+    def acked(self, count=1):
+        if self.enabled:
+            self._acked.inc(count)
+
+    def ignored(self, reason):
+        if self.enabled:
+            self._ignored.labels(reason).inc()
+
+    def rule_evaluation(self, seconds):
+        if self.enabled:
+            self._rules.observe(seconds)
+
+    def template_render(self, seconds):
+        if self.enabled:
+            self._render.observe(seconds)
+
+    def smtp_connect(self, seconds):
+        if self.enabled:
+            self._connect.observe(seconds)
+
+    def smtp_send(self, seconds):
+        if self.enabled:
+            self._send.observe(seconds)
+
+    def send_failure(self, exc):
+        if self.enabled:
+            self._failures.labels(type(exc).__name__).inc()
+
+    def deferred(self, reason):
+        if self.enabled:
+            self._deferred.labels(reason).inc()
+
+    def sent(self, alerts):
+        '''Record the lag from receiveTime for alerts that were just emailed'''
+        if not self.enabled:
+            return
+        now = datetime.datetime.utcnow()
+        for alert in alerts:
+            if alert.receive_time is not None:
+                self._lag.observe((now - alert.receive_time).total_seconds())
+
+
+METRICS = Metrics()
+
+
+class HoldQueue(object):
+    '''Alerts waiting for their hold time to expire, ordered by deadline.
+
+    Entries live in a heap of ``(deadline, seq, alertid)`` plus an index of
+    the current entry for each alert. Holding an alert again or cancelling
+    it only touches the index; superseded heap entries are skipped when they
+    reach the top of the heap, so no operation has to scan the whole queue.
+    '''
+
+    def __init__(self):
+        self._heap = []
+        self._held = {}  # alertid -> (alert, deadline, seq)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._woken = False
+
+    def __len__(self):
+        return len(self._held)
+
+    def __contains__(self, alertid):
+        return alertid in self._held
+
+    def hold(self, alertid, alert, deadline):
+        '''Hold an alert until deadline, replacing any earlier hold'''
+        with self._cond:
+            seq = next(self._seq)
+            self._held[alertid] = (alert, deadline, seq)
+            heapq.heappush(self._heap, (deadline, seq, alertid))
+            self._maybe_compact()
+            if self._heap[0][1] == seq:
+                # new earliest deadline, the sender may be sleeping too long
+                self._cond.notify_all()
+
+    def cancel(self, alertid):
+        '''Drop a held alert, returns False if it was not held'''
+        with self._cond:
+            if self._held.pop(alertid, None) is None:
+                return False
+            self._maybe_compact()
+            return True
+
+    def next_deadline(self):
+        with self._cond:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None, limit=None):
+        '''Remove and return (alertid, alert) for every expired hold, or
+        for the limit earliest ones
+        '''
+        if now is None:
+            now = time.time()
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now and (
+                    limit is None or len(due) < limit):
+                _, seq, alertid = heapq.heappop(self._heap)
+                entry = self._held.get(alertid)
+                if entry is None or entry[2] != seq:
+                    continue
+                del self._held[alertid]
+                due.append((alertid, entry[0]))
+        return due
+
+    def wait(self, timeout=None):
+        '''Sleep until the next deadline, an earlier hold, wake() or timeout'''
+        with self._cond:
+            if self._woken:
+                self._woken = False
+                return
+            self._discard_stale()
+            if self._heap:
+                delay = self._heap[0][0] - time.time()
+                if timeout is None or delay < timeout:
+                    timeout = delay
+            if timeout is None or timeout > 0:
+                self._cond.wait(timeout)
+            self._woken = False
+
+    def wake(self):
+        with self._cond:
+            self._woken = True
+            self._cond.notify_all()
+
+    def _discard_stale(self):
+        while self._heap:
+            _, seq, alertid = self._heap[0]
+            entry = self._held.get(alertid)
+            if entry is not None and entry[2] == seq:
+                break
+            heapq.heappop(self._heap)
+
+    def _maybe_compact(self):
+        # Rebuild the heap once superseded entries outnumber live ones,
+        # so repeatedly re-held alerts cannot grow it without bound.
+        if len(self._heap) > 2 * len(self._held) + 64:
+            self._heap = [(deadline, seq, alertid) for alertid, (_, deadline, seq)
+                          in self._held.items()]
+            heapq.heapify(self._heap)
+
+
+on_hold = HoldQueue()
+
+class HoldStore(object):
+    '''Durable copy of the hold queue, kept in SQLite in WAL mode.
+
+    Writes are buffered in memory (the latest write per alert wins) and
+    committed together by sync(), which the consumer calls before it
+    acknowledges a batch of messages. One transaction therefore covers a
+    whole acknowledgement batch, and no alert is acknowledged before it
+    is on disk.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS held ('
+                         'alertid TEXT PRIMARY KEY, deadline REAL NOT NULL, body TEXT NOT NULL)')
+        self._ids = set(row[0] for row in self._db.execute('SELECT alertid FROM held'))
+        self._pending = {}  # alertid -> (deadline, body) or None to delete
+        self._lock = threading.Lock()
+        self.commits = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def load(self):
+        '''Return (alertid, body, deadline) for every stored hold'''
+        self.sync()
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT alertid, body, deadline FROM held ORDER BY deadline').fetchall()
+        return [(alertid, json.loads(body), deadline) for alertid, body, deadline in rows]
+
+    def update(self, alertid, body, deadline, cleared=False):
+        '''Record an alert received from the broker, mirroring the hold
+        queue: a clear removes a stored hold, anything else (re)stores it
+        '''
+        with self._lock:
+            if cleared and alertid in self._ids:
+                self._ids.discard(alertid)
+                self._pending[alertid] = None
+            else:
+                self._ids.add(alertid)
+                self._pending[alertid] = (deadline, json.dumps(body))
+
+    def delete(self, alertid):
+        with self._lock:
+            if alertid in self._ids:
+                self._ids.discard(alertid)
+                self._pending[alertid] = None
+
+    def sync(self):
+        '''Commit every buffered write in a single transaction'''
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            deletes = [(alertid,) for alertid, row in pending.items() if row is None]
+            upserts = [(alertid, row[0], row[1]) for alertid, row in pending.items()
+                       if row is not None]
+            self._db.execute('BEGIN')
+            try:
+                if deletes:
+                    self._db.executemany('DELETE FROM held WHERE alertid = ?', deletes)
+                if upserts:
+                    self._db.executemany('INSERT OR REPLACE INTO held (alertid, deadline, body) '
+                                         'VALUES (?, ?, ?)', upserts)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                # keep the writes for the next attempt, newer ones win
+                pending.update(self._pending)
+                self._pending = pending
+                raise
+            self.commits += 1
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            self._db.close()
+
+
+# durable copy of on_hold, see the hold_store option
+hold_store = None
+
+
+class MemoryHoldBackend(object):
+    '''In-process stand-in for a shared hold store, for tests and for
+    running several mailers in one process
+    '''
+
+    def __init__(self):
+        self._held = {}  # alertid -> (deadline, body)
+        self._members = {}  # member -> lease expiry
+        self._lock = threading.Lock()
+
+    def update(self, alertid, body, deadline, cleared=False):
+        with self._lock:
+            if cleared and self._held.pop(alertid, None) is not None:
+                return
+            self._held[alertid] = (deadline, body)
+
+    def due(self, now, limit, offset=0):
+        with self._lock:
+            due = sorted((deadline, alertid) for alertid, (deadline, _) in self._held.items()
+                         if deadline <= now)
+        return [alertid for _, alertid in due[offset:offset + limit]]
+
+    def claim(self, alertids, now):
+        '''Remove the given alerts if they are still due, returning the
+        body of each one removed by this call and None for the others
+        '''
+        with self._lock:
+            bodies = []
+            for alertid in alertids:
+                held = self._held.get(alertid)
+                if held is not None and held[0] <= now:
+                    del self._held[alertid]
+                    bodies.append(held[1])
+                else:
+                    bodies.append(None)
+            return bodies
+
+    def next_deadline(self):
+        with self._lock:
+            return min([deadline for deadline, _ in self._held.values()] or [None])
+
+    def heartbeat(self, member, expires):
+        with self._lock:
+            self._members[member] = expires
+
+    def leave(self, member):
+        with self._lock:
+            self._members.pop(member, None)
+
+    def members(self, now):
+        with self._lock:
+            for member in [m for m, expires in self._members.items() if expires <= now]:
+                del self._members[member]
+            return sorted(self._members)
+
+
+class RedisHoldBackend(object):
+    '''Hold state shared through Redis: a sorted set of deadlines, a hash
+    of alert bodies and a sorted set of replica leases. Updates and claims
+    run as scripts, so each is atomic across replicas.
+    '''
+
+    UPDATE = '''
+if ARGV[4] == '1' and redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+return 1
+'''
+
+    CLAIM = '''
+local bodies = {}
+for i, alertid in ipairs(ARGV) do
+    if i > 1 then
+        local deadline = redis.call('ZSCORE', KEYS[1], alertid)
+        if deadline and tonumber(deadline) <= tonumber(ARGV[1]) then
+            redis.call('ZREM', KEYS[1], alertid)
+            bodies[i - 1] = redis.call('HGET', KEYS[2], alertid)
+            redis.call('HDEL', KEYS[2], alertid)
+        else
+            bodies[i - 1] = false
+        end
+    end
+end
+return bodies
+'''
+
+    def __init__(self, url, prefix='alerta-mailer'):
+        self._redis = redis.Redis.from_url(url)
+        self._deadlines = prefix + ':deadlines'
+        self._bodies = prefix + ':bodies'
+        self._members = prefix + ':members'
+        self._update = self._redis.register_script(self.UPDATE)
+        self._claim = self._redis.register_script(self.CLAIM)
+
+    def update(self, alertid, body, deadline, cleared=False):
+        self._update(keys=[self._deadlines, self._bodies],
+                     args=[alertid, deadline, json.dumps(body), '1' if cleared else '0'])
+
+    def due(self, now, limit, offset=0):
+        return [alertid.decode('utf-8') for alertid in self._redis.zrangebyscore(
+            self._deadlines, '-inf', now, start=offset, num=limit)]
+
+    def claim(self, alertids, now):
+        if not alertids:
+            return []
+        bodies = self._claim(keys=[self._deadlines, self._bodies], args=[now] + list(alertids))
+        bodies += [None] * (len(alertids) - len(bodies))
+        return [json.loads(body) if body else None for body in bodies]
+
+    def next_deadline(self):
+        first = self._redis.zrange(self._deadlines, 0, 0, withscores=True)
+        return first[0][1] if first else None
+
+    def heartbeat(self, member, expires):
+        self._redis.zadd(self._members, {member: expires})
+
+    def leave(self, member):
+        self._redis.zrem(self._members, member)
+
+    def members(self, now):
+        self._redis.zremrangebyscore(self._members, '-inf', now)
+        return sorted(m.decode('utf-8') for m in self._redis.zrange(self._members, 0, -1))
+
+
+class HashRing(object):
+    '''Consistent hashing of alert ids over replicas, so that a change in
+    membership only moves the alerts of the replicas that came or went
+    '''
+
+    def __init__(self, members, replicas=64):
+        self.members = sorted(members)
+        ring = sorted((self._hash('%s#%d' % (member, i)), member)
+                      for member in self.members for i in range(replicas))
+        self._hashes = [h for h, _ in ring]
+        self._owners = [member for _, member in ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        if not self._owners:
+            return None
+        return self._owners[bisect.bisect(self._hashes, self._hash(key)) % len(self._owners)]
+
+
+class SharedHold(object):
+    '''Hold state shared by mailer replicas.
+
+    Every replica writes the alerts it consumes to the shared backend.
+    Each replica holds a lease, renewed by heartbeat(), and the live
+    replicas split alert ids between them on a hash ring. A replica only
+    claims due alerts that it owns. The claim removes the alert from the
+    backend atomically, so an alert is emailed once even while replicas
+    disagree about membership.
+    '''
+
+    BATCH = 500  # due alerts read from the backend at a time, and most claimed per pop_due() call
+    MAX_PAGES = 20  # batches of other replicas' alerts paged past per pop_due() call
+
+    def __init__(self, backend, member, ttl, poll_interval=1):
+        self.backend = backend
+        self.member = member
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.ring = HashRing([])
+        self._next_heartbeat = 0
+        self._backlog = False  # the last pop_due() stopped with owned alerts possibly left
+
+    def update(self, alertid, body, deadline, cleared=False):
+        self.backend.update(alertid, body, deadline, cleared=cleared)
+
+    def heartbeat(self, now=None):
+        '''Renew this replica's lease when due and pick up membership changes'''
+        now = now if now is not None else time.time()
+        if now >= self._next_heartbeat:
+            self.backend.heartbeat(self.member, now + self.ttl)
+            self._next_heartbeat = now + self.ttl / 3.0
+        members = self.backend.members(now)
+        if members != self.ring.members:
+            LOG.info('Mailer replicas changed to %s', ', '.join(members))
+            self.ring = HashRing(members)
+
+    def leave(self):
+        self.backend.leave(self.member)
+
+    def pop_due(self, now=None, limit=None):
+        '''Claim the due alerts this replica owns, as (alertid, alert)'''
+        now = now if now is not None else time.time()
+        self.heartbeat(now)
+        want = self.BATCH if limit is None else min(limit, self.BATCH)
+        owned = []
+        # page past the due alerts of other replicas, including those of a
+        # replica whose lease has not expired yet, to find this one's share
+        for page in range(self.MAX_PAGES):
+            if len(owned) >= want:
+                break
+            alertids = self.backend.due(now, self.BATCH, offset=page * self.BATCH)
+            owned.extend(alertid for alertid in alertids if self.ring.owner(alertid) == self.member)
+            if len(alertids) < self.BATCH:
+                break
+        else:
+            page = self.MAX_PAGES
+        owned = owned[:want]
+        self._backlog = want > 0 and (len(owned) == want or page == self.MAX_PAGES)
+        due = []
+        for alertid, body in zip(owned, self.backend.claim(owned, now)):
+            if body is None:
+                continue
+            try:
+                due.append((alertid, Alert.parse(body)))
+            except Exception as e:
+                LOG.warning('Could not parse held alert %s: %s', alertid, e)
+        return due
+
+    def next_wakeup(self, now=None):
+        '''When to check for due alerts again'''
+        now = now if now is not None else time.time()
+        if self._backlog:
+            return now
+        wakeup = min(now + self.poll_interval, self._next_heartbeat)
+        next_deadline = self.backend.next_deadline()
+        if next_deadline is not None and now < next_deadline < wakeup:
+            wakeup = next_deadline
+        return wakeup
+
+
+# hold state shared by mailer replicas, see the shared_hold_store option
+shared_hold = None
+
+
+def shared_hold_backend(url):
+    if url.startswith('memory://'):
+        return MemoryHoldBackend()
+    if not REDIS_AVAILABLE:
+        raise RuntimeError('Python redis unavailable, it is needed for shared_hold_store')
+    return RedisHoldBackend(url)
+
+
+# (alertid, alert, deadline) from the consumer to the mailer thread, bounded
+# so that a full hold queue blocks the consumer instead of growing memory
+handoff = queue.Queue(maxsize=DEFAULT_OPTIONS['handoff_queue_size'])
+
+
+class SMTPConnectionPool(object):
+    '''Reusable SMTP sessions keyed by connection settings.
+
+    A key is ``(host, port, use_ssl, starttls, username, password)``. Idle
+    sessions are checked with NOOP before reuse, closed by reap() after
+    idle_timeout seconds and replaced transparently if the server has
+    dropped them. An idle_timeout of 0 closes every session after use.
+    '''
+
+    # the server refused this message, but the session is still usable
+    _REJECTED = (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)
+
+    def __init__(self, idle_timeout=60):
+        self.idle_timeout = idle_timeout
+        self._idle = {}  # key -> [(session, last_used)]
+        self._lock = threading.Lock()
+
+    def sendmail(self, key, from_addr, to_addrs, msg):
+        mx, reused = self._acquire(key)
+        try:
+            return self._sendmail(key, mx, from_addr, to_addrs, msg)
+        except self._REJECTED:
+            raise
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            if not reused:
+                raise
+        LOG.debug('Pooled SMTP session to %s:%s was dropped, reconnecting', key[0], key[1])
+        return self._sendmail(key, self._connect(key), from_addr, to_addrs, msg)
+
+    def reap(self, now=None):
+        '''Close sessions that have been idle for longer than idle_timeout'''
+        if now is None:
+            now = time.time()
+        expired = []
+        with self._lock:
+            for key, sessions in list(self._idle.items()):
+                keep = [(mx, used) for mx, used in sessions
+                        if now - used < self.idle_timeout]
+                expired.extend(mx for mx, used in sessions
+                               if now - used >= self.idle_timeout)
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+        for mx in expired:
+            self._close(mx)
+
+    def close_all(self):
+        with self._lock:
+            sessions = [mx for idle in self._idle.values() for mx, _ in idle]
+            self._idle.clear()
+        for mx in sessions:
+            self._close(mx)
+
+    def _sendmail(self, key, mx, from_addr, to_addrs, msg):
+        start = time.time()
+        try:
+            refused = mx.sendmail(from_addr, to_addrs, msg)
+            METRICS.smtp_send(time.time() - start)
+        except self._REJECTED:
+            self._release(key, mx)
+            raise
+        except Exception:
+            self._close(mx)
+            raise
+        self._release(key, mx)
+        return refused
+
+    def _acquire(self, key):
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                mx, used = idle.pop()
+            if time.time() - used < SMTP_NOOP_AFTER:
+                return mx, True
+            try:
+                if mx.noop()[0] == 250:
+                    return mx, True
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self._close(mx)
+        return self._connect(key), False
+
+    def _release(self, key, mx):
+        if self.idle_timeout <= 0:
+            self._close(mx)
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append((mx, time.time()))
+
+    @staticmethod
+    def _connect(key):
+        host, port, use_ssl, starttls, username, password = key
+        start = time.time()
+        if use_ssl:
+            mx = smtplib.SMTP_SSL(host,
+                                  port,
+                                  local_hostname=OPTIONS['mail_localhost'],
+                                  keyfile=OPTIONS['ssl_key_file'],
+                                  certfile=OPTIONS['ssl_cert_file'])
+        else:
+            mx = smtplib.SMTP(host,
+                              port,
+                              local_hostname=OPTIONS['mail_localhost'])
+        try:
+            if OPTIONS['debug']:
+                mx.set_debuglevel(True)
+
+            mx.ehlo()
+
+            if starttls:
+                mx.starttls()
+
+            if password:
+                mx.login(username, password)
+        except Exception:
+            SMTPConnectionPool._close(mx)
+            raise
+        METRICS.smtp_connect(time.time() - start)
+        return mx
+
+    @staticmethod
+    def _close(mx):
+        try:
+            mx.quit()
+        except (smtplib.SMTPException, socket.error):
+            mx.close()
+
+
+def _rule_matches(pattern, value):
+    '''Checks if a compiled rule regex matches
+    its provided value considering its type
+    '''
+    if isinstance(value, list):
+        # at least one item must match
+        for item in value:
+            if isinstance(item, six.string_types) and pattern.match(item) is not None:  # pylint: disable=undefined-variable
+                return True
+        return False
+    elif isinstance(value, six.string_types):  # pylint: disable=undefined-variable
+        return pattern.search(value) is not None
+    return False
+
+
+def _memo_value(value):
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+class GroupRules(object):
+    '''Compiled group rules that resolve the contact list for an alert.
+
+    Regexes are compiled once and identical (field, regex) tests shared by
+    several rules are evaluated once per alert. Rules are indexed by the
+    fields they test, so rules testing a field the alert does not have are
+    skipped without evaluating any of their tests. Resolved contact lists are
+    kept in an LRU memo keyed by the values of the fields the rules test,
+    so alerts that agree on those fields skip rule evaluation altogether.
+    Rules are still applied in order, so ``exclude`` behaves as before.
+    '''
+
+    def __init__(self, rules=(), cache_size=1024):
+        self.rules = list(rules)
+        self.cache_size = cache_size
+        self._compiled = []  # [(rule, [(field, regex)])]
+        self._patterns = {}  # (field, regex) -> compiled pattern
+        self._by_field = {}  # field -> indexes of the rules testing it
+        for index, rule in enumerate(self.rules):
+            tests = []
+            for field in rule['fields']:
+                test = (field['field'], field['regex'])
+                if test not in self._patterns:
+                    self._patterns[test] = re.compile(field['regex'])
+                self._by_field.setdefault(field['field'], set()).add(index)
+                tests.append(test)
+            self._compiled.append((rule, tests))
+        self.fields = sorted(self._by_field)
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def contacts_for(self, alert, initial=()):
+        '''Return the contacts for an alert, starting from initial'''
+        if not self.rules:
+            return list(initial)
+        values = dict((field, getattr(alert, field, None)) for field in self.fields)
+        key = (tuple(initial),
+               tuple(_memo_value(values[field]) for field in self.fields))
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+
+        if key is not None:
+            with self._lock:
+                contacts = self._memo.get(key)
+                if contacts is not None:
+                    self._memo.move_to_end(key)
+                    return list(contacts)
+
+        contacts = self._evaluate(values, initial)
+        LOG.debug('Resolved contacts %s from %d group rules', contacts, len(self.rules))
+
+        if key is not None and self.cache_size > 0:
+            with self._lock:
+                self._memo[key] = tuple(contacts)
+                if len(self._memo) > self.cache_size:
+                    self._memo.popitem(last=False)
+        return contacts
+
+    def _evaluate(self, values, initial):
+        contacts = list(initial)
+        skip = set()
+        for field, value in values.items():
+            if value is None:
+                LOG.warning('Alert has no attribute %s', field)
+                skip.update(self._by_field[field])
+        results = {}
+        for index, (rule, tests) in enumerate(self._compiled):
+            if index in skip:
+                continue
+            for test in tests:
+                is_matching = results.get(test)
+                if is_matching is None:
+                    is_matching = _rule_matches(self._patterns[test], values[test[0]])
+                    results[test] = is_matching
+                if not is_matching:
+                    break
+            else:
+                # Add up any new contacts
+                new_contacts = [x.strip() for x in rule['contacts']
+                                if x.strip() not in contacts]
+                if len(new_contacts) > 0:
+                    if not rule.get('exclude', False):
+                        contacts.extend(new_contacts)
+                    else:
+                        # Clear initial list of contacts and add for this rule only
+                        del contacts[:]
+                        contacts.extend(new_contacts)
+        return contacts
+
+
+class DigestBuffer(object):
+    '''Released alerts waiting to be sent together, one batch per contact list.
+
+    A batch is ready once it has max_alerts alerts or its oldest alert has
+    waited max_latency seconds.
+    '''
+
+    def __init__(self, max_alerts, max_latency):
+        self.max_alerts = max(1, max_alerts)
+        self.max_latency = max_latency
+        self._batches = {}  # tuple(contacts) -> (first_added, [alerts])
+
+    def __len__(self):
+        return sum(len(alerts) for _, alerts in self._batches.values())
+
+    def add(self, contacts, alert, now=None):
+        '''Add an alert, returns the batch for its contacts if it is now full'''
+        if now is None:
+            now = time.time()
+        key = tuple(contacts)
+        _, alerts = self._batches.setdefault(key, (now, []))
+        alerts.append(alert)
+        if len(alerts) >= self.max_alerts:
+            del self._batches[key]
+            return list(key), alerts
+        return None
+
+    def next_deadline(self):
+        if not self._batches:
+            return None
+        return min(added for added, _ in self._batches.values()) + self.max_latency
+
+    def pop_due(self, now=None):
+        '''Remove and return (contacts, alerts) for batches that waited long enough'''
+        if now is None:
+            now = time.time()
+        due = [key for key, (added, _) in self._batches.items()
+               if now >= added + self.max_latency]
+        return [(list(key), self._batches.pop(key)[1]) for key in due]
+
+    def pop_all(self):
+        batches = [(list(key), alerts) for key, (_, alerts) in self._batches.items()]
+        self._batches.clear()
+        return batches
+
+
+def _resolve_mx(domain):
+    resolve = getattr(dns.resolver, 'resolve', None) or dns.resolver.query
+    return resolve(domain, 'MX')
+
+
+class MXCache(object):
+    '''Mail exchangers per domain, most preferred first, cached for their DNS TTL'''
+
+    def __init__(self):
+        self._cache = {}  # domain -> (hosts, expires)
+        self._lock = threading.Lock()
+
+    def lookup(self, domain, now=None):
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._cache.get(domain)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        answers = _resolve_mx(domain)
+        hosts = [r.exchange.to_text() for r in sorted(answers, key=lambda r: r.preference)]
+        if not hosts:
+            raise Exception('Failed to find mail exchange for {}'.format(domain))  # nopep8
+        expires = getattr(answers, 'expiration', None) or now + answers.rrset.ttl
+        with self._lock:
+            self._cache[domain] = (hosts, expires)
+        return hosts
+
+
+class RateLimiter(object):
+    '''Token buckets keyed by (kind, name), e.g. ('domain', 'example.com').
+
+    Each kind has its own rate in emails per second, 0 for no limit. A
+    bucket holds up to burst tokens and starts full.
+    '''
+
+    MAX_BUCKETS = 4096  # forget full buckets beyond this many
+
+    def __init__(self, rates, burst):
+        self.rates = dict((kind, float(rate)) for kind, rate in rates.items() if rate > 0)
+        self.burst = max(1, burst)
+        self._buckets = {}  # (kind, name) -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def reserve(self, keys, now=None):
+        '''Take a token from the bucket of every key and return 0, or take
+        none and return the seconds until every bucket has a token
+        '''
+        keys = [key for key in keys if key[0] in self.rates]
+        if not keys:
+            return 0
+        if now is None:
+            now = time.time()
+        with self._lock:
+            levels = {}
+            wait = 0
+            for key in keys:
+                rate = self.rates[key[0]]
+                tokens, updated = self._buckets.get(key, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * rate)
+                levels[key] = tokens
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            if wait > 0:
+                return wait
+            for key, tokens in levels.items():
+                self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._prune(now)
+            return 0
+
+    def _prune(self, now):
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if tokens + (now - updated) * self.rates[key[0]] >= self.burst:
+                del self._buckets[key]
+
+
+def _is_transient(exc):
+    '''Whether a failed send may succeed later: 4xx replies and connection errors'''
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPException):
+        return isinstance(exc, smtplib.SMTPServerDisconnected)
+    return isinstance(exc, socket.error)
+
+
+class AckBatcher(object):
+    '''Acknowledges consumed messages in batches.
+
+    With ``multiple`` set (AMQP brokers) a batch is acknowledged with a
+    single basic.ack of the last delivery tag, otherwise every message in
+    the batch is acknowledged in turn.
+    '''
+
+    def __init__(self, batch_size=1, interval=0, multiple=False, before_flush=None):
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.multiple = multiple
+        self.before_flush = before_flush
+        self._pending = []
+        self._first = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, message, now=None):
+        if not self._pending:
+            self._first = time.time() if now is None else now
+        self._pending.append(message)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def maybe_flush(self, now=None):
+        if now is None:
+            now = time.time()
+        if self._pending and now >= self._first + self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        if self.before_flush is not None:
+            self.before_flush()
+        pending, self._pending = self._pending, []
+        if self.multiple:
+            pending[-1].ack(multiple=True)
+        else:
+            for message in pending:
+                message.ack()
+        METRICS.acked(len(pending))
 
 
 class FanoutConsumer(ConsumerMixin):
@@ -87,6 +1130,14 @@ class FanoutConsumer(ConsumerMixin):
 
         self.connection = connection
         self.channel = self.connection.channel()
+        self.severities = frozenset(OPTIONS['severities'] or ['critical', 'major'])
+        self.ignored = Counter()  # reason -> number of messages ignored
+        self.acks = AckBatcher(
+            batch_size=OPTIONS['amqp_ack_batch_size'],
+            interval=OPTIONS['amqp_ack_interval'] / 1000.0,
+            multiple=getattr(connection.transport, 'driver_type', None) == 'amqp',
+            before_flush=hold_store.sync if hold_store is not None else None
+        )
 
     def get_consumers(self, Consumer, channel):
 
@@ -109,54 +1160,80 @@ class FanoutConsumer(ConsumerMixin):
 
         return [
             Consumer(queues=queues, accept=['json'],
-                     callbacks=[self.on_message])
+                     callbacks=[self.on_message],
+                     prefetch_count=OPTIONS['amqp_prefetch_count'] or None)
         ]
 
+    def on_iteration(self):
+        self.acks.maybe_flush()
+
+    def on_consume_end(self, connection, channel):
+        self.acks.flush()
+
+    def ignore_reason(self, body):
+        """Return why an alert can be ignored, tested on the raw message
+        body so that most messages never need to be parsed
+        """
+        if body.get('repeat'):
+            return 'repeat'
+        if body.get('status') not in ('open', 'closed'):
+            return 'status'
+        if (
+            body.get('severity') not in self.severities and
+            body.get('previousSeverity') not in self.severities
+        ):
+            return 'severity'
+        return None
+
     def on_message(self, body, message):
-        sevs = list(OPTIONS['severities'])
-        if not sevs:
-            sevs = ['critical', 'major']
+        METRICS.consumed()
+        if isinstance(body, dict):
+            reason = self.ignore_reason(body)
+            if reason is not None:
+                LOG.debug('Ignored alert %s: %s', body.get('id'), reason)
+                self.ignored[reason] += 1
+                METRICS.ignored(reason)
+                self.acks.add(message)
+                return
 
         try:
             alert = Alert.parse(body)
             alertid = alert.get_id()
         except Exception as e:
             LOG.warn(e)
+            self.ignored['invalid'] += 1
+            METRICS.ignored('invalid')
+            # acknowledge it anyway, or it would use up a prefetch slot for good
+            self.acks.add(message)
             return
 
         LOG.debug('Alert received from the queue (id: %s)', alertid)
-        if alert.repeat:
-            LOG.debug('Ignored alert %s: repeat state', alertid)
-            message.ack()
-            return
 
-        if alert.status not in ['open', 'closed']:
-            LOG.debug('Ignored alert %s: not in open or closed state', alertid)
-            message.ack()
+        if shared_hold is not None:
+            # the replica that owns the alert sends it once its hold is up
+            shared_hold.update(alertid, body, time.time() + HOLD_TIME,
+                               cleared=alert.severity in ['normal', 'ok', 'cleared'])
+            self.acks.add(message)
             return
 
-        if (
-            alert.severity not in sevs and
-            alert.previous_severity not in sevs
-        ):
-            LOG.debug('Ignored alert %s: severity or previous_severity does not matche the severities configuration (%s)',
-                      alertid, sevs)
-            message.ack()
-            return
-
-        if alertid in on_hold:
-            if alert.severity in ['normal', 'ok', 'cleared']:
+        item = (alertid, alert, time.time() + HOLD_TIME)
+        if hold_store is not None:
+            hold_store.update(alertid, body, item[2],
+                              cleared=alert.severity in ['normal', 'ok', 'cleared'])
+        try:
+            handoff.put_nowait(item)
+        except queue.Full:
+            # the mailer is behind; stop acknowledging so the broker stops
+            # delivering once the prefetch window is used up
+            LOG.debug('Hand-off queue is full, waiting for the mailer')
+            self.acks.flush()
+            while not self.should_stop:
                 try:
-                    del on_hold[alertid]
-                except KeyError:
-                    pass
-                message.ack()
-            else:
-                on_hold[alertid] = (alert, time.time() + HOLD_TIME)
-                message.ack()
-        else:
-            on_hold[alertid] = (alert, time.time() + HOLD_TIME)
-            message.ack()
+                    handoff.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+        self.acks.add(message)
 
 
 class MailSender(threading.Thread):
@@ -168,105 +1245,272 @@ class MailSender(threading.Thread):
             os.path.realpath(OPTIONS['mail_template']))
         self._template_name = os.path.basename(OPTIONS['mail_template'])
         self._subject_template = jinja2.Template(OPTIONS['mail_subject'])
+        template_dirs = [self._template_dir]
+        if OPTIONS['digest']:
+            for template in (OPTIONS['mail_template_digest'],
+                             OPTIONS['mail_template_digest_html']):
+                if template:
+                    template_dirs.append(os.path.dirname(os.path.realpath(template)))
         self._template_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(self._template_dir),
-            extensions=['jinja2.ext.autoescape'],
+            loader=jinja2.FileSystemLoader(template_dirs),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(
+                os.path.expanduser(OPTIONS['template_cache_dir']) or None),
+            # templates are cached by _get_template instead
+            cache_size=0,
             autoescape=True
         )
+        self._templates = {}  # name -> compiled template
+        # template variables that are the same for every email
+        self._process_vars = {
+            'program': os.path.basename(sys.argv[0]),
+            'hostname': platform.uname()[1]
+        }
         if OPTIONS['mail_template_html']:
             self._template_name_html = os.path.basename(
                 OPTIONS['mail_template_html'])
+        self._smtp_pool = SMTPConnectionPool(
+            idle_timeout=OPTIONS['smtp_pool_idle_timeout'])
+        self._group_rules = GroupRules(OPTIONS.get('group_rules', ()),
+                                       cache_size=OPTIONS['group_rules_cache_size'])
+        self._rate_limiter = RateLimiter({'smtp': OPTIONS['smtp_rate_limit'],
+                                          'domain': OPTIONS['domain_rate_limit']},
+                                         burst=OPTIONS['rate_limit_burst'])
+        # emails waiting for a rate limit or a retry, as (msg, contacts, alerts, attempt)
+        self._deferred = HoldQueue()
+        self._deferred_ids = itertools.count()
+        # alertid -> emails for it not sent or given up on yet, its hold
+        # store entry is kept until this drops to zero
+        self._unsettled = Counter()
+        self._unsettled_lock = threading.Lock()
+
+        self._mx_executor = None
+        if OPTIONS['skip_mta'] and DNS_RESOLVER_AVAILABLE:
+            workers = max(1, OPTIONS['mx_max_workers'])
+            self._mx_cache = MXCache()
+            self._mx_executor = ThreadPoolExecutor(max_workers=workers)
+            self._mx_pending = threading.BoundedSemaphore(workers * MX_PENDING_PER_WORKER)
+
+        self._digest = None
+        if OPTIONS['digest']:
+            self._digest = DigestBuffer(OPTIONS['digest_max_alerts'],
+                                        OPTIONS['digest_max_latency'])
+            self._digest_subject_template = jinja2.Template(
+                OPTIONS['mail_subject_digest'])
+            self._digest_template_name = os.path.basename(
+                OPTIONS['mail_template_digest'])
+            self._digest_template_name_html = None
+            if OPTIONS['mail_template_digest_html']:
+                self._digest_template_name_html = os.path.basename(
+                    OPTIONS['mail_template_digest_html'])
 
         super(MailSender, self).__init__()
 
     def run(self):
 
         api = Client(endpoint=OPTIONS['endpoint'], key=OPTIONS['key'])
-        keep_alive = 0
+        next_heartbeat = time.time() + HEARTBEAT_INTERVAL
 
         while not self.should_stop:
-            for alertid in list(on_hold.keys()):
-                try:
-                    (alert, hold_time) = on_hold[alertid]
-                except KeyError:
-                    continue
-                if time.time() > hold_time:
+            self._drain_handoff()
+            for _, (msg, contacts, alerts, attempt) in self._deferred.pop_due():
+                self._deliver(msg, contacts, alerts, attempt)
+                self._settle(alerts)
+            held = shared_hold if shared_hold is not None else on_hold
+            # alerts stay on hold while deferred emails use up the room
+            for alertid, alert in held.pop_due(limit=self._deferred_room()):
+                self._unsettle([alert])
+                if self._digest is not None:
+                    self.add_to_digest(alert)
+                else:
                     self.send_email(alert)
-                    try:
-                        del on_hold[alertid]
-                    except KeyError:
-                        continue
-
-            if keep_alive >= 10:
+                self._settle([alert])
+            if hold_store is not None:
+                hold_store.sync()
+            if self._digest is not None:
+                for contacts, alerts in self._digest.pop_due():
+                    self.send_digest(alerts, contacts)
+
+            now = time.time()
+            if now >= next_heartbeat:
                 try:
                     origin = '{}/{}'.format('alerta-mailer', OPTIONS['smtp_host'])
                     api.heartbeat(origin, tags=[__version__])
                 except Exception as e:
-                    time.sleep(5)
-                    continue
-                keep_alive = 0
-            keep_alive += 1
-            time.sleep(2)
+                    next_heartbeat = now + 5
+                else:
+                    next_heartbeat = now + HEARTBEAT_INTERVAL
+
+            self._smtp_pool.reap()
+
+            # sleep until the next hold expires (or a new one arrives)
+            wake_at = next_heartbeat
+            if self._digest is not None and self._digest.next_deadline() is not None:
+                wake_at = min(wake_at, self._digest.next_deadline())
+            self._wait(wake_at)
+
+        if self._digest is not None:
+            for contacts, alerts in self._digest.pop_all():
+                self.send_digest(alerts, contacts)
+        if self._mx_executor is not None:
+            self._mx_executor.shutdown(wait=True)
+        self._smtp_pool.close_all()
+        if shared_hold is not None:
+            shared_hold.leave()
+        if len(self._deferred):
+            LOG.warning('Dropping %d emails still waiting for a rate limit or retry%s',
+                        len(self._deferred),
+                        ', their alerts stay in the hold store' if hold_store is not None else '')
+
+    def stop(self):
+        self.should_stop = True
+        on_hold.wake()
+        self._deferred.wake()
+        try:
+            handoff.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _get_template(self, name):
+        '''Return a compiled template, loading it again only after its
+        file has been modified
+        '''
+        template = self._templates.get(name)
+        if template is None or not template.is_up_to_date:
+            template = self._template_env.get_template(name)
+            self._templates[name] = template
+        return template
+
+    def reload(self, rules, changed=()):
+        '''Swap in new group rules, and templates for changed options.
+        Everything is built before the single attribute assignment that
+        publishes it, so sends in progress finish with the old rules.
+        '''
+        if 'mail_subject' in changed:
+            self._subject_template = jinja2.Template(OPTIONS['mail_subject'])
+        if 'mail_subject_digest' in changed and self._digest is not None:
+            self._digest_subject_template = jinja2.Template(OPTIONS['mail_subject_digest'])
+        self._group_rules = GroupRules(rules, cache_size=OPTIONS['group_rules_cache_size'])
+
+    def _hold(self, item):
+        if item is None:
+            return
+        alertid, alert, deadline = item
+        # a clear cancels a pending hold, otherwise (re)start the hold time
+        if not (alert.severity in ['normal', 'ok', 'cleared'] and
+                on_hold.cancel(alertid)):
+            on_hold.hold(alertid, alert, deadline)
+
+    def _hold_queue_full(self):
+        return 0 < OPTIONS['max_held_alerts'] <= len(on_hold)
+
+    def _drain_handoff(self):
+        '''Move alerts from the consumer into the hold queue while it has room'''
+        while not self._hold_queue_full():
+            try:
+                item = handoff.get_nowait()
+            except queue.Empty:
+                return
+            self._hold(item)
+
+    def _wait(self, until):
+        '''Sleep until the given time, the next hold deadline or a new alert'''
+        next_deadline = self._deferred.next_deadline()
+        if next_deadline is not None:
+            until = min(until, next_deadline)
+        if shared_hold is not None:
+            # alerts arrive through the shared store, not the hand-off queue
+            timeout = min(until, shared_hold.next_wakeup()) - time.time()
+            if timeout > 0:
+                on_hold.wait(timeout)
+            return
+        deferred_full = self._deferred_room() == 0
+        next_deadline = on_hold.next_deadline()
+        if next_deadline is not None and not deferred_full:
+            until = min(until, next_deadline)
+        timeout = until - time.time()
+        if timeout <= 0:
+            return
+        if self._hold_queue_full():
+            # leave new alerts in the hand-off queue until holds expire
+            (self._deferred if deferred_full else on_hold).wait(timeout)
+            return
+        try:
+            item = handoff.get(timeout=timeout)
+        except queue.Empty:
+            return
+        self._hold(item)
 
-    def _rule_matches(self, regex, value):
-        '''Checks if a rule matches the regex to
-        its provided value considering its type
+    def _deferred_room(self):
+        '''How many more held alerts may be released, None for no limit'''
+        if OPTIONS['max_deferred_emails'] <= 0:
+            return None
+        return max(0, OPTIONS['max_deferred_emails'] - len(self._deferred))
+
+    def _defer(self, msg, contacts, alerts, attempt, until):
+        self._unsettle(alerts)
+        self._deferred.hold(next(self._deferred_ids), (msg, contacts, alerts, attempt), until)
+
+    def _unsettle(self, alerts):
+        '''Count an email for alerts that is being sent or is deferred'''
+        with self._unsettled_lock:
+            self._unsettled.update(alert.get_id() for alert in alerts)
+
+    def _settle(self, alerts):
+        '''Uncount an email for alerts once it was sent, deferred again or
+        given up on. An alert leaves the hold store when none are left, so
+        deferred emails are sent again after a restart.
         '''
-        if isinstance(value, list):
-            LOG.debug('%s is a list, at least one item must match %s',
-                      value, regex)
-            for item in value:
-                if re.match(regex, item) is not None:
-                    LOG.debug('Regex %s matches item %s', regex, item)
-                    return True
-            LOG.debug('Regex %s matches nothing', regex)
+        with self._unsettled_lock:
+            for alert in alerts:
+                alertid = alert.get_id()
+                self._unsettled[alertid] -= 1
+                if self._unsettled[alertid] > 0:
+                    continue
+                del self._unsettled[alertid]
+                # unless the alert came back on hold in the meantime
+                if hold_store is not None and alertid not in on_hold:
+                    hold_store.delete(alertid)
+
+    def _retry_later(self, msg, contacts, alerts, attempt, error):
+        '''Schedule another attempt after a temporary failure, with an
+        exponential backoff. Returns False once the retries are used up.
+        '''
+        if attempt >= OPTIONS['retry_max_attempts']:
+            LOG.error('Giving up on email to %s after %d attempts: %s',
+                      ', '.join(contacts), attempt + 1, error)
             return False
-        elif isinstance(value, six.string_types):  # pylint: disable=undefined-variable
-            LOG.debug('Trying to match %s to %s',
-                      value, regex)
-            return re.search(regex, value) is not None
-        LOG.warning('Field type is not supported')
-        return False
+        delay = min(OPTIONS['retry_max_delay'], OPTIONS['retry_initial_delay'] * 2 ** attempt)
+        # spread out the retries of emails that failed together
+        delay *= random.uniform(0.8, 1.2)
+        LOG.warning('Temporary failure sending email to %s, retry %d in %.0fs: %s',
+                    ', '.join(contacts), attempt + 1, delay, error)
+        METRICS.deferred('retry')
+        self._defer(msg, contacts, alerts, attempt + 1, time.time() + delay)
+        return True
+
+    def _rate_limit_keys(self, contacts):
+        keys = set(('domain', dest.rpartition('@')[2].lower()) for dest in contacts)
+        if not (OPTIONS['skip_mta'] and DNS_RESOLVER_AVAILABLE):
+            keys.add(('smtp', OPTIONS['smtp_host']))
+        return keys
+
+    def _resolve_contacts(self, alert):
+        """Return the list of contacts for an alert, starting from mail_to
+        and applying every group rule in order
+        """
+        start = time.time()
+        contacts = self._group_rules.contacts_for(alert, OPTIONS['mail_to'])
+        METRICS.rule_evaluation(time.time() - start)
+        return contacts
 
-    def send_email(self, alert):
+    def send_email(self, alert, contacts=None):
         """Attempt to send an email for the provided alert, compiling
         the subject and text template and using all the other smtp settings
         that were specified in the configuration file
         """
-        contacts = list(OPTIONS['mail_to'])
-        LOG.debug('Initial contact list: %s', contacts)
-        if 'group_rules' in OPTIONS and len(OPTIONS['group_rules']) > 0:
-            LOG.debug('Checking %d group rules' % len(OPTIONS['group_rules']))
-            for rule in OPTIONS['group_rules']:
-                LOG.info('Evaluating rule %s', rule['name'])
-                is_matching = False
-                for field in rule['fields']:
-                    LOG.debug('Evaluating rule field %s', field)
-                    value = getattr(alert, field['field'], None)
-                    if value is None:
-                        LOG.warning('Alert has no attribute %s',
-                                    field['field'])
-                        break
-                    if self._rule_matches(field['regex'], value):
-                        is_matching = True
-                    else:
-                        is_matching = False
-                        break
-                if is_matching:
-                    # Add up any new contacts
-                    new_contacts = [x.strip() for x in rule['contacts']
-                                    if x.strip() not in contacts]
-                    if len(new_contacts) > 0:
-                        if not rule.get('exclude', False):
-                            LOG.debug('Extending contact to include %s' % (
-                                new_contacts))
-                            contacts.extend(new_contacts)
-                        else:
-                            LOG.info('Clearing initial list of contacts and'
-                                     ' adding for this rule only')
-                            del contacts[:]
-                            contacts.extend(new_contacts)
-        
+        if contacts is None:
+            contacts = self._resolve_contacts(alert)
+
         # Don't loose time (and try to send an email) if there is no contact...
         if not contacts:
             return
@@ -275,24 +1519,80 @@ class MailSender(threading.Thread):
             'alert': alert,
             'mail_to': contacts,
             'dashboard_url': OPTIONS['dashboard_url'],
-            'program': os.path.basename(sys.argv[0]),
-            'hostname': platform.uname()[1],
             'now': datetime.datetime.utcnow()
         }
+        template_vars.update(self._process_vars)
 
+        start = time.time()
         subject = self._subject_template.render(alert=alert)
-        text = self._template_env.get_template(
+        text = self._get_template(
             self._template_name).render(**template_vars)
 
         if (
             OPTIONS['email_type'] == 'html' and
             self._template_name_html
         ):
-            html = self._template_env.get_template(
+            html = self._get_template(
                 self._template_name_html).render(**template_vars)
         else:
             html = None
+        METRICS.template_render(time.time() - start)
+
+        msg = self._build_message(subject, text, html, contacts)
+        if self._deliver(msg, contacts, [alert]):
+            LOG.debug('%s : Email sent to %s' % (alert.get_id(),
+                                                 ','.join(contacts)))
+            return (msg, contacts)
+        return None
 
+    def add_to_digest(self, alert):
+        """Queue a released alert for the digest of its contact list,
+        sending the digest straight away if it is full
+        """
+        contacts = self._resolve_contacts(alert)
+        if not contacts:
+            return
+        batch = self._digest.add(contacts, alert)
+        if batch is not None:
+            self.send_digest(batch[1], batch[0])
+
+    def send_digest(self, alerts, contacts):
+        """Send one email summarising all the alerts for a contact list"""
+        if len(alerts) == 1:
+            return self.send_email(alerts[0], contacts)
+
+        template_vars = {
+            'alerts': alerts,
+            'mail_to': contacts,
+            'dashboard_url': OPTIONS['dashboard_url'],
+            'now': datetime.datetime.utcnow()
+        }
+        template_vars.update(self._process_vars)
+
+        start = time.time()
+        subject = self._digest_subject_template.render(alerts=alerts)
+        text = self._get_template(
+            self._digest_template_name).render(**template_vars)
+
+        if (
+            OPTIONS['email_type'] == 'html' and
+            self._digest_template_name_html
+        ):
+            html = self._get_template(
+                self._digest_template_name_html).render(**template_vars)
+        else:
+            html = None
+        METRICS.template_render(time.time() - start)
+
+        msg = self._build_message(subject, text, html, contacts)
+        if self._deliver(msg, contacts, alerts):
+            LOG.debug('Digest of %d alerts sent to %s', len(alerts),
+                      ','.join(contacts))
+            return (msg, contacts)
+        return None
+
+    @staticmethod
+    def _build_message(subject, text, html, contacts):
         msg = MIMEMultipart('alternative')
         msg['Subject'] = Header(subject, 'utf-8').encode()
         msg['From'] = OPTIONS['mail_from']
@@ -305,80 +1605,111 @@ class MailSender(threading.Thread):
         if html:
             msg_html = MIMEText(html, 'html', 'utf-8')
             msg.attach(msg_html)
+        return msg
 
+    def _deliver(self, msg, contacts, alerts=(), attempt=0):
+        '''Returns True once sent, False on failure or None when the message
+        was deferred by a rate limit or a temporary failure, or queued for
+        MX delivery, which logs its own outcome per domain
+        '''
+        wait = self._rate_limiter.reserve(self._rate_limit_keys(contacts))
+        if wait > 0:
+            METRICS.deferred('rate_limit')
+            self._defer(msg, contacts, alerts, attempt, time.time() + wait)
+            return None
         try:
-            self._send_email_message(msg, contacts)
-            LOG.debug('%s : Email sent to %s' % (alert.get_id(),
-                                                 ','.join(contacts)))
-            return (msg, contacts)
+            if isinstance(self._send_email_message(msg, contacts, alerts, attempt), list):
+                return None
+            METRICS.sent(alerts)
+            return True
         except smtplib.SMTPException as e:
+            if _is_transient(e) and self._retry_later(msg, contacts, alerts, attempt, e):
+                return None
             LOG.error('Failed to send mail to %s on %s:%s : %s',
                       ", ".join(contacts),
                       OPTIONS['smtp_host'], OPTIONS['smtp_port'], e)
-            return None
+            METRICS.send_failure(e)
         except (socket.error, socket.herror, socket.gaierror) as e:
+            if _is_transient(e) and self._retry_later(msg, contacts, alerts, attempt, e):
+                return None
             LOG.error('Mail server connection error: %s', e)
-            return None
+            METRICS.send_failure(e)
         except Exception as e:
             LOG.error('Unexpected error while sending email: {}'.format(str(e)))  # nopep8
-            return None
+            METRICS.send_failure(e)
+        return False
 
-    def _send_email_message(self, msg, contacts):
+    def _send_email_message(self, msg, contacts, alerts=(), attempt=0):
         if OPTIONS['skip_mta'] and DNS_RESOLVER_AVAILABLE:
+            # one transaction per recipient domain, delivered concurrently
+            domains = OrderedDict()
             for dest in contacts:
-                try:
-                    (_, ehost) = dest.split('@')
-                    dns_answers = dns.resolver.query(ehost, 'MX')
-
-                    if len(dns_answers) <= 0:
-                        raise Exception('Failed to find mail exchange for {}'.format(dest))  # nopep8
-
-                    mxhost = reduce(lambda x, y: x if x.preference >= y.preference else y, dns_answers).exchange.to_text()  # nopep8
-                    msg['To'] = dest
-                    if OPTIONS['smtp_use_ssl']:
-                        mx = smtplib.SMTP_SSL(mxhost,
-                                          OPTIONS['smtp_port'],
-                                          local_hostname=OPTIONS['mail_localhost'],
-                                          keyfile=OPTIONS['ssl_key_file'],
-                                          certfile=OPTIONS['ssl_cert_file'])
-                    else:
-                        mx = smtplib.SMTP(mxhost,
-                                          OPTIONS['smtp_port'],
-                                          local_hostname=OPTIONS['mail_localhost'])
-                    if OPTIONS['debug']:
-                        mx.set_debuglevel(True)
-                    mx.sendmail(OPTIONS['mail_from'], dest, msg.as_string())
-                    mx.close()
-                    LOG.debug('Sent notification email to {} (mta={})'.format(dest, mxhost))  # nopep8
-                except Exception as e:
-                    LOG.error('Failed to send email to address {} (mta={}): {}'.format(dest, mxhost, str(e)))  # nopep8
+                (_, at, ehost) = dest.rpartition('@')
+                if not at or not ehost:
+                    LOG.error('Failed to send email to address {}: not a valid address'.format(dest))  # nopep8
+                    continue
+                domains.setdefault(ehost.lower(), []).append(dest)
+            futures = []
+            for domain, recipients in domains.items():
+                self._mx_pending.acquire()
+                self._unsettle(alerts)
+                future = self._mx_executor.submit(
+                    self._send_to_domain, msg, domain, recipients, alerts, attempt)
+                future.add_done_callback(lambda _: self._mx_pending.release())
+                future.add_done_callback(lambda _: self._settle(alerts))
+                futures.append(future)
+            return futures
 
         else:
-            if OPTIONS['smtp_use_ssl']:
-                mx = smtplib.SMTP_SSL(OPTIONS['smtp_host'],
-                                  OPTIONS['smtp_port'],
-                                  local_hostname=OPTIONS['mail_localhost'],
-                                  keyfile=OPTIONS['ssl_key_file'],
-                                  certfile=OPTIONS['ssl_cert_file'])
-            else:
-                mx = smtplib.SMTP(OPTIONS['smtp_host'],
-                                  OPTIONS['smtp_port'],
-                                  local_hostname=OPTIONS['mail_localhost'])
-            if OPTIONS['debug']:
-                mx.set_debuglevel(True)
-
-            mx.ehlo()
-
-            if OPTIONS['smtp_starttls']:
-                mx.starttls()
+            key = (OPTIONS['smtp_host'], OPTIONS['smtp_port'], OPTIONS['smtp_use_ssl'],
+                   OPTIONS['smtp_starttls'], OPTIONS['smtp_username'],
+                   OPTIONS['smtp_password'])
+            self._smtp_pool.sendmail(key,
+                                     OPTIONS['mail_from'],
+                                     contacts,
+                                     msg.as_string())
+
+    def _send_to_domain(self, msg, domain, recipients, alerts=(), attempt=0):
+        dest = ','.join(recipients)
+        try:
+            mxhosts = self._mx_cache.lookup(domain)
+        except Exception as e:
+            LOG.error('Failed to send email to address {} (mta=?): {}'.format(dest, str(e)))  # nopep8
+            METRICS.send_failure(e)
+            return False
 
-            if OPTIONS['smtp_password']:
-                mx.login(OPTIONS['smtp_username'], OPTIONS['smtp_password'])
+        # each destination gets its own copy addressed only to its recipients
+        domain_msg = copy.deepcopy(msg)
+        del domain_msg['To']
+        domain_msg['To'] = ', '.join(recipients)
+        data = domain_msg.as_string()
 
-            mx.sendmail(OPTIONS['mail_from'],
-                        contacts,
-                        msg.as_string())
-            mx.close()
+        error = LookupError('no mail exchange for %s' % domain)
+        for mxhost in mxhosts:
+            key = (mxhost, OPTIONS['smtp_port'], OPTIONS['smtp_use_ssl'],
+                   False, None, None)
+            try:
+                self._smtp_pool.sendmail(key, OPTIONS['mail_from'], recipients, data)
+            except SMTPConnectionPool._REJECTED as e:
+                # the exchange answered, a less preferred one will not do better
+                if _is_transient(e) and self._retry_later(msg, recipients, alerts, attempt, e):
+                    return None
+                LOG.error('Failed to send email to address {} (mta={}): {}'.format(dest, mxhost, str(e)))  # nopep8
+                METRICS.send_failure(e)
+                return False
+            except Exception as e:
+                LOG.warning('Failed to send email to address {} (mta={}), trying next exchange: {}'.format(dest, mxhost, str(e)))  # nopep8
+                error = e
+                continue
+            LOG.debug('Sent notification email to {} (mta={})'.format(dest, mxhost))  # nopep8
+            METRICS.sent(alerts)
+            return True
+
+        if _is_transient(error) and self._retry_later(msg, recipients, alerts, attempt, error):
+            return None
+        LOG.error('Failed to send email to address {}: no mail exchange for {} accepted it'.format(dest, domain))  # nopep8
+        METRICS.send_failure(error)
+        return False
 
 
 def validate_rules(rules):
@@ -412,6 +1743,8 @@ def validate_rules(rules):
                                 rule, key)
                     valid = False
                     break
+            if valid is False:
+                break
             try:
                 re.compile(field['regex'])
             except re.error:
@@ -427,61 +1760,64 @@ def validate_rules(rules):
     return valid_rules
 
 
+def _parse_rules_file(path):
+    '''Return the valid rules in a rules file, or None if it cannot be read'''
+    try:
+        with open(path, 'r') as f:
+            rules = validate_rules(json.load(f))
+    except:
+        LOG.exception('Could not parse file')
+        return None
+    return rules if rules is not None else []
+
+
+def _rules_dir(config_file):
+    return "{}/alerta.rules.d".format(os.path.dirname(config_file))
+
+
 def parse_group_rules(config_file):
-    rules_dir = "{}/alerta.rules.d".format(os.path.dirname(config_file))
+    rules_dir = _rules_dir(config_file)
     LOG.debug('Looking for rules files in %s', rules_dir)
     if os.path.exists(rules_dir):
         rules_d = []
         for files in os.walk(rules_dir):
             for filename in files[2]:
                 LOG.debug('Parsing %s', filename)
-                try:
-                    with open(os.path.join(files[0], filename), 'r') as f:
-                        rules = validate_rules(json.load(f))
-                        if rules is not None:
-                            rules_d.extend(rules)
-                except:
-                    LOG.exception('Could not parse file')
+                rules = _parse_rules_file(os.path.join(files[0], filename))
+                if rules:
+                    rules_d.extend(rules)
         return rules_d
     return ()
 
 
-def on_sigterm(x, y):
-    raise SystemExit
-
+def config_files(config_file):
+    '''Return the fragments in the .d directory of a config file, followed
+    by the config file itself
+    '''
+    config_file = os.path.expanduser(config_file)
+    config_path = "{}.d".format(config_file)
+    config_list = []
+    if os.path.exists(config_path):
+        for files in os.walk(config_path):
+            for filename in sorted(files[2]):
+                config_list.append("{}/{}".format(config_path, filename))
+    config_list.append(config_file)
+    return config_list
 
-def main():
-    global OPTIONS
 
+def load_options(config_list):
+    '''Read the options from a list of config files, later files taking
+    precedence, then apply the environment overrides
+    '''
     CONFIG_SECTION = 'alerta-mailer'
-    config_file = os.environ.get('ALERTA_CONF_FILE') or DEFAULT_OPTIONS['config_file']  # nopep8
 
     # Convert default booleans to its string type, otherwise config.getboolean fails  # nopep8
     defopts = {k: str(v) if type(v) is bool else v for k, v in DEFAULT_OPTIONS.items()}  # nopep8
     config = RawConfigParser(defaults=defopts)
-
-    if os.path.exists("{}.d".format(config_file)):
-        config_path = "{}.d".format(config_file)
-        config_list = []
-        for files in os.walk(config_path):
-            for filename in files[2]:
-                config_list.append("{}/{}".format(config_path, filename))
-
-        config_list.append(os.path.expanduser(config_file))
-        config_file = config_list
-
-    try:
-        # No need to expanduser if we got a list (already done sooner)
-        # Morever expanduser does not accept a list.
-        if isinstance(config_file, list):
-            config.read(config_file)
-        else:
-            config.read(os.path.expanduser(config_file))
-    except Exception as e:
-        LOG.warning("Problem reading configuration file %s - is this an ini file?", config_file)  # nopep8
-        sys.exit(1)
+    config.read(config_list)
 
     if config.has_section(CONFIG_SECTION):
+        options = {}
         NoneType = type(None)
         config_getters = {
             NoneType: config.get,
@@ -493,27 +1829,200 @@ def main():
         }
         for opt in DEFAULT_OPTIONS:
             # Convert the options to the expected type
-            OPTIONS[opt] = config_getters[type(DEFAULT_OPTIONS[opt])](CONFIG_SECTION, opt)  # nopep8
+            options[opt] = config_getters[type(DEFAULT_OPTIONS[opt])](CONFIG_SECTION, opt)  # nopep8
     else:
         sys.stderr.write('Alerta configuration section not found in configuration file\n')  # nopep8
-        OPTIONS = defopts.copy()
+        options = defopts.copy()
 
-    OPTIONS['endpoint'] = os.environ.get('ALERTA_ENDPOINT') or OPTIONS['endpoint']  # nopep8
-    OPTIONS['key'] = os.environ.get('ALERTA_API_KEY') or OPTIONS['key']
-    OPTIONS['smtp_username'] = os.environ.get('SMTP_USERNAME') or OPTIONS['smtp_username'] or OPTIONS['mail_from']
-    OPTIONS['smtp_password'] = os.environ.get('SMTP_PASSWORD') or OPTIONS['smtp_password']  # nopep8
+    options['endpoint'] = os.environ.get('ALERTA_ENDPOINT') or options['endpoint']  # nopep8
+    options['key'] = os.environ.get('ALERTA_API_KEY') or options['key']
+    options['smtp_username'] = os.environ.get('SMTP_USERNAME') or options['smtp_username'] or options['mail_from']
+    options['smtp_password'] = os.environ.get('SMTP_PASSWORD') or options['smtp_password']  # nopep8
 
     if os.environ.get('DEBUG'):
-        OPTIONS['debug'] = True
+        options['debug'] = True
+    return options
 
-    if isinstance(config_file, list):
-        group_rules = []
-        for file in config_file:
-            group_rules.extend(parse_group_rules(file))
-    else:
-        group_rules = parse_group_rules(config_file)
-    if group_rules is not None:
-        OPTIONS['group_rules'] = group_rules
+
+def reload_options(options):
+    '''Copy the reloadable options into OPTIONS and return the names of
+    those that changed; any other change needs a restart
+    '''
+    loaded = LOADED_OPTIONS or OPTIONS
+    changed = []
+    for opt, value in options.items():
+        if opt == 'group_rules' or loaded.get(opt) == value:
+            continue
+        if opt in RELOADABLE_OPTIONS:
+            OPTIONS[opt] = value
+            changed.append(opt)
+        else:
+            LOG.warning('Option %s changed, restart the mailer to apply it', opt)
+    if LOADED_OPTIONS:
+        LOADED_OPTIONS.update(options)
+    return changed
+
+
+class ConfigWatcher(threading.Thread):
+    '''Polls the config files and their rules directories for changes
+
+    Only files whose modification time or size changed are parsed again.
+    The new options and rules are handed to on_reload from this thread so
+    that neither the consumer nor the send path waits on the parsing.
+    '''
+
+    def __init__(self, config_file, interval, on_reload=None):
+        threading.Thread.__init__(self, name='ConfigWatcher')
+        self.daemon = True
+        self.config_file = config_file
+        self.interval = interval
+        self.on_reload = on_reload
+        self._stop_event = threading.Event()
+        self._rules = {}  # rules file -> (stat, rules parsed from it)
+        self._configs, rules_files = self._scan()
+        self.rules = self._load_rules(rules_files)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _scan(self):
+        '''Return the stat of every config file and of every rules file'''
+        configs = OrderedDict()
+        rules_files = OrderedDict()
+        for config in config_files(self.config_file):
+            configs[config] = self._stat(config)
+            for root, _, filenames in os.walk(_rules_dir(config)):
+                for filename in sorted(filenames):
+                    path = os.path.join(root, filename)
+                    rules_files[path] = self._stat(path)
+        return configs, rules_files
+
+    def _load_rules(self, rules_files):
+        rules = []
+        loaded = {}
+        for path, stat in rules_files.items():
+            previous = self._rules.get(path)
+            if previous is not None and previous[0] == stat:
+                file_rules = previous[1]
+            else:
+                LOG.debug('Parsing %s', path)
+                file_rules = _parse_rules_file(path)
+                if file_rules is None:
+                    # likely caught mid-write, keep what the file had before
+                    file_rules = previous[1] if previous is not None else []
+            loaded[path] = (stat, file_rules)
+            rules.extend(file_rules)
+        self._rules = loaded
+        return rules
+
+    def check(self):
+        '''Reload whatever changed, returns True if anything did'''
+        configs, rules_files = self._scan()
+        rules_changed = rules_files != OrderedDict(
+            (path, loaded[0]) for path, loaded in self._rules.items())
+        if configs == self._configs and not rules_changed:
+            return False
+
+        options = None
+        if configs != self._configs:
+            LOG.info('Config files changed, reloading')
+            try:
+                options = load_options(list(configs))
+            except Exception as e:
+                LOG.warning('Could not reload config files, keeping the current options: %s', e)
+            self._configs = configs
+        if rules_changed:
+            LOG.info('Rules files changed, reloading')
+            self.rules = self._load_rules(rules_files)
+
+        if self.on_reload is not None:
+            self.on_reload(options, self.rules)
+        return True
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                LOG.exception('Failed to reload the configuration')
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def on_sigterm(x, y):
+    raise SystemExit
+
+
+def apply_reload(options, rules, mailer, consumer):
+    '''Apply reloaded options (None if unchanged) and rules to a running mailer'''
+    changed = reload_options(options) if options is not None else []
+    if 'severities' in changed:
+        consumer.severities = frozenset(OPTIONS['severities'] or ['critical', 'major'])
+    OPTIONS['group_rules'] = rules
+    mailer.reload(rules, changed)
+    LOG.info('Reloaded %d group rules%s', len(rules),
+             ' and options ' + ', '.join(changed) if changed else '')
+
+
+def recover_held_alerts(store):
+    '''Put alerts held before a restart back on hold with their deadlines'''
+    recovered = 0
+    for alertid, body, deadline in store.load():
+        try:
+            alert = Alert.parse(body)
+        except Exception as e:
+            LOG.warning('Could not recover held alert %s: %s', alertid, e)
+            store.delete(alertid)
+            continue
+        on_hold.hold(alertid, alert, deadline)
+        recovered += 1
+    store.sync()
+    LOG.info('Recovered %d held alerts from %s', recovered, store.path)
+    return recovered
+
+
+def main():
+    global OPTIONS, handoff, hold_store, shared_hold
+
+    config_file = os.environ.get('ALERTA_CONF_FILE') or DEFAULT_OPTIONS['config_file']  # nopep8
+
+    try:
+        OPTIONS = load_options(config_files(config_file))
+        LOADED_OPTIONS.update(OPTIONS)
+    except Exception as e:
+        LOG.warning("Problem reading configuration file %s - is this an ini file?", config_file)  # nopep8
+        sys.exit(1)
+
+    watcher = ConfigWatcher(config_file, OPTIONS['config_reload_interval'])
+    OPTIONS['group_rules'] = watcher.rules
+
+    handoff = queue.Queue(maxsize=OPTIONS['handoff_queue_size'])
+
+    if OPTIONS['metrics_port']:
+        METRICS.enable(port=OPTIONS['metrics_port'])
+
+    if OPTIONS['shared_hold_store']:
+        # replicas take turns on one work queue instead of each binding its own
+        OPTIONS['amqp_queue_exclusive'] = False
+        OPTIONS['amqp_queue_name'] = OPTIONS['amqp_queue_name'] or 'alerta-mailer'
+        member = '{}:{}'.format(platform.uname()[1], os.getpid())
+        shared_hold = SharedHold(shared_hold_backend(OPTIONS['shared_hold_store']), member,
+                                 ttl=OPTIONS['replica_ttl'],
+                                 poll_interval=OPTIONS['shared_poll_interval'])
+        shared_hold.heartbeat()
+        if OPTIONS['hold_store']:
+            LOG.warning('hold_store is not used with shared_hold_store')
+            OPTIONS['hold_store'] = ''
+
+    if OPTIONS['hold_store']:
+        hold_store = HoldStore(os.path.expanduser(OPTIONS['hold_store']))
+        recover_held_alerts(hold_store)
 
     # Registering action for SIGTERM signal handling
     signal.signal(signal.SIGTERM, on_sigterm)
@@ -534,10 +2043,18 @@ def main():
     with Connection(OPTIONS['amqp_url']) as conn:
         try:
             consumer = FanoutConsumer(connection=conn)
-            consumer.run()
+            if OPTIONS['config_reload_interval'] > 0:
+                watcher.on_reload = lambda options, rules: apply_reload(
+                    options, rules, mailer, consumer)
+                watcher.start()
+            # wake up often enough to honour the acknowledgement interval
+            consumer.run(safety_interval=min(1, max(0.05, OPTIONS['amqp_ack_interval'] / 1000.0)))
         except (SystemExit, KeyboardInterrupt):
-            mailer.should_stop = True
+            watcher.stop()
+            mailer.stop()
             mailer.join()
+            if hold_store is not None:
+                hold_store.close()
             sys.exit(0)
         except Exception as e:
             print(str(e))
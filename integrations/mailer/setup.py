@@ -13,7 +13,8 @@ setuptools.setup(
     author='Nick Satterly',
     author_email='nick.satterly@theguardian.com',
     py_modules=['mailer'],
-    data_files=[('.', ['email.tmpl', 'email.html.tmpl'])],
+    data_files=[('.', ['email.tmpl', 'email.html.tmpl',
+                        'digest.tmpl', 'digest.html.tmpl'])],
     setup_requires=['pytest-runner'],
     tests_require=['pytest', 'mock', 'pytest-capturelog'],
     install_requires=[
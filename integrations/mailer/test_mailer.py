@@ -0,0 +1,678 @@
+'''
+Unit test definitions for the mailer hold queue and consumer
+'''
+import os
+import threading
+import time
+from email.header import decode_header, make_header
+
+import mailer
+import pytest
+from alertaclient.models.alert import Alert
+from mock import MagicMock, patch
+
+
+def _alert_body(alertid, severity='major', **kwargs):
+    body = {
+        'id': alertid,
+        'resource': 'server-1234',
+        'event': 'DiskFull',
+        'environment': 'Production',
+        'severity': severity,
+        'previousSeverity': 'normal',
+        'status': 'open',
+        'repeat': False,
+    }
+    body.update(kwargs)
+    return body
+
+
+def test_hold_queue_orders_by_deadline():
+    '''
+    Test that expired holds are returned in deadline order
+    '''
+    held = mailer.HoldQueue()
+    held.hold('b', 'alert-b', 20)
+    held.hold('a', 'alert-a', 10)
+    held.hold('c', 'alert-c', 30)
+
+    assert held.next_deadline() == 10
+    assert held.pop_due(now=5) == []
+    assert held.pop_due(now=25) == [('a', 'alert-a'), ('b', 'alert-b')]
+    assert len(held) == 1
+    assert 'c' in held
+
+
+def test_hold_queue_rehold_and_cancel():
+    '''
+    Test that re-holding replaces the deadline and cancelled
+    alerts are never returned
+    '''
+    held = mailer.HoldQueue()
+    held.hold('a', 'alert-a1', 10)
+    held.hold('a', 'alert-a2', 50)
+    held.hold('b', 'alert-b', 20)
+    assert held.cancel('b') is True
+    assert held.cancel('b') is False
+
+    assert held.next_deadline() == 50
+    assert held.pop_due(now=40) == []
+    assert held.pop_due(now=60) == [('a', 'alert-a2')]
+    assert len(held) == 0
+
+
+def test_hold_queue_compacts_superseded_entries():
+    '''
+    Test that repeatedly re-held alerts do not grow the heap
+    '''
+    held = mailer.HoldQueue()
+    for i in range(10000):
+        held.hold('a', 'alert', i)
+    assert len(held) == 1
+    assert len(held._heap) < 100
+
+
+def test_hold_queue_wait_wakes_on_earlier_deadline():
+    '''
+    Test that a sleeping sender is woken by a hold that expires sooner
+    '''
+    held = mailer.HoldQueue()
+    held.hold('late', 'alert', time.time() + 60)
+    waiter = threading.Thread(target=held.wait)
+    waiter.start()
+    time.sleep(0.05)
+    held.hold('soon', 'alert', time.time() + 0.05)
+    waiter.join(timeout=5)
+    assert not waiter.is_alive()
+
+
+def test_on_message_holds_and_clears():
+    '''
+    Test that the consumer holds alerts and a clear cancels the hold
+    '''
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'on_hold', mailer.HoldQueue()) as held, \
+            patch.object(mailer, 'handoff', mailer.queue.Queue()):
+        mailer.OPTIONS['amqp_ack_batch_size'] = 1
+        consumer = mailer.FanoutConsumer(connection=MagicMock())
+        mail_sender = mailer.MailSender()
+
+        message = MagicMock()
+        consumer.on_message(_alert_body('a1'), message)
+        mail_sender._drain_handoff()
+        assert 'a1' in held
+        assert message.ack.call_count == 1
+
+        consumer.on_message(_alert_body('a1', severity='normal',
+                                        previousSeverity='major'), message)
+        mail_sender._drain_handoff()
+        assert 'a1' not in held
+        assert message.ack.call_count == 2
+
+        consumer.on_message(_alert_body('a2', repeat=True), message)
+        mail_sender._drain_handoff()
+        assert 'a2' not in held
+        assert message.ack.call_count == 3
+
+
+SMTP_KEY = ('smtp.example.com', 587, False, True, 'user', 'secret')
+
+
+def test_smtp_pool_reuses_sessions():
+    '''
+    Test that consecutive sends share one authenticated session
+    '''
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer.smtplib, 'SMTP') as smtp:
+        pool = mailer.SMTPConnectionPool(idle_timeout=60)
+        pool.sendmail(SMTP_KEY, 'from@example.com', ['to@example.com'], 'msg1')
+        pool.sendmail(SMTP_KEY, 'from@example.com', ['to@example.com'], 'msg2')
+
+        assert smtp.call_count == 1
+        session = smtp.return_value
+        assert session.starttls.call_count == 1
+        session.login.assert_called_once_with('user', 'secret')
+        assert session.sendmail.call_count == 2
+
+
+def test_smtp_pool_reconnects_dropped_session():
+    '''
+    Test that a session dropped by the server is replaced transparently
+    '''
+    stale, fresh = MagicMock(), MagicMock()
+    stale.sendmail.side_effect = [{}, mailer.smtplib.SMTPServerDisconnected()]
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer.smtplib, 'SMTP', side_effect=[stale, fresh]):
+        pool = mailer.SMTPConnectionPool(idle_timeout=60)
+        pool.sendmail(SMTP_KEY, 'from@example.com', ['to@example.com'], 'msg1')
+        pool.sendmail(SMTP_KEY, 'from@example.com', ['to@example.com'], 'msg2')
+
+        assert stale.close.called or stale.quit.called
+        fresh.sendmail.assert_called_once_with(
+            'from@example.com', ['to@example.com'], 'msg2')
+
+
+def test_smtp_pool_health_checks_and_reaps_idle_sessions():
+    '''
+    Test that idle sessions are checked with NOOP and closed after
+    the idle timeout
+    '''
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer.smtplib, 'SMTP') as smtp:
+        session = smtp.return_value
+        session.noop.return_value = (250, b'OK')
+        pool = mailer.SMTPConnectionPool(idle_timeout=60)
+        pool.sendmail(SMTP_KEY, 'from@example.com', ['to@example.com'], 'msg1')
+
+        with patch.object(mailer.time, 'time', return_value=time.time() + 30):
+            pool.sendmail(SMTP_KEY, 'from@example.com', ['to@example.com'], 'msg2')
+        assert session.noop.call_count == 1
+        assert smtp.call_count == 1
+
+        pool.reap(now=time.time() + 120)
+        assert session.quit.call_count == 1
+        assert pool._idle == {}
+
+
+def test_digest_buffer_flushes_on_size_and_latency():
+    '''
+    Test that digests are released when full or when they waited too long
+    '''
+    digest = mailer.DigestBuffer(max_alerts=2, max_latency=60)
+    assert digest.add(['a@example.com'], 'alert1', now=0) is None
+    assert digest.add(['b@example.com'], 'alert2', now=10) is None
+    assert digest.add(['a@example.com'], 'alert3', now=20) == \
+        (['a@example.com'], ['alert1', 'alert3'])
+
+    assert digest.next_deadline() == 70
+    assert digest.pop_due(now=65) == []
+    assert digest.pop_due(now=70) == [(['b@example.com'], ['alert2'])]
+    assert len(digest) == 0
+
+
+def test_send_digest_groups_by_contacts():
+    '''
+    Test that released alerts are coalesced into one email per contact list
+    '''
+    rules = [{"name": "db",
+              "fields": [{"field": "resource", "regex": r"db-\w+"}],
+              "contacts": ["dba@example.com"]}]
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS):
+        mailer.OPTIONS['mail_to'] = ['ops@example.com']
+        mailer.OPTIONS['group_rules'] = rules
+        mailer.OPTIONS['digest'] = True
+        mailer.OPTIONS['email_type'] = 'html'
+        mail_sender = mailer.MailSender()
+        with patch.object(mail_sender, '_send_email_message') as _sem:
+            for resource in ['db-1', 'web-1', 'db-2', 'web-2', 'db-3']:
+                mail_sender.add_to_digest(Alert.parse(
+                    _alert_body(resource, resource=resource)))
+            assert _sem.call_count == 0
+
+            for contacts, alerts in mail_sender._digest.pop_due(now=time.time() + 60):
+                mail_sender.send_digest(alerts, contacts)
+            assert _sem.call_count == 2
+
+            sent = {tuple(call[0][1]): call[0][0] for call in _sem.call_args_list}
+            db_msg = sent[('ops@example.com', 'dba@example.com')]
+            subject = str(make_header(decode_header(db_msg['Subject'])))
+            assert subject == '[Digest] 3 alerts: DiskFull'
+            text, html = [part.get_payload(decode=True).decode('utf-8')
+                          for part in db_msg.get_payload()]
+            assert 'db-1' in text and 'db-3' in text and 'web-1' not in text
+            assert 'db-2' in html
+            assert len(sent[('ops@example.com',)].get_payload()) == 2
+
+
+def test_templates_are_compiled_once_until_modified(tmp_path):
+    '''
+    Test that templates are only loaded again after their file changes,
+    and that per-process template variables are computed once
+    '''
+    template = tmp_path / 'email.tmpl'
+    template.write_text(u'v1 {{ alert.resource }} {{ hostname }}')
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer.platform, 'uname',
+                         return_value=('Linux', 'mailhost')) as uname:
+        mailer.OPTIONS['mail_to'] = ['ops@example.com']
+        mailer.OPTIONS['mail_template'] = str(template)
+        mailer.OPTIONS['template_cache_dir'] = str(tmp_path)
+        mail_sender = mailer.MailSender()
+        alert = Alert.parse(_alert_body('a1'))
+        with patch.object(mail_sender, '_send_email_message') as _sem, \
+                patch.object(mail_sender._template_env, 'get_template',
+                             wraps=mail_sender._template_env.get_template) as get:
+            mail_sender.send_email(alert)
+            mail_sender.send_email(alert)
+            assert get.call_count == 1
+
+            template.write_text(u'v2 {{ alert.resource }}')
+            st = template.stat()
+            os.utime(str(template), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+            mail_sender.send_email(alert)
+            assert get.call_count == 2
+
+        bodies = [call[0][0].get_payload()[0].get_payload(decode=True).decode('utf-8')
+                  for call in _sem.call_args_list]
+        assert bodies == ['v1 server-1234 mailhost'] * 2 + ['v2 server-1234']
+        assert uname.call_count == 1
+
+
+def _mx_answers(ttl, *records):
+    answers = [MagicMock(preference=pref, exchange=MagicMock(**{'to_text.return_value': host}))
+               for pref, host in records]
+    result = MagicMock()
+    result.__iter__.side_effect = lambda: iter(answers)
+    result.expiration = None
+    result.rrset.ttl = ttl
+    return result
+
+
+def test_mx_cache_prefers_lowest_preference_and_honours_ttl():
+    '''
+    Test that MX hosts are ordered by preference and cached for the TTL
+    '''
+    with patch.object(mailer, '_resolve_mx') as resolve:
+        resolve.return_value = _mx_answers(300, (20, 'backup.example.com.'),
+                                           (10, 'mx.example.com.'))
+        mx_cache = mailer.MXCache()
+        assert mx_cache.lookup('example.com', now=1000) == \
+            ['mx.example.com.', 'backup.example.com.']
+        mx_cache.lookup('example.com', now=1299)
+        assert resolve.call_count == 1
+        mx_cache.lookup('example.com', now=1300)
+        assert resolve.call_count == 2
+
+
+def test_skip_mta_sends_one_copy_per_domain():
+    '''
+    Test that MX-direct delivery sends one transaction per domain,
+    falls back to the next exchange and leaves the original message alone
+    '''
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'DNS_RESOLVER_AVAILABLE', True):
+        mailer.OPTIONS['skip_mta'] = True
+        mail_sender = mailer.MailSender()
+        mail_sender._mx_cache = MagicMock()
+        mail_sender._mx_cache.lookup.side_effect = lambda domain: \
+            ['mx1.' + domain, 'mx2.' + domain]
+        sent = []
+
+        def sendmail(key, from_addr, to_addrs, data):
+            if key[0] == 'mx1.b.example.com':
+                raise mailer.socket.error('connection refused')
+            sent.append((key[0], to_addrs, data))
+
+        contacts = ['x@a.example.com', 'y@b.example.com', 'z@A.example.com']
+        msg = mail_sender._build_message('subject', 'text', None, contacts)
+        with patch.object(mail_sender._smtp_pool, 'sendmail', side_effect=sendmail):
+            futures = mail_sender._send_email_message(msg, contacts)
+            assert [f.result() for f in futures] == [True, True]
+
+        sent = sorted(sent)
+        assert [(host, rcpts) for host, rcpts, _ in sent] == [
+            ('mx1.a.example.com', ['x@a.example.com', 'z@A.example.com']),
+            ('mx2.b.example.com', ['y@b.example.com']),
+        ]
+        assert 'To: y@b.example.com\n' in sent[1][2]
+        assert msg.get_all('To') == [', '.join(contacts)]
+        mail_sender._mx_executor.shutdown()
+
+
+def test_skip_mta_skips_malformed_addresses():
+    '''
+    Test that a malformed contact does not stop delivery to the others
+    and that queued MX deliveries are not reported as sent
+    '''
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'DNS_RESOLVER_AVAILABLE', True):
+        mailer.OPTIONS['skip_mta'] = True
+        mail_sender = mailer.MailSender()
+        mail_sender._mx_cache = MagicMock()
+        mail_sender._mx_cache.lookup.return_value = ['mx.example.com']
+        alert = Alert.parse(_alert_body('a1'))
+        with patch.object(mail_sender._smtp_pool, 'sendmail') as sendmail:
+            assert mail_sender.send_email(
+                alert, ['ok@example.com', 'broken-address']) is None
+            mail_sender._mx_executor.shutdown(wait=True)
+        assert sendmail.call_count == 1
+        assert sendmail.call_args[0][2] == ['ok@example.com']
+
+
+def test_on_message_prefilters_raw_body():
+    '''
+    Test that repeats, other states and severities are acknowledged
+    and counted without parsing the alert
+    '''
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'handoff', mailer.queue.Queue()) as handoff, \
+            patch.object(mailer.Alert, 'parse', wraps=mailer.Alert.parse) as parse:
+        mailer.OPTIONS['amqp_ack_batch_size'] = 1
+        consumer = mailer.FanoutConsumer(connection=MagicMock())
+        message = MagicMock()
+        for body in [_alert_body('a1', repeat=True),
+                     _alert_body('a2', status='ack'),
+                     _alert_body('a3', severity='minor', previousSeverity='warning'),
+                     _alert_body('a4', severity='minor', previousSeverity='major')]:
+            consumer.on_message(body, message)
+
+        assert consumer.ignored == {'repeat': 1, 'status': 1, 'severity': 1}
+        assert message.ack.call_count == 4
+        assert parse.call_count == 1
+        assert handoff.qsize() == 1 and handoff.get()[0] == 'a4'
+
+
+def test_ack_batcher():
+    '''
+    Test that acknowledgements are batched by count and by time
+    '''
+    messages = [MagicMock() for _ in range(5)]
+    acks = mailer.AckBatcher(batch_size=3, interval=0.2, multiple=True)
+    for message in messages[:3]:
+        acks.add(message, now=0)
+    messages[2].ack.assert_called_once_with(multiple=True)
+    assert not messages[0].ack.called and not messages[1].ack.called
+
+    acks.add(messages[3], now=1)
+    acks.maybe_flush(now=1.1)
+    assert not messages[3].ack.called
+    acks.maybe_flush(now=1.2)
+    messages[3].ack.assert_called_once_with(multiple=True)
+
+    acks = mailer.AckBatcher(batch_size=3, interval=0.2, multiple=False)
+    acks.add(messages[4])
+    acks.flush()
+    messages[4].ack.assert_called_once_with()
+    assert len(acks) == 0
+
+
+def test_full_hold_queue_applies_backpressure():
+    '''
+    Test that alerts stay in the bounded hand-off queue while the hold
+    queue is full and the consumer blocks once that is full too
+    '''
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'on_hold', mailer.HoldQueue()) as held, \
+            patch.object(mailer, 'handoff', mailer.queue.Queue(maxsize=2)) as handoff:
+        mailer.OPTIONS['max_held_alerts'] = 2
+        consumer = mailer.FanoutConsumer(connection=MagicMock())
+        mail_sender = mailer.MailSender()
+        for alertid in ['a1', 'a2', 'a3', 'a4']:
+            consumer.on_message(_alert_body(alertid), MagicMock())
+            mail_sender._drain_handoff()
+        assert len(held) == 2 and handoff.qsize() == 2
+
+        blocked = threading.Thread(target=consumer.on_message,
+                                   args=(_alert_body('a5'), MagicMock()))
+        blocked.start()
+        time.sleep(0.1)
+        assert blocked.is_alive()
+
+        held.pop_due(now=time.time() + mailer.HOLD_TIME + 1)
+        mail_sender._drain_handoff()
+        blocked.join(timeout=5)
+        assert not blocked.is_alive()
+        mail_sender._drain_handoff()
+        assert len(held) == 2 and handoff.qsize() == 1
+
+
+def test_hold_store_survives_restart(tmp_path):
+    '''
+    Test that held alerts and their deadlines are recovered from the
+    hold store and that clears and sent alerts are removed from it
+    '''
+    path = str(tmp_path / 'held.db')
+    store = mailer.HoldStore(path)
+    store.update('a1', _alert_body('a1'), 100.0)
+    store.update('a2', _alert_body('a2'), 200.0)
+    store.update('a3', _alert_body('a3'), 300.0)
+    store.update('a2', _alert_body('a2', severity='normal'), 250.0, cleared=True)
+    store.update('a4', _alert_body('a4', severity='normal'), 400.0, cleared=True)
+    store.delete('a3')
+    store.sync()
+    assert store.commits == 1
+    store.close()
+
+    with patch.object(mailer, 'on_hold', mailer.HoldQueue()) as held:
+        store = mailer.HoldStore(path)
+        assert mailer.recover_held_alerts(store) == 2
+        assert held.next_deadline() == 100.0
+        due = held.pop_due(now=1000)
+        assert [alertid for alertid, _ in due] == ['a1', 'a4']
+        assert due[0][1].resource == 'server-1234'
+        store.close()
+
+
+def test_hold_store_commits_before_acknowledging(tmp_path):
+    '''
+    Test that the consumer writes alerts to the hold store and commits
+    them once per acknowledgement batch
+    '''
+    store = mailer.HoldStore(str(tmp_path / 'held.db'))
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'hold_store', store), \
+            patch.object(mailer, 'handoff', mailer.queue.Queue()):
+        mailer.OPTIONS['amqp_ack_batch_size'] = 3
+        consumer = mailer.FanoutConsumer(connection=MagicMock())
+        message = MagicMock()
+        message.ack.side_effect = lambda: acked.append(
+            len(mailer.HoldStore(store.path).load()))
+        acked = []
+        for alertid in ['a1', 'a2', 'a3']:
+            consumer.on_message(_alert_body(alertid), message)
+        assert acked == [3, 3, 3]
+        assert store.commits == 1
+    store.close()
+
+
+def test_metrics_record_consumer_and_smtp_activity():
+    '''
+    Test that consumed, ignored and acked messages and SMTP timings are
+    exported once metrics are enabled
+    '''
+    prometheus_client = pytest.importorskip('prometheus_client')
+    registry = prometheus_client.CollectorRegistry()
+    metrics = mailer.Metrics()
+    assert metrics.enable(registry=registry)
+
+    def sample(name, **labels):
+        return registry.get_sample_value(name, labels) or 0
+
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'METRICS', metrics), \
+            patch.object(mailer, 'on_hold', mailer.HoldQueue()), \
+            patch.object(mailer, 'handoff', mailer.queue.Queue()), \
+            patch.object(mailer.smtplib, 'SMTP') as smtp:
+        mailer.OPTIONS['amqp_ack_batch_size'] = 1
+        consumer = mailer.FanoutConsumer(connection=MagicMock())
+        consumer.on_message(_alert_body('a1'), MagicMock())
+        consumer.on_message(_alert_body('a2', repeat=True), MagicMock())
+        assert sample('alerta_mailer_held_alerts') == 0
+        mailer.MailSender()._drain_handoff()
+        assert sample('alerta_mailer_held_alerts') == 1
+
+        pool = mailer.SMTPConnectionPool(idle_timeout=60)
+        pool.sendmail(SMTP_KEY, 'from@example.com', ['to@example.com'], 'msg')
+        smtp.return_value.sendmail.side_effect = mailer.smtplib.SMTPDataError(554, 'no')
+        with pytest.raises(mailer.smtplib.SMTPDataError):
+            pool.sendmail(SMTP_KEY, 'from@example.com', ['to@example.com'], 'msg')
+        metrics.send_failure(mailer.smtplib.SMTPDataError(554, 'no'))
+
+    assert sample('alerta_mailer_messages_consumed_total') == 2
+    assert sample('alerta_mailer_messages_acked_total') == 2
+    assert sample('alerta_mailer_messages_ignored_total', reason='repeat') == 1
+    assert sample('alerta_mailer_smtp_connect_seconds_count') == 1
+    assert sample('alerta_mailer_smtp_send_seconds_count') == 1
+    assert sample('alerta_mailer_send_failures_total', exception='SMTPDataError') == 1
+
+
+def test_shared_hold_splits_alerts_between_replicas():
+    '''
+    Test that replicas sharing a hold store each send a disjoint share of
+    the due alerts, and take over the share of a replica that went away
+    '''
+    backend = mailer.MemoryHoldBackend()
+    replicas = [mailer.SharedHold(backend, name, ttl=60) for name in ('mailer-1', 'mailer-2')]
+    for replica in replicas:
+        replica.heartbeat(now=0)
+    # a replica joining means the first one sees it on its next heartbeat
+    replicas[0].heartbeat(now=5)
+    assert replicas[0].ring.members == replicas[1].ring.members == ['mailer-1', 'mailer-2']
+
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'shared_hold', replicas[0]):
+        mailer.OPTIONS['amqp_ack_batch_size'] = 1
+        consumer = mailer.FanoutConsumer(connection=MagicMock())
+        with patch.object(mailer.time, 'time', return_value=0):
+            for i in range(100):
+                consumer.on_message(_alert_body('alert-%d' % i), MagicMock())
+            consumer.on_message(_alert_body('alert-0', severity='normal',
+                                              previousSeverity='major'), MagicMock())
+
+    assert replicas[0].pop_due(now=10) == []
+    first = replicas[0].pop_due(now=31)
+    second = replicas[1].pop_due(now=31)
+    sent = [alertid for alertid, _ in first + second]
+    assert len(sent) == len(set(sent)) == 99
+    assert 'alert-0' not in sent
+    assert 20 < len(first) < 80
+    assert isinstance(first[0][1], Alert)
+
+    # mailer-2 stops renewing its lease, mailer-1 takes over everything
+    for i in range(10):
+        backend.update('late-%d' % i, _alert_body('late-%d' % i), 40)
+    assert len(replicas[0].pop_due(now=45)) < 10
+    assert len(replicas[0].pop_due(now=100)) > 0
+    assert replicas[0].ring.members == ['mailer-1']
+    assert backend.due(now=100, limit=100) == []
+
+
+def test_shared_hold_replicas_drain_a_backlog_together():
+    '''
+    Test that each replica claims a full batch of its own alerts from a
+    backlog larger than a batch, and does not sleep while one remains
+    '''
+    backend = mailer.MemoryHoldBackend()
+    replicas = [mailer.SharedHold(backend, 'mailer-%d' % i, ttl=60) for i in range(4)]
+    for replica in replicas + replicas:
+        replica.heartbeat(now=0)
+    for i in range(5000):
+        backend.update('alert-%d' % i, _alert_body('alert-%d' % i), 1)
+
+    first = [len(replica.pop_due(now=2)) for replica in replicas]
+    assert first == [mailer.SharedHold.BATCH] * 4
+    assert all(replica.next_wakeup(now=2) == 2 for replica in replicas)
+
+    sent = sum(first)
+    for _ in range(3):
+        sent += sum(len(replica.pop_due(now=2)) for replica in replicas)
+    assert sent == 5000
+    assert backend.due(now=2, limit=10) == []
+    assert replicas[0].pop_due(now=2) == []
+    assert replicas[0].next_wakeup(now=2) > 2
+
+    # a caller's limit caps the claim
+    for i in range(100):
+        backend.update('more-%d' % i, _alert_body('more-%d' % i), 1)
+    assert len(replicas[0].pop_due(now=2, limit=5)) == 5
+
+
+def test_rate_limiter_token_buckets():
+    '''
+    Test that each key has its own bucket, and that a send takes a token
+    from all of its buckets or from none
+    '''
+    limiter = mailer.RateLimiter({'smtp': 2, 'domain': 1}, burst=2)
+    relay, domain = ('smtp', 'relay'), ('domain', 'example.com')
+    assert limiter.reserve([relay, domain], now=0) == 0
+    assert limiter.reserve([relay, domain], now=0) == 0
+    assert limiter.reserve([relay, domain], now=0) == pytest.approx(1.0)
+    # the relay still has the tokens the domain could not use
+    assert limiter.reserve([relay], now=0.5) == 0
+    assert limiter.reserve([('domain', 'example.org')], now=0.5) == 0
+    assert limiter.reserve([relay, domain], now=1) == 0
+    assert limiter.reserve([('mx', 'unlimited')] * 10, now=1) == 0
+
+
+def test_deferred_emails_keep_their_alerts_in_the_hold_store(tmp_path):
+    '''
+    Test that an alert whose email is deferred stays in the hold store
+    until the email is sent, so it is recovered after a restart
+    '''
+    store = mailer.HoldStore(str(tmp_path / 'held.db'))
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'hold_store', store), \
+            patch.object(mailer, 'on_hold', mailer.HoldQueue()):
+        mailer.OPTIONS['mail_to'] = ['ops@example.com']
+        mail_sender = mailer.MailSender()
+        mail_sender._rate_limiter = mailer.RateLimiter({'domain': 0.5}, burst=1)
+        alerts = [Alert.parse(_alert_body(alertid)) for alertid in ('a1', 'a2')]
+        for alert in alerts:
+            store.update(alert.get_id(), _alert_body(alert.get_id()), 0)
+
+        with patch.object(mail_sender, '_send_email_message') as _sem:
+            # released from hold as run() does, the second one is rate limited
+            for alert in alerts:
+                mail_sender._unsettle([alert])
+                mail_sender.send_email(alert)
+                mail_sender._settle([alert])
+            store.sync()
+            assert [alertid for alertid, _, _ in store.load()] == ['a2']
+
+            mail_sender._rate_limiter = mailer.RateLimiter({}, burst=1)
+            for _, (msg, contacts, deferred, attempt) in mail_sender._deferred.pop_due(time.time() + 10):
+                assert mail_sender._deliver(msg, contacts, deferred, attempt) is True
+                mail_sender._settle(deferred)
+            store.sync()
+            assert store.load() == []
+            assert _sem.call_count == 2
+    store.close()
+
+
+def test_rate_limited_and_temporarily_failed_emails_are_deferred():
+    '''
+    Test that emails over a rate limit wait in the deferred queue, that
+    4xx replies are retried with backoff and that 5xx replies are not
+    '''
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS):
+        mailer.OPTIONS['mail_to'] = ['ops@example.com']
+        mailer.OPTIONS['domain_rate_limit'] = 1
+        mailer.OPTIONS['rate_limit_burst'] = 1
+        mailer.OPTIONS['retry_max_attempts'] = 2
+        mailer.OPTIONS['max_deferred_emails'] = 2
+        mail_sender = mailer.MailSender()
+        alert = Alert.parse(_alert_body('a1'))
+        greylisted = mailer.smtplib.SMTPDataError(451, 'greylisted, try later')
+
+        with patch.object(mail_sender, '_send_email_message') as _sem, \
+                patch.object(mailer.random, 'uniform', return_value=1):
+            assert mail_sender.send_email(alert) is not None
+            assert mail_sender.send_email(alert) is None
+            assert _sem.call_count == 1 and len(mail_sender._deferred) == 1
+
+            # a 4xx reply is retried with a growing delay until attempts run out
+            mail_sender._rate_limiter = mailer.RateLimiter({}, burst=1)
+            _sem.side_effect = greylisted
+            for attempt, delay in [(0, 30), (1, 60)]:
+                (_, (msg, contacts, alerts, n)), = mail_sender._deferred.pop_due(time.time() + 1000)
+                assert n == attempt
+                now = time.time()
+                assert mail_sender._deliver(msg, contacts, alerts, n) is None
+                assert now + delay <= mail_sender._deferred.next_deadline() <= time.time() + delay
+            (_, (msg, contacts, alerts, n)), = mail_sender._deferred.pop_due(time.time() + 1000)
+            assert mail_sender._deliver(msg, contacts, alerts, n) is False
+            assert _sem.call_count == 4
+
+            # permanent failures are not retried
+            _sem.side_effect = mailer.smtplib.SMTPDataError(554, 'rejected')
+            assert mail_sender._deliver(msg, contacts, alerts) is False
+            assert len(mail_sender._deferred) == 0
+
+            # held alerts are not released while the deferred queue is full
+            for i in range(2):
+                mail_sender._defer(msg, contacts, alerts, 0, now + 60)
+            assert mail_sender._deferred_room() == 0
+            held = mailer.HoldQueue()
+            held.hold('a1', alert, 0)
+            assert held.pop_due(now=1, limit=mail_sender._deferred_room()) == []
+            assert len(held) == 1
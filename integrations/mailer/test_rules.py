@@ -1,6 +1,9 @@
 '''
 Unit test definitions for all rules
 '''
+import json
+import os
+
 import pytest
 import mailer
 from alertaclient.models.alert import Alert
@@ -137,15 +140,12 @@ def test_rule_matches_list():
     Test regex matching is working properly
     for a list
     '''
-    # Mock options to instantiate mailer
-    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS):
-        mail_sender = mailer.MailSender()
-        with patch.object(mailer, 're') as regex:
-            regex.match.side_effect = [MagicMock(), None]
-            assert mail_sender._rule_matches('regex', ['item1']) is True
-            regex.match.assert_called_with('regex', 'item1')
-            assert mail_sender._rule_matches('regex', ['item2']) is False 
-            regex.match.assert_called_with('regex', 'item2')
+    pattern = MagicMock()
+    pattern.match.side_effect = [MagicMock(), None]
+    assert mailer._rule_matches(pattern, ['item1']) is True
+    pattern.match.assert_called_with('item1')
+    assert mailer._rule_matches(pattern, ['item2']) is False
+    pattern.match.assert_called_with('item2')
 
 
 def test_rule_matches_string():
@@ -153,13 +153,185 @@ def test_rule_matches_string():
     Test regex matching is working properly
     for a string
     '''
-    # Mock options to instantiate mailer
+    pattern = MagicMock()
+    pattern.search.side_effect = [MagicMock(), None]
+    assert mailer._rule_matches(pattern, 'value1') is True
+    pattern.search.assert_called_with('value1')
+    assert mailer._rule_matches(pattern, 'value2') is False
+    pattern.search.assert_called_with('value2')
+
+
+GROUP_RULES = [
+    {"name": "db",
+     "fields": [{"field": "resource", "regex": r"db-\w+"}],
+     "contacts": ["dba@example.com", " dev@example.com "]},
+    {"name": "web",
+     "fields": [{"field": "resource", "regex": r"web-\w+"}],
+     "contacts": ["web@example.com"],
+     "exclude": True},
+    {"name": "tagged",
+     "fields": [{"field": "tags", "regex": "pager"},
+                {"field": "resource", "regex": r"db-\w+"}],
+     "contacts": ["pager@example.com"],
+     "exclude": True},
+]
+
+GROUP_RULES_DATA = [
+    ({'resource': 'db-1'}, ['ops@example.com', 'dba@example.com', 'dev@example.com']),
+    ({'resource': 'web-1'}, ['web@example.com']),
+    ({'resource': 'db-1', 'tags': ['a', 'pager-now']}, ['pager@example.com']),
+    ({'resource': 'db-1', 'tags': ['x-pager']}, ['ops@example.com', 'dba@example.com', 'dev@example.com']),
+    ({'resource': 'app-1'}, ['ops@example.com']),
+]
+
+
+@pytest.mark.parametrize('alert_spec, expected_contacts', GROUP_RULES_DATA)
+def test_group_rules_contacts(alert_spec, expected_contacts):
+    '''
+    Test that compiled rules keep the semantics of exclude
+    and list-valued fields
+    '''
+    rules = mailer.GroupRules(mailer.validate_rules(GROUP_RULES))
+    alert = Alert.parse(dict(alert_spec, event='DiskFull'))
+    assert rules.contacts_for(alert, ['ops@example.com']) == expected_contacts
+
+
+def test_group_rules_memo():
+    '''
+    Test that contacts are memoised on the values of the tested fields
+    '''
+    rules = mailer.GroupRules(GROUP_RULES, cache_size=2)
+    with patch.object(rules, '_evaluate', wraps=rules._evaluate) as evaluate:
+        for resource in ['db-1', 'db-1', 'web-1', 'db-1', 'app-1', 'web-1', 'db-1']:
+            alert = Alert.parse({'resource': resource, 'event': resource})
+            contacts = rules.contacts_for(alert, [])
+            contacts.append('not-cached@example.com')
+        # db-1 evicted by web-1 and app-1 before the last lookup
+        assert evaluate.call_count == 5
+    assert len(rules._memo) == 2
+
+
+def test_group_rules_skip_rules_on_missing_fields():
+    '''
+    Test that rules testing a field the alert lacks are skipped
+    without evaluating any of their regexes
+    '''
+    rules = mailer.GroupRules([
+        {"name": "grouped",
+         "fields": [{"field": "resource", "regex": "db"},
+                    {"field": "customer", "regex": "acme"}],
+         "contacts": ["dba@example.com"]},
+        {"name": "db",
+         "fields": [{"field": "resource", "regex": "db"}],
+         "contacts": ["dev@example.com"]},
+    ])
+    assert rules._by_field == {"resource": {0, 1}, "customer": {0}}
+    alert = Alert.parse({'resource': 'db-1', 'event': 'DiskFull'})
+    with patch.object(mailer, '_rule_matches', wraps=mailer._rule_matches) as matches:
+        assert rules.contacts_for(alert, []) == ['dev@example.com']
+        assert matches.call_count == 1
+
+
+def _write_json(path, doc):
+    path.write_text(json.dumps(doc))
+    # make sure the change is seen even on coarse mtime filesystems
+    st = os.stat(str(path))
+    os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_config_watcher_reloads_changed_files(tmp_path):
+    '''
+    Test that only changed rules files are parsed again and that config
+    fragments and rules are handed over on change
+    '''
+    config_file = tmp_path / 'mailer.conf'
+    config_file.write_text('[alerta-mailer]\nmail_from = alerta@example.com\n')
+    fragments = tmp_path / 'mailer.conf.d'
+    fragments.mkdir()
+    rules_dir = tmp_path / 'alerta.rules.d'
+    rules_dir.mkdir()
+    _write_json(rules_dir / 'db.json', GROUP_RULES[:1])
+    _write_json(rules_dir / 'web.json', GROUP_RULES[1:2])
+
+    reloads = []
+    watcher = mailer.ConfigWatcher(str(config_file), 5,
+                                   on_reload=lambda *args: reloads.append(args))
+    assert [r['name'] for r in watcher.rules] == ['db', 'web']
+    assert watcher.check() is False
+
+    with patch.object(mailer, '_parse_rules_file',
+                      wraps=mailer._parse_rules_file) as parse:
+        _write_json(rules_dir / 'web.json', GROUP_RULES[1:])
+        assert watcher.check() is True
+        parse.assert_called_once_with(str(rules_dir / 'web.json'))
+    options, rules = reloads.pop()
+    assert options is None
+    assert [r['name'] for r in rules] == ['db', 'web', 'tagged']
+
+    # a file caught half-written keeps its previous rules
+    (rules_dir / 'db.json').write_text('[{"name": ')
+    assert watcher.check() is True
+    assert [r['name'] for r in reloads.pop()[1]] == ['db', 'web', 'tagged']
+
+    (fragments / 'team.conf').write_text('[alerta-mailer]\nmail_to = team@example.com\n')
+    assert watcher.check() is True
+    options, rules = reloads.pop()
+    assert options['mail_to'] == ['team@example.com']
+
+
+def test_apply_reload_swaps_rules_and_options():
+    '''
+    Test that reloaded options and rules reach the running mailer, and
+    that options needing a restart are left alone
+    '''
     with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS):
-        mail_sender = mailer.MailSender()
-        with patch.object(mailer, 're') as regex:
-            regex.search.side_effect = [MagicMock(), None]
-            assert mail_sender._rule_matches('regex', 'value1') is True
-            regex.search.assert_called_with('regex', 'value1')
-            assert mail_sender._rule_matches('regex', 'value2') is False
-            regex.search.assert_called_with('regex', 'value2')
+        mailer.OPTIONS['mail_to'] = ['ops@example.com']
+        sender = mailer.MailSender()
+        consumer = MagicMock()
+        alert = Alert.parse({'resource': 'db-1', 'event': 'DiskFull'})
+        assert sender._resolve_contacts(alert) == ['ops@example.com']
 
+        options = dict(mailer.OPTIONS, mail_to=['dev@example.com'],
+                       severities=['critical'], smtp_port=25)
+        mailer.apply_reload(options, GROUP_RULES[:1], sender, consumer)
+
+        assert consumer.severities == frozenset(['critical'])
+        assert mailer.OPTIONS['smtp_port'] == mailer.DEFAULT_OPTIONS['smtp_port']
+        assert sender._resolve_contacts(alert) == [
+            'dev@example.com', 'dba@example.com']
+
+
+def test_reload_ignores_options_derived_at_startup():
+    '''
+    Test that options main() rewrites, such as the queue settings of a
+    shared hold, are compared with the config files and not reported as
+    changed on every reload
+    '''
+    options = dict(mailer.DEFAULT_OPTIONS, shared_hold_store='memory://',
+                   amqp_queue_exclusive=True, amqp_queue_name='')
+    with patch.dict(mailer.OPTIONS, options), patch.dict(mailer.LOADED_OPTIONS, options), \
+            patch.object(mailer.LOG, 'warning') as warning:
+        mailer.OPTIONS['amqp_queue_exclusive'] = False
+        mailer.OPTIONS['amqp_queue_name'] = 'alerta-mailer'
+
+        assert mailer.reload_options(dict(options)) == []
+        warning.assert_not_called()
+
+        assert mailer.reload_options(dict(options, smtp_port=2525, mail_to=['ops@example.com'])) == ['mail_to']
+        assert warning.call_count == 1
+        assert mailer.OPTIONS['amqp_queue_name'] == 'alerta-mailer'
+        # reported once, not again on the next reload
+        mailer.reload_options(dict(options, smtp_port=2525, mail_to=['ops@example.com']))
+        assert warning.call_count == 1
+
+
+def test_load_options_reads_fractional_rate_limits(tmp_path):
+    '''
+    Test that rate limits below one email a second, as greylisting
+    domains need, can be configured
+    '''
+    config_file = tmp_path / 'mailer.conf'
+    config_file.write_text('[alerta-mailer]\ndomain_rate_limit = 0.5\nsmtp_rate_limit = 2\n')
+    options = mailer.load_options([str(config_file)])
+    assert options['domain_rate_limit'] == 0.5
+    assert options['smtp_rate_limit'] == 2.0
@@ -14,7 +14,9 @@ setuptools.setup(
     author_email='nick.satterly@theguardian.com',
     py_modules=['urlmon'],
     install_requires=[
-        'alerta'
+        'alerta',
+        'aiohttp',
+        'requests'
     ],
     include_package_data=True,
     zip_safe=False,
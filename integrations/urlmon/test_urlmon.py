@@ -0,0 +1,580 @@
+'''
+Unit test definitions for urlmon
+'''
+import asyncio
+import json
+import os
+import time
+
+import pytest
+import urlmon
+from aiohttp import web
+from mock import MagicMock, patch
+
+
+def _serve(handler, client):
+    '''Run client(url) against a local server answering every path with handler'''
+    async def run():
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            return await client('http://127.0.0.1:%d' % port)
+        finally:
+            await runner.cleanup()
+    return asyncio.run(run())
+
+
+def test_waiting_for_a_busy_host_is_not_timed():
+    '''
+    Test that checks queued behind the per host limit report the time of
+    their own request, not the time they waited for the host
+    '''
+    async def handler(request):
+        await asyncio.sleep(0.2)
+        return web.Response(text='ok')
+
+    async def client(url):
+        async with urlmon.aiohttp.ClientSession(connector=urlmon.TimingConnector(),
+                                                trace_configs=[urlmon.trace_config()]) as session:
+            checker = urlmon.Checker(session, MagicMock(), max_per_host=2)
+            return await asyncio.gather(*[
+                checker.urlmon({'resource': 'r%d' % i, 'url': '%s/%d' % (url, i)}) for i in range(6)])
+
+    results = _serve(handler, client)
+    assert [status for status, _, _, _, _ in results] == [200] * 6
+    assert all(200 <= rtt < 400 for _, _, _, rtt, _ in results)
+
+
+def test_scheduler_spreads_checks_over_their_interval():
+    '''
+    Test that checks start at their own offset within the interval, keep
+    it from one run to the next and skip slots missed while suspended
+    '''
+    checks = [{'resource': 'r%d' % i, 'url': 'http://example.com/%d' % i, 'interval': 60} for i in range(100)]
+    scheduler = urlmon.Scheduler(checks, now=6000)
+    assert len(scheduler) == 100
+
+    first = scheduler.pop_due(now=6060)
+    assert len(first) == 100
+    offsets = sorted(due - 6000 for due, _ in first)
+    # about one check in each tenth of the interval
+    assert all(5 <= sum(1 for o in offsets if 6 * i <= o < 6 * (i + 1)) <= 20 for i in range(10))
+    phases = dict((urlmon.check_key(check), due % 60) for due, check in first)
+
+    assert scheduler.pop_due(now=6060) == []
+    second = scheduler.pop_due(now=6120)
+    assert all(due % 60 == phases[urlmon.check_key(check)] for due, check in second)
+
+    # suspended for ten minutes: each check runs once, then in its next slot
+    late = scheduler.pop_due(now=6720)
+    assert len(late) == 100
+    assert 6720 < scheduler.next_due() <= 6780
+    assert len(scheduler.pop_due(now=6780)) == 100
+
+
+def test_scheduler_skips_removed_and_changed_entries():
+    '''
+    Test that heap entries left behind by a removed or rescheduled check
+    are skipped
+    '''
+    a = {'resource': 'a', 'url': 'http://a/', 'interval': 10}
+    b = {'resource': 'b', 'url': 'http://b/', 'interval': 10}
+    scheduler = urlmon.Scheduler([a, b], now=0)
+    scheduler.remove(urlmon.check_key(a))
+    b2 = dict(b, interval=20)
+    assert scheduler.update([b2], now=0) == ([], [urlmon.check_key(b)], [])
+
+    due = scheduler.pop_due(now=20)
+    assert [check for _, check in due] == [b2]
+    assert len(scheduler) == 1
+    assert scheduler.next_due() > 20
+
+
+def test_checks_of_the_same_resource_and_url_are_all_scheduled():
+    '''
+    Test that unnamed checks sharing a resource and url each get a key of
+    their own, and that exact copies are left out
+    '''
+    search = {'resource': 'r', 'url': 'http://example.com/', 'search': 'ok'}
+    status = {'resource': 'r', 'url': 'http://example.com/', 'status_regex': '2..'}
+    named = {'name': 'other', 'resource': 'r', 'url': 'http://example.com/'}
+    checks = urlmon.unique_checks([search, status, dict(search), named, dict(named, search='x')])
+    assert len(checks) == 3
+    assert len(set(urlmon.check_key(check) for check in checks)) == 3
+    assert urlmon.unique_checks([search, status]) == checks[:2]  # stable keys
+    assert len(urlmon.Scheduler(checks)) == 3
+
+    # without unique_checks() the second is refused, not silently merged
+    assert len(urlmon.Scheduler([search, status])) == 1
+
+
+def test_phase_timings_split_a_traced_request():
+    '''
+    Test that DNS and TLS are taken out of the connect time, and that
+    phases that did not happen count as 0
+    '''
+    trace = {'start': 10.0, 'dns_start': 10.0, 'dns_end': 10.125, 'connect_start': 10.0,
+             'tls_start': 10.25, 'tls_end': 10.5, 'connected': 10.5, 'sent': 10.5,
+             'headers': 11.0, 'end': 11.25}
+    assert urlmon.phase_timings(trace) == {
+        'dns': 125, 'connect': 125, 'tls': 250, 'ttfb': 500, 'transfer': 250}
+
+    # a reused connection has no DNS, connect or TLS phase
+    reused = {'start': 5.0, 'connected': 5.0, 'reused': True, 'headers': 5.5, 'end': 5.75}
+    assert urlmon.phase_timings(reused) == {
+        'dns': 0, 'connect': 0, 'tls': 0, 'ttfb': 500, 'transfer': 250}
+    assert urlmon.phase_timings({}) == dict((phase, 0) for phase in urlmon.PHASES)
+
+
+def test_slow_phase_picks_the_worst_breach():
+    '''
+    Test that a critical breach wins over a warning, whichever phase comes
+    first, and that phases under their thresholds are ignored
+    '''
+    timings = {'dns': 5, 'connect': 30, 'tls': 300, 'ttfb': 2500, 'transfer': 0}
+    assert urlmon.slow_phase({}, timings) is None
+    assert urlmon.slow_phase({'thresholds': {'dns': {'warning': 10}}}, timings) is None
+
+    warning = {'tls': {'warning': 200, 'critical': 1000}}
+    assert urlmon.slow_phase({'thresholds': warning}, timings) == ('warning', 'tls', 300, 200)
+
+    both = dict(warning, ttfb={'warning': 500, 'critical': 2000})
+    assert urlmon.slow_phase({'thresholds': both}, timings) == ('critical', 'ttfb', 2500, 2000)
+
+    # the first of two critical breaches is kept
+    critical = {'tls': {'critical': 100}, 'ttfb': {'critical': 100}}
+    assert urlmon.slow_phase({'thresholds': critical}, timings)[0:2] == ('critical', 'tls')
+
+
+def test_report_names_the_slow_phase():
+    '''
+    Test that a phase over its threshold turns an OK response into
+    HttpResponseSlow, with the breakdown in the text
+    '''
+    api = MagicMock()
+    checker = urlmon.Checker(None, api)
+    check = {'resource': 'r', 'url': 'http://example.com/', 'environment': 'Production',
+             'service': ['Web'], 'thresholds': {'ttfb': {'warning': 500}}}
+    info = {'dnsTime': 1, 'connectTime': 2, 'tlsTime': 3, 'ttfbTime': 700, 'transferTime': 4}
+    checker.report(check, 200, None, 'ok', 710, info)
+    alert = api.send_alert.call_args[1]
+    assert (alert['event'], alert['severity'], alert['value']) == ('HttpResponseSlow', 'warning', 'ttfb 700ms')
+    assert '(dns 1ms, connect 2ms, tls 3ms, ttfb 700ms, transfer 4ms)' in alert['text']
+    assert alert['attributes']['ttfbTime'] == 700
+
+
+class _Body(object):
+    '''Stands in for an aiohttp response, yielding the given chunks'''
+
+    def __init__(self, chunks, charset='utf-8'):
+        self.charset = charset
+        self.chunks = chunks
+        self.read = 0
+        self.content = self
+
+    async def iter_chunked(self, size):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+
+def _search(chunks, search, max_bytes=1024 * 1024):
+    return asyncio.run(urlmon.search_body(_Body(chunks), urlmon.search_pattern(search), max_bytes))
+
+
+def test_search_body_finds_a_match_split_across_chunks():
+    '''
+    Test that a line split over two chunks is searched whole, and that
+    the search stops reading at the first match
+    '''
+    assert _search([b'first line\nstatus: ne', b'edle ok\nlast'], 'needle ok') == (True, 33)
+    assert _search([b'caf\xc3', b'\xa9 open\n'], 'café open') == (True, 11)
+    assert _search([b'no newline at all'], 'newline at all$') == (True, 17)
+
+    body = _Body([b'needle\n', b'more\n', b'and more\n'])
+    assert asyncio.run(urlmon.search_body(body, urlmon.search_pattern('needle'), 1000)) == (True, 7)
+    assert body.read == 1
+
+
+def test_search_body_matches_each_line_on_its_own():
+    '''
+    Test that patterns are matched line by line, as before streaming, so
+    they cannot match across a line break
+    '''
+    assert _search([b'foo\nbar\n'], r'foo\sbar') == (False, 8)
+    assert _search([b'foo\nbar\n'], r'foo[^x]bar') == (False, 8)
+    assert _search([b'foo\nbar\n'], '^bar$') == (True, 8)
+    assert _search([b'a\n', b'b\n'], '^b$') == (True, 4)
+
+
+def test_search_body_stops_at_max_bytes():
+    '''
+    Test that no more than max_bytes are scanned, and that the bytes
+    scanned are reported
+    '''
+    chunks = [b'x' * 99 + b'\n'] * 10 + [b'needle\n']
+    assert _search(chunks, 'needle', max_bytes=250) == (False, 250)
+    assert _search(chunks, 'needle') == (True, 1007)
+    assert _search(chunks, 'needle', max_bytes=1003) == (False, 1003)
+    assert _search([], 'needle') == (False, 0)
+
+
+def test_rule_grammar():
+    '''
+    Test paths in both forms, comparisons, membership, negation,
+    parentheses and negative numbers
+    '''
+    body = {'a': {'b': [3, 4]}, 'x': 'ok', 'n': -2, 'flag': False}
+    holds = [
+        '$.a.b[0] == 3',
+        "body['x'] == 'ok'",
+        "body['a']['b'][1] >= 4",
+        '$.x in ["ok", "fine"]',
+        '$.x not in ["down"]',
+        '4 in $.a.b',
+        'not $.flag',
+        'not not $.a',
+        '$.n == -2 and $.n < -1.5',
+        '($.x == "down" or $.n < 0) and not ($.flag == true)',
+        'true or $.missing == 1',
+    ]
+    for text in holds:
+        assert urlmon.Rule(text).evaluate(body), text
+
+    fails = ['$.a.b[0] != 3', '$.x in []', '$.n > -2', 'not ($.x == "ok")', '$.flag or null']
+    for text in fails:
+        assert not urlmon.Rule(text).evaluate(body), text
+
+
+def test_rule_rejects_anything_else():
+    '''
+    Test that calls, attributes, builtins, chained comparisons and
+    malformed rules raise RuleError when compiled
+    '''
+    for text in ['len($.a)', '$.x.upper()', "__import__('os').system('true')",
+                 '$.n < 1 < 2', '$.x ==', '$.a[$.n]', '($.x == 1', '$.x = 1', '$.x == ok', '']:
+        with pytest.raises(urlmon.RuleError):
+            urlmon.Rule(text)
+
+    check = {'resource': 'r', 'url': 'http://example.com/', 'rule': 'eval("1")'}
+    assert urlmon.valid_checks([check, dict(check, rule='$.x == 1')]) == [dict(check, rule='$.x == 1')]
+
+
+def test_rule_evaluation_errors():
+    '''
+    Test that a missing field raises LookupError and comparing unlike
+    types raises TypeError, for report() to log
+    '''
+    with pytest.raises(LookupError):
+        urlmon.Rule('$.a.c == 1').evaluate({'a': {'b': 1}})
+    with pytest.raises(LookupError):
+        urlmon.Rule('$.a[2] == 1').evaluate({'a': [1]})
+    with pytest.raises(LookupError):
+        urlmon.Rule("$.a['x'] == 1").evaluate({'a': [1]})
+    # fields are looked up in the body, never as attributes
+    with pytest.raises(LookupError):
+        urlmon.Rule('body.__class__ == 1').evaluate({})
+    with pytest.raises(TypeError):
+        urlmon.Rule('$.a < 1').evaluate({'a': 'text'})
+    with pytest.raises(TypeError):
+        urlmon.Rule('$.a.b == 1').evaluate({'a': 5})
+
+    api = MagicMock()
+    check = {'resource': 'r', 'url': 'http://example.com/', 'rule': '$.a < 1',
+             'environment': 'Production', 'service': ['Web']}
+    urlmon.Checker(None, api).report(check, 200, None, '{"a": "text"}', 10, {})
+    assert api.send_alert.call_args[1]['event'] == 'HttpResponseOK'
+
+
+def test_alert_state_buckets_times():
+    '''
+    Test that times in a value are bucketed to the next power of two, and
+    that the rest of the value is kept
+    '''
+    assert urlmon.AlertState.bucket('130ms') == urlmon.AlertState.bucket('250ms') == '<256ms'
+    assert urlmon.AlertState.bucket('256ms') == '<512ms'
+    assert urlmon.AlertState.bucket('ttfb 5230ms') == 'ttfb <8192ms'
+    assert urlmon.AlertState.bucket('Search failed') == 'Search failed'
+    assert urlmon.AlertState.bucket(404) == '404'
+
+
+def test_alert_state_suppresses_repeats_until_refresh():
+    '''
+    Test that an alert is only due again when its event, severity or value
+    bucket changes, or once refresh seconds have passed
+    '''
+    state = urlmon.AlertState(refresh=300)
+    with patch.object(urlmon.time, 'time', return_value=1000):
+        assert state.due('a', 'HttpResponseOK', 'normal', '130ms')
+        state.sent('a', 'HttpResponseOK', 'normal', '130ms')
+        assert not state.due('a', 'HttpResponseOK', 'normal', '200ms')
+        assert state.due('a', 'HttpResponseOK', 'normal', '300ms')
+        assert state.due('a', 'HttpResponseSlow', 'warning', '200ms')
+        assert state.due('a', 'HttpResponseOK', 'minor', '200ms')
+        assert state.due('b', 'HttpResponseOK', 'normal', '130ms')
+    with patch.object(urlmon.time, 'time', return_value=1299):
+        assert not state.due('a', 'HttpResponseOK', 'normal', '130ms')
+    with patch.object(urlmon.time, 'time', return_value=1300):
+        assert state.due('a', 'HttpResponseOK', 'normal', '130ms')
+    assert state.counts() == (1, 2)
+    assert state.counts() == (0, 0)
+
+    state.forget('a')
+    assert state.due('a', 'HttpResponseOK', 'normal', '130ms')
+
+
+def test_alert_state_keeps_certificate_alerts_apart():
+    '''
+    Test that the certificate alert of a check does not reset or suppress
+    its HTTP alert, and the other way round
+    '''
+    state = urlmon.AlertState()
+    state.sent('a', 'HttpResponseOK', 'normal', '130ms')
+    state.sent('a', 'HttpSSLChecker', 'normal', 'left 90 day(s)')
+    assert not state.due('a', 'HttpResponseOK', 'normal', '130ms')
+    assert not state.due('a', 'HttpSSLChecker', 'normal', 'left 90 day(s)')
+    assert state.due('a', 'HttpSSLChecker', 'major', 'left 9 day(s)')
+
+    state.forget('a')
+    assert state.last == {}
+
+
+def test_report_only_records_alerts_that_were_sent():
+    '''
+    Test that report() suppresses a repeated alert, and that an alert
+    Alerta did not accept is sent again on the next check
+    '''
+    api = MagicMock()
+    checker = urlmon.Checker(None, api)
+    expires = (urlmon.datetime.datetime.utcnow() + urlmon.datetime.timedelta(days=90)).strftime(urlmon.SSL_EXPIRES_FMT)
+    check = {'resource': 'r', 'url': 'https://example.com/', 'environment': 'Production',
+             'service': ['Web'], 'check_ssl': True}
+    info = {'sslExpires': expires}
+
+    checker.report(check, 200, None, 'ok', 130, info)
+    assert [c[1]['event'] for c in api.send_alert.call_args_list] == ['HttpResponseOK', 'HttpSSLChecker']
+    checker.report(check, 200, None, 'ok', 200, info)
+    assert api.send_alert.call_count == 2
+    assert checker.alerts.counts() == (2, 2)
+
+    api.send_alert.reset_mock()
+    api.send_alert.side_effect = Exception('Alerta is down')
+    checker.report(check, 500, None, 'error', 130, info)
+    assert api.send_alert.call_count == 1
+    assert checker.alerts.counts() == (0, 1)
+
+    api.send_alert.side_effect = None
+    checker.report(check, 500, None, 'error', 130, info)
+    assert api.send_alert.call_count == 2
+    assert api.send_alert.call_args[1]['severity'] == 'major'
+    assert checker.alerts.counts() == (1, 1)
+
+
+def test_shard_splits_checks_between_instances():
+    '''
+    Test that instances sharing a lease store each own a disjoint share of
+    the checks, and take over the share of an instance that went away
+    '''
+    store = urlmon.MemoryLeaseStore()
+    shards = [urlmon.Shard(store, name, ttl=60) for name in ('urlmon-1', 'urlmon-2', 'urlmon-3')]
+    checks = [{'resource': 'r%d' % i, 'url': 'http://example.com/%d' % i} for i in range(300)]
+    assert not any(shard.owns(checks[0]) for shard in shards)  # no checks before the first heartbeat
+
+    for shard in shards:
+        shard.heartbeat(now=0)
+    # an instance joining is seen by the others on their next heartbeat
+    for shard in shards:
+        shard.heartbeat(now=5)
+    assert all(shard.ring.members == ['urlmon-1', 'urlmon-2', 'urlmon-3'] for shard in shards)
+
+    owned = [[urlmon.check_key(check) for check in checks if shard.owns(check)] for shard in shards]
+    assert sorted(sum(owned, [])) == sorted(urlmon.check_key(check) for check in checks)
+    assert all(50 < len(keys) < 150 for keys in owned)
+
+    # urlmon-3 stops renewing its lease: its checks move, the others' stay
+    for shard in shards[:2]:
+        shard.heartbeat(now=64)
+    assert shards[0].ring.members == ['urlmon-1', 'urlmon-2', 'urlmon-3']
+    for shard in shards[:2]:
+        shard.heartbeat(now=66)
+    assert shards[0].ring.members == shards[1].ring.members == ['urlmon-1', 'urlmon-2']
+    survivors = [[urlmon.check_key(check) for check in checks if shard.owns(check)] for shard in shards[:2]]
+    assert sorted(sum(survivors, [])) == sorted(urlmon.check_key(check) for check in checks)
+    assert set(owned[0]) <= set(survivors[0]) and set(owned[1]) <= set(survivors[1])
+
+    # leaving hands the checks over without waiting for the lease
+    shards[1].leave()
+    shards[0].heartbeat(now=67)
+    assert all(shards[0].owns(check) for check in checks)
+
+
+def test_shard_only_counts_allowed_members():
+    '''
+    Test that instances not in SHARD_MEMBERS are left off the ring, and
+    that an instance left off runs no checks
+    '''
+    store = urlmon.MemoryLeaseStore()
+    allowed = ['urlmon-1', 'urlmon-2']
+    shards = [urlmon.Shard(store, name, ttl=60, allowed=allowed) for name in ('urlmon-1', 'urlmon-2', 'stray')]
+    for shard in shards:
+        shard.heartbeat(now=0)
+    for shard in shards:
+        shard.heartbeat(now=1)
+    assert all(shard.ring.members == allowed for shard in shards)
+
+    checks = [{'resource': 'r%d' % i, 'url': 'http://example.com/%d' % i} for i in range(50)]
+    assert not any(shards[2].owns(check) for check in checks)
+    assert all(shards[0].owns(check) != shards[1].owns(check) for check in checks)
+
+
+def test_file_lease_store(tmp_path):
+    '''
+    Test that leases written by one instance are read by another, that
+    expired leases and other files are ignored, and that leave() removes
+    the lease
+    '''
+    directory = str(tmp_path / 'leases')
+    first = urlmon.FileLeaseStore(directory)
+    second = urlmon.FileLeaseStore(directory)
+    first.heartbeat('urlmon-1', 100.5)
+    second.heartbeat('urlmon-2', 50)
+    (tmp_path / 'leases' / 'urlmon-3.lease').write_text('half writ')
+    (tmp_path / 'leases' / 'notes.txt').write_text('1000')
+
+    assert second.members(now=10) == ['urlmon-1', 'urlmon-2']
+    assert first.members(now=50) == ['urlmon-1']
+    assert first.members(now=100.5) == []
+
+    first.heartbeat('urlmon-1', 200)
+    second.leave('urlmon-2')
+    second.leave('urlmon-2')
+    assert second.members(now=10) == ['urlmon-1']
+    assert sorted(os.listdir(directory)) == ['notes.txt', 'urlmon-1.lease', 'urlmon-3.lease']
+
+    shard = urlmon.Shard(first, 'urlmon-1', ttl=60)
+    shard.heartbeat(now=300)
+    assert first.members(now=359) == ['urlmon-1']
+    shard.leave()
+    assert first.members(now=300) == []
+
+
+def test_scheduler_update_keeps_the_slot_of_unchanged_checks():
+    '''
+    Test that update() leaves unchanged checks where they are in the
+    schedule, and reschedules changed and added ones
+    '''
+    a = {'resource': 'a', 'url': 'http://a/', 'interval': 10}
+    b = {'resource': 'b', 'url': 'http://b/', 'interval': 10}
+    c = {'resource': 'c', 'url': 'http://c/', 'interval': 10}
+    scheduler = urlmon.Scheduler([a, b, c], now=0)
+    assert len(scheduler.pop_due(now=100)) == 3
+
+    # updating with an earlier time shows which checks were put back
+    b2 = dict(b, search='ok')
+    d = {'resource': 'd', 'url': 'http://d/', 'interval': 10}
+    keys = [urlmon.check_key(check) for check in (a, b, c, d)]
+    assert scheduler.update([a, b2, d], now=0) == ([keys[3]], [keys[1]], [keys[2]])
+    assert sorted(urlmon.check_key(check) for check in scheduler.checks()) == [keys[0], keys[1], keys[3]]
+    due = dict((urlmon.check_key(check), deadline) for deadline, check in scheduler.pop_due(now=110))
+    assert 100 < due[keys[0]] <= 110
+    assert due[keys[1]] < 10 and due[keys[3]] < 10
+    assert scheduler.update([a, b2, d], now=0) == ([], [], [])
+
+
+def test_checks_file(tmp_path):
+    '''
+    Test that a checks file is read when it changes, and that anything
+    but a list of checks with a resource and url raises ValueError
+    '''
+    path = tmp_path / 'checks.json'
+    checks_file = urlmon.ChecksFile(str(path))
+    assert checks_file.changed() is False  # missing from the start
+    with pytest.raises(ValueError):
+        checks_file.load()
+
+    path.write_text('[{"resource": "a", "url": "http://a/"}]')
+    assert checks_file.changed() is True
+    assert checks_file.changed() is False
+    assert checks_file.load() == [{'resource': 'a', 'url': 'http://a/'}]
+
+    for text in ['[{"resource": "a", "url"', '{"resource": "a", "url": "http://a/"}',
+                 '[{"resource": "a"}]', '["http://a/"]']:
+        path.write_text(text)
+        assert checks_file.changed() is True
+        with pytest.raises(ValueError):
+            checks_file.load()
+
+    path.unlink()
+    assert checks_file.changed() is True
+    assert checks_file.changed() is False
+
+    if urlmon.YAML_AVAILABLE:
+        yaml_path = tmp_path / 'checks.yaml'
+        yaml_path.write_text('- resource: a\n  url: http://a/\n  interval: 30\n')
+        assert urlmon.ChecksFile(str(yaml_path)).load() == [{'resource': 'a', 'url': 'http://a/', 'interval': 30}]
+        yaml_path.write_text('- resource: [a\n')
+        with pytest.raises(ValueError):
+            urlmon.ChecksFile(str(yaml_path)).load()
+
+
+def test_load_checks_applies_changes_to_the_running_checks(tmp_path):
+    '''
+    Test that reloading the checks keeps the slot and alert state of
+    unchanged checks, cancels and forgets removed ones, and keeps the
+    running checks when the file cannot be read
+    '''
+    fixed = {'name': 'fixed', 'resource': 'fixed', 'url': 'http://fixed/', 'interval': 10}
+    a = {'name': 'a', 'resource': 'a', 'url': 'http://a/', 'interval': 10}
+    b = {'name': 'b', 'resource': 'b', 'url': 'http://b/', 'interval': 10}
+    path = tmp_path / 'checks.json'
+    path.write_text(json.dumps([a, b]))
+    checks_file = urlmon.ChecksFile(str(path))
+    scheduler = urlmon.Scheduler()
+    checker = urlmon.Checker(None, MagicMock())
+    tasks = {}
+    daemon = urlmon.UrlmonDaemon()
+
+    def load():
+        with patch.object(urlmon, 'settings', MagicMock(checks=[fixed])):
+            asyncio.run(daemon.load_checks(scheduler, checker, tasks, checks_file))
+
+    def keys():
+        return sorted(urlmon.check_key(check) for check in scheduler.checks())
+
+    load()
+    assert keys() == ['a', 'b', 'fixed']
+    assert checks_file.changed() is False
+    # run every check well ahead, so checks put back in the schedule show
+    now = time.time()
+    assert len(scheduler.pop_due(now=now + 100)) == 3
+    for key in keys():
+        checker.alerts.sent(key, 'HttpResponseOK', 'normal', '100ms')
+    tasks['b'] = task = MagicMock()
+
+    # b removed, a changed, c added and an invalid check left out
+    a2 = dict(a, interval=20)
+    c = {'name': 'c', 'resource': 'c', 'url': 'http://c/'}
+    invalid = {'name': 'invalid', 'resource': 'invalid', 'url': 'http://invalid/', 'rule': 'len($.a)'}
+    path.write_text(json.dumps([a2, c, invalid]))
+    load()
+    assert keys() == ['a', 'c', 'fixed']
+    assert [check for check in scheduler.checks() if check['name'] == 'a'] == [a2]
+    task.cancel.assert_called_once_with()
+    assert 'b' not in tasks
+    assert not checker.alerts.due('fixed', 'HttpResponseOK', 'normal', '100ms')
+    assert checker.alerts.due('b', 'HttpResponseOK', 'normal', '100ms')
+    assert sorted(check['name'] for _, check in scheduler.pop_due(now=now + 70)) == ['a', 'c']
+
+    # a half written, malformed or missing file keeps the checks already running
+    for text in ['[{"name": "a", "resource": "a", "ur', '{}', None]:
+        if text is None:
+            path.unlink()
+        else:
+            path.write_text(text)
+        load()
+        assert keys() == ['a', 'c', 'fixed']
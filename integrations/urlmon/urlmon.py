@@ -1,21 +1,39 @@
+import ast
+import asyncio
+import bisect
+import codecs
+import contextvars
 import datetime
+import functools
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+import os
 import platform
-import queue
 import re
-import socket
 import ssl
-import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler as BHRH
-from urllib.error import URLError  # pylint: disable=no-name-in-module
 from urllib.parse import urlparse  # pylint: disable=no-name-in-module
-from urllib.request import build_opener, ProxyHandler, HTTPBasicAuthHandler, install_opener, Request, urlopen  # pylint: disable=no-name-in-module
 
 import sys
+import threading
 import time
+import aiohttp
+import requests
 from alertaclient.api import Client
 
+YAML_AVAILABLE = False
+
+try:
+    import yaml
+    YAML_AVAILABLE = True
+except ImportError:
+    pass
+
 HTTP_RESPONSES = dict([(k, v[0]) for k, v in list(BHRH.responses.items())])
 
 # Add missing responses
@@ -44,12 +62,27 @@ __version__ = '3.3.0'
 
 LOOP_EVERY = 60  # seconds
 #TARGET_FILE = 'urlmon.targets'  # FIXME -- or settings.py ???
-SERVER_THREADS = 20
+MAX_CONCURRENCY = 1000  # checks in progress at once, override in settings.py
+MAX_CONCURRENCY_PER_HOST = 10  # connections to any one host:port, override in settings.py
+REPORT_THREADS = 20  # threads sending alerts to the Alerta API
+MEASURE_COLD = False  # also time every check on a new connection, override in settings.py or per check
+KEEPALIVE_TIMEOUT = LOOP_EVERY + 15  # seconds an idle pooled connection is kept, override in settings.py
+MAX_SEARCH_BYTES = 1024 * 1024  # body bytes scanned for a search pattern, override in settings.py or per check
+SEARCH_CHUNK_SIZE = 64 * 1024  # bytes
+SEARCH_OVERLAP = 64 * 1024  # longest partial line carried between chunks, in characters
+ALERT_REFRESH_INTERVAL = 60 * 60  # seconds before an unchanged alert is sent again, override in settings.py
+CHECKS_FILE = None  # JSON or YAML list of checks, in addition to settings.checks, override in settings.py
+CHECKS_RELOAD_INTERVAL = 5  # seconds between looking for changes to CHECKS_FILE
+SHARD_LEASE_DIR = None  # directory shared by all instances, splits the checks between them, override in settings.py
+SHARD_MEMBERS = None  # names of the instances allowed to take checks, default any with a lease
+SHARD_NAME = platform.uname()[1]  # this instance, must be unique within SHARD_LEASE_DIR
+SHARD_LEASE_TTL = 30  # seconds
 SLOW_WARNING_THRESHOLD = 5000  # ms
 SLOW_CRITICAL_THRESHOLD = 10000  # ms
 MAX_TIMEOUT = 15000  # ms
 SSL_DAYS = 30
 SSL_DAYS_PANIC = 7
+SSL_CACHE_TTL = 6 * 60 * 60  # seconds a certificate's expiry is trusted without parsing it again
 
 import settings
 
@@ -57,166 +90,337 @@ LOG = logging.getLogger("alerta.urlmon")
 logging.basicConfig(format="%(asctime)s - %(name)s: %(levelname)s - %(message)s", level=logging.DEBUG)
 
 
-class WorkerThread(threading.Thread):
+def check_key(check):
+    '''Identifies a check across cycles'''
+    return check.get('name') or '%s %s' % (check['resource'], check['url'])
 
-    def __init__(self, queue, api):
 
-        threading.Thread.__init__(self)
-        LOG.debug('Initialising %s...', self.getName())
+def unique_checks(checks):
+    '''Give unnamed checks of the same resource and url a name of their
+    own, from a hash of their settings, so that each one is scheduled.
+    Checks that are exact copies, or share a name, are logged and left out.
+    '''
+    keys = Counter(check_key(check) for check in checks)
+    unique = []
+    seen = set()
+    for check in checks:
+        key = check_key(check)
+        if keys[key] > 1 and not check.get('name'):
+            digest = hashlib.md5(json.dumps(check, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            check = dict(check, name='%s #%s' % (key, digest[:8]))
+            key = check_key(check)
+        if key in seen:
+            LOG.error('Not scheduling a second check named %s, check names must be unique', key)
+            continue
+        seen.add(key)
+        unique.append(check)
+    return unique
 
-        self.queue = queue   # internal queue
-        self.api = api       # send alerts api
 
-    def run(self):
+class Scheduler(object):
+    '''Runs each check every interval seconds at a fixed phase.
 
-        while True:
-            LOG.debug('Waiting on input queue...')
-            try:
-                check, queue_time = self.queue.get()
-            except TypeError:
-                LOG.info('%s is shutting down.', self.getName())
-                break
+    The phase is derived from a hash of the check key, so checks are
+    spread across their interval and each keeps its slot from one start
+    to the next. Due checks come out of a heap in deadline order.
+    '''
 
-            if time.time() - queue_time > LOOP_EVERY:
-                LOG.warning('URL request for %s to %s expired after %d seconds.', check['resource'], check['url'],
-                            int(time.time() - queue_time))
-                self.queue.task_done()
-                continue
+    def __init__(self, checks=(), now=None):
 
-            resource = check['resource']
-            LOG.info('%s polling %s...', self.getName(), resource)
-            status, reason, body, rtt = self.urlmon(check)
-
-            status_regex = check.get('status_regex', None)
-            search_string = check.get('search', None)
-            rule = check.get('rule', None)
-            warn_thold = check.get('warning', SLOW_WARNING_THRESHOLD)
-            crit_thold = check.get('critical', SLOW_CRITICAL_THRESHOLD)
-            checker_api = check.get('api_endpoint', None)
-            checker_apikey = check.get('api_key', None)
-            check_ssl = check.get('check_ssl')
-            if (checker_api and checker_apikey):
-                local_api = Client(endpoint=checker_api, key=checker_apikey)
-            else:
-                local_api = self.api
+        self._heap = []  # (due, seq, check), entries no longer in _entries are skipped
+        self._entries = {}  # check key -> (seq, check) of its scheduled run
+        self._seq = itertools.count()
+        self.update(checks, now)
 
-            try:
-                description = HTTP_RESPONSES[status]
-            except KeyError:
-                description = 'undefined'
+    def __len__(self):
+        return len(self._entries)
 
-            if not status:
-                event = 'HttpConnectionError'
-                severity = 'major'
-                value = reason
-                text = 'Error during connection or data transfer (timeout=%d).' % MAX_TIMEOUT
-
-            elif status_regex:
-                if re.search(status_regex, str(status)):
-                    event = 'HttpResponseRegexOK'
-                    severity = 'normal'
-                    value = '%s (%d)' % (description, status)
-                    text = 'HTTP server responded with status code %d that matched "%s" in %dms' % (status, status_regex, rtt)
-                else:
-                    event = 'HttpResponseRegexError'
-                    severity = 'major'
-                    value = '%s (%d)' % (description, status)
-                    text = 'HTTP server responded with status code %d that failed to match "%s"' % (status, status_regex)
+    def checks(self):
+        return [check for _, check in self._entries.values()]
 
-            elif 100 <= status <= 199:
-                event = 'HttpInformational'
-                severity = 'normal'
-                value = '%s (%d)' % (description, status)
-                text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
+    @staticmethod
+    def interval(check):
+        return max(1, check.get('interval', LOOP_EVERY))
 
-            elif 200 <= status <= 299:
-                event = 'HttpResponseOK'
+    @staticmethod
+    def phase(check):
+        '''Offset of a check within its interval, as a fraction'''
+        digest = hashlib.md5(check_key(check).encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) / float(0x100000000)
+
+    def add(self, check, now=None):
+        '''Schedule a check at the next start of its slot'''
+        now = now if now is not None else time.time()
+        interval = self.interval(check)
+        offset = self.phase(check) * interval
+        due = (now - offset) // interval * interval + offset
+        if due < now:
+            due += interval
+        self._push(due, check)
+
+    def _push(self, due, check):
+        seq = next(self._seq)
+        self._entries[check_key(check)] = (seq, check)
+        heapq.heappush(self._heap, (due, seq, check))
+
+    def remove(self, key):
+        self._entries.pop(key, None)
+
+    def update(self, checks, now=None):
+        '''Replace the checks, returning the keys (added, changed, removed).
+        Unchanged checks keep their place in the schedule.
+        '''
+        now = now if now is not None else time.time()
+        new = OrderedDict()
+        for check in checks:
+            if check_key(check) in new:
+                LOG.error('Not scheduling a second check named %s, check names must be unique', check_key(check))
+                continue
+            new[check_key(check)] = check
+        current = dict((key, check) for key, (_, check) in self._entries.items())
+        added = [key for key in new if key not in current]
+        changed = [key for key in new if key in current and new[key] != current[key]]
+        removed = [key for key in current if key not in new]
+        for key in removed:
+            self.remove(key)
+        for key in added + changed:
+            self.add(new[key], now)
+        return added, changed, removed
+
+    def next_due(self):
+        while self._heap and not self._current(*self._heap[0][1:]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def _current(self, seq, check):
+        entry = self._entries.get(check_key(check))
+        return entry is not None and entry[0] == seq
+
+    def pop_due(self, now=None):
+        '''Return (due, check) for every check that is due, in deadline
+        order, and schedule the next run of each one
+        '''
+        now = now if now is not None else time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, seq, check = heapq.heappop(self._heap)
+            if not self._current(seq, check):
+                continue  # removed or changed since it was scheduled
+            due.append((deadline, check))
+            interval = self.interval(check)
+            # slots missed while the process was busy or suspended are skipped
+            following = deadline + interval
+            if following <= now:
+                following += (now - following) // interval * interval + interval
+            self._push(following, check)
+        return due
+
+
+class Checker(object):
+    '''Runs checks as coroutines on one shared aiohttp session'''
+
+    def __init__(self, session, api, max_concurrency=MAX_CONCURRENCY, cold_session=None, clients=None,
+                 max_per_host=MAX_CONCURRENCY_PER_HOST):
+
+        self.session = session  # pooled keep-alive HTTP connections
+        self.cold_session = cold_session  # a new connection for every request
+        self.api = api          # send alerts api
+        self.clients = clients or AlertaClients()  # api of checks with their own api_endpoint
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0        # checks waiting for a free slot
+        self.max_per_host = max_per_host
+        self.host_slots = {}    # (scheme, host, port) -> semaphore, taken before a request is timed
+        self.in_flight = set()  # keys of the checks queued or running
+        self.alerts = AlertState(getattr(settings, 'ALERT_REFRESH_INTERVAL', ALERT_REFRESH_INTERVAL))
+        self.certificates = CertificateCache(getattr(settings, 'SSL_CACHE_TTL', SSL_CACHE_TTL))
+
+    def host_slot(self, url):
+        url = urlparse(url)
+        key = (url.scheme, url.hostname, url.port)
+        slot = self.host_slots.get(key)
+        if slot is None:
+            slot = self.host_slots[key] = asyncio.Semaphore(self.max_per_host)
+        return slot
+
+    def busy(self, check):
+        return check_key(check) in self.in_flight
+
+    async def run(self, check, queue_time):
+
+        key = check_key(check)
+        self.in_flight.add(key)
+        try:
+            await self.check(check, queue_time)
+        finally:
+            self.in_flight.discard(key)
+
+    async def check(self, check, queue_time):
+
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            if time.time() - queue_time > check.get('interval', LOOP_EVERY):
+                LOG.warning('URL request for %s to %s expired after %d seconds.', check['resource'], check['url'],
+                            int(time.time() - queue_time))
+                return
+
+            LOG.info('Polling %s...', check['resource'])
+            status, reason, body, rtt, info = await self.urlmon(check)
+
+            loop = asyncio.get_event_loop()
+            # alertaclient and the certificate check block, keep them off the event loop
+            await loop.run_in_executor(None, self.report, check, status, reason, body, rtt, info)
+            LOG.info('%s check complete.', check['resource'])
+        except Exception as e:
+            LOG.error('Check for %s failed: %s', check['resource'], e, exc_info=1)
+        finally:
+            self.slots.release()
+
+    def report(self, check, status, reason, body, rtt, info=None):
+
+        resource = check['resource']
+        status_regex = check.get('status_regex', None)
+        search_string = check.get('search', None)
+        rule = check.get('rule', None)
+        warn_thold = check.get('warning', SLOW_WARNING_THRESHOLD)
+        crit_thold = check.get('critical', SLOW_CRITICAL_THRESHOLD)
+        checker_api = check.get('api_endpoint', None)
+        checker_apikey = check.get('api_key', None)
+        check_ssl = check.get('check_ssl')
+        if (checker_api and checker_apikey):
+            local_api = self.clients.get(checker_api, checker_apikey)
+        else:
+            local_api = self.api
+
+        try:
+            description = HTTP_RESPONSES[status]
+        except KeyError:
+            description = 'undefined'
+
+        if not status:
+            event = 'HttpConnectionError'
+            severity = 'major'
+            value = reason
+            text = 'Error during connection or data transfer (timeout=%d).' % MAX_TIMEOUT
+
+        elif status_regex:
+            if re.search(status_regex, str(status)):
+                event = 'HttpResponseRegexOK'
                 severity = 'normal'
                 value = '%s (%d)' % (description, status)
-                text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
-
-            elif 300 <= status <= 399:
-                event = 'HttpRedirection'
-                severity = 'minor'
-                value = '%s (%d)' % (description, status)
-                text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
-
-            elif 400 <= status <= 499:
-                event = 'HttpClientError'
-                severity = 'minor'
-                value = '%s (%d)' % (description, status)
-                text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
-
-            elif 500 <= status <= 599:
-                event = 'HttpServerError'
+                text = 'HTTP server responded with status code %d that matched "%s" in %dms' % (status, status_regex, rtt)
+            else:
+                event = 'HttpResponseRegexError'
                 severity = 'major'
                 value = '%s (%d)' % (description, status)
-                text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
-
-            else:
-                event = 'HttpUnknownError'
+                text = 'HTTP server responded with status code %d that failed to match "%s"' % (status, status_regex)
+
+        elif 100 <= status <= 199:
+            event = 'HttpInformational'
+            severity = 'normal'
+            value = '%s (%d)' % (description, status)
+            text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
+
+        elif 200 <= status <= 299:
+            event = 'HttpResponseOK'
+            severity = 'normal'
+            value = '%s (%d)' % (description, status)
+            text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
+
+        elif 300 <= status <= 399:
+            event = 'HttpRedirection'
+            severity = 'minor'
+            value = '%s (%d)' % (description, status)
+            text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
+
+        elif 400 <= status <= 499:
+            event = 'HttpClientError'
+            severity = 'minor'
+            value = '%s (%d)' % (description, status)
+            text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
+
+        elif 500 <= status <= 599:
+            event = 'HttpServerError'
+            severity = 'major'
+            value = '%s (%d)' % (description, status)
+            text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
+
+        else:
+            event = 'HttpUnknownError'
+            severity = 'warning'
+            value = 'UNKNOWN'
+            text = 'HTTP request resulted in an unhandled error.'
+
+        timings = dict((phase, (info or {}).get(phase + 'Time', 0)) for phase in PHASES)
+        breakdown = ', '.join('%s %dms' % (phase, timings[phase]) for phase in PHASES)
+
+        if event in ['HttpResponseOK', 'HttpResponseRegexOK']:
+            if rtt > crit_thold:
+                event = 'HttpResponseSlow'
+                severity = 'critical'
+                value = '%dms' % rtt
+                text = 'Website available but exceeding critical RT thresholds of %dms (%s)' % (crit_thold, breakdown)
+            elif rtt > warn_thold:
+                event = 'HttpResponseSlow'
                 severity = 'warning'
-                value = 'UNKNOWN'
-                text = 'HTTP request resulted in an unhandled error.'
-
-            if event in ['HttpResponseOK', 'HttpResponseRegexOK']:
-                if rtt > crit_thold:
-                    event = 'HttpResponseSlow'
-                    severity = 'critical'
-                    value = '%dms' % rtt
-                    text = 'Website available but exceeding critical RT thresholds of %dms' % crit_thold
-                elif rtt > warn_thold:
-                    event = 'HttpResponseSlow'
-                    severity = 'warning'
-                    value = '%dms' % rtt
-                    text = 'Website available but exceeding warning RT thresholds of %dms' % warn_thold
-                if search_string and body:
-                    LOG.debug('Searching for %s', search_string)
-                    found = False
-                    for line in body.split('\n'):
-                        m = re.search(search_string, line)
-                        if m:
-                            found = True
-                            LOG.debug("Regex: Found %s in %s", search_string, line)
-                            break
-                    if not found:
+                value = '%dms' % rtt
+                text = 'Website available but exceeding warning RT thresholds of %dms (%s)' % (warn_thold, breakdown)
+            breach = slow_phase(check, timings)
+            # a phase only overrides an overall RT breach if it is worse
+            if breach and (event != 'HttpResponseSlow' or (breach[0] == 'critical' and severity == 'warning')):
+                severity, phase, elapsed, phase_thold = breach
+                event = 'HttpResponseSlow'
+                value = '%s %dms' % (phase, elapsed)
+                text = 'Website available but %s time exceeding %s threshold of %dms (%s)' % (
+                    phase, severity, phase_thold, breakdown)
+            if search_string and info and info.get('bytesScanned'):
+                LOG.debug('Regex: %s %s in %d bytes', 'Found' if info['searchMatched'] else 'Did not find',
+                          search_string, info['bytesScanned'])
+                if not info['searchMatched']:
+                    event = 'HttpContentError'
+                    severity = 'minor'
+                    value = 'Search failed'
+                    text = 'Website available but pattern "%s" not found' % search_string
+                    if info['bytesScanned'] >= check.get('max_bytes', getattr(settings, 'MAX_SEARCH_BYTES', MAX_SEARCH_BYTES)):
+                        text += ' in the first %d bytes' % info['bytesScanned']
+            elif rule and body:
+                LOG.debug('Evaluating rule %s', rule)
+                try:
+                    body = json.loads(body)
+                except ValueError:
+                    pass  # rules can also test the body as a string
+                try:
+                    passed = compile_rule(rule).evaluate(body)
+                except (RuleError, LookupError, TypeError) as e:
+                    LOG.error('Could not evaluate rule %s: %s', rule, e)
+                else:
+                    if not passed:
                         event = 'HttpContentError'
                         severity = 'minor'
-                        value = 'Search failed'
-                        text = 'Website available but pattern "%s" not found' % search_string
-                elif rule and body:
-                    LOG.debug('Evaluating rule %s', rule)
-                    headers = check.get('headers', {})
-                    if 'Content-type' in headers and headers['Content-type'] == 'application/json':
-                        try:
-                            body = json.loads(body)
-                        except ValueError as e:
-                            LOG.error('Could not evaluate rule %s: %s', rule, e)
-                    try:
-                        eval(rule)  # NOTE: assumes request body in variable called 'body'
-                    except (SyntaxError, NameError, ZeroDivisionError) as e:
-                        LOG.error('Could not evaluate rule %s: %s', rule, e)
-                    except Exception as e:
-                        LOG.error('Could not evaluate rule %s: %s', rule, e)
-                    else:
-                        if not eval(rule):
-                            event = 'HttpContentError'
-                            severity = 'minor'
-                            value = 'Rule failed'
-                            text = 'Website available but rule evaluation failed (%s)' % rule
-
-            LOG.debug("URL: %s, Status: %s (%s), Round-Trip Time: %dms -> %s",
-                      check['url'], description, status, rtt, event)
-
-            resource = check['resource']
-            correlate = _HTTP_ALERTS
-            group = 'Web'
-            environment = check['environment']
-            service = check['service']
-            text = text
-            tags = check.get('tags', list())
-            threshold_info = "%s : RT > %d RT > %d x %s" % (check['url'], warn_thold, crit_thold, check.get('count', 1))
-
+                        value = 'Rule failed'
+                        text = 'Website available but rule evaluation failed (%s)' % rule
+
+        LOG.debug("URL: %s, Status: %s (%s), Round-Trip Time: %dms -> %s",
+                  check['url'], description, status, rtt, event)
+
+        resource = check['resource']
+        correlate = _HTTP_ALERTS
+        group = 'Web'
+        environment = check['environment']
+        service = check['service']
+        text = text
+        tags = check.get('tags', list())
+        threshold_info = "%s : RT > %d RT > %d x %s" % (check['url'], warn_thold, crit_thold, check.get('count', 1))
+        attributes = {
+            'thresholdInfo': threshold_info
+        }
+        attributes.update(info or {})
+
+        key = check_key(check)
+        if self.alerts.due(key, event, severity, value):
             try:
                 local_api.send_alert(
                     resource=resource,
@@ -230,45 +434,36 @@ class WorkerThread(threading.Thread):
                     text=text,
                     event_type='serviceAlert',
                     tags=tags,
-                    attributes={
-                        'thresholdInfo': threshold_info
-                    }
+                    attributes=attributes
                 )
             except Exception as e:
                 LOG.warning('Failed to send alert: %s', e)
+            else:
+                self.alerts.sent(key, event, severity, value)
+
+        if check_ssl and info and info.get('sslExpires'):
+            days_left = datetime.datetime.strptime(info['sslExpires'], SSL_EXPIRES_FMT) - datetime.datetime.utcnow()
+            if days_left < datetime.timedelta(days=0):
+                text = 'HTTPS cert for %s expired' % check['resource']
+                severity = 'critical'
+            elif days_left < datetime.timedelta(days=SSL_DAYS) and days_left > datetime.timedelta(days=SSL_DAYS_PANIC):
+                text = 'HTTPS cert for %s will expire at %s' % (check['resource'], days_left)
+                severity = 'major'
+            elif days_left <= datetime.timedelta(days=SSL_DAYS_PANIC):
+                text = 'HTTPS cert for %s will expire at %s' % (check['resource'], days_left)
+                severity = 'critical'
+            else:
+                severity = 'normal'
 
-            if check_ssl:
-                ssl_date_fmt = r'%b %d %H:%M:%S %Y %Z'
-                context = ssl.create_default_context()
-                domain = '{uri.netloc}'.format(uri=urlparse(check.get('url')))
-                port = urlparse(check.get('url')).port or 443
-                conn = context.wrap_socket(
-                    socket.socket(socket.AF_INET),
-                    server_hostname=domain
-                )
-                conn.settimeout(3.0)
-                conn.connect((domain, port))
-                ssl_info = conn.getpeercert()
-                days_left = datetime.datetime.strptime(ssl_info['notAfter'], ssl_date_fmt) - datetime.datetime.utcnow()
-                if days_left < datetime.timedelta(days=0):
-                    text = 'HTTPS cert for %s expired' % check['resource']
-                    severity = 'critical'
-                elif days_left < datetime.timedelta(days=SSL_DAYS) and days_left > datetime.timedelta(days=SSL_DAYS_PANIC):
-                    text = 'HTTPS cert for %s will expire at %s' % (check['resource'], days_left)
-                    severity = 'major'
-                elif days_left <= datetime.timedelta(days=SSL_DAYS_PANIC):
-                    text = 'HTTPS cert for %s will expire at %s' % (check['resource'], days_left)
-                    severity = 'critical'
-                else:
-                    severity = 'normal'
-
+            value = 'left %s day(s)' % days_left.days
+            if self.alerts.due(key, 'HttpSSLChecker', severity, value):
                 try:
                     local_api.send_alert(
                         resource=resource,
                         event='HttpSSLChecker',
                         correlate=correlate,
                         group=group,
-                        value='left %s day(s)' % days_left.days,
+                        value=value,
                         severity=severity,
                         environment=environment,
                         service=service,
@@ -281,152 +476,893 @@ class WorkerThread(threading.Thread):
                     )
                 except Exception as e:
                     LOG.warning('Failed to send ssl alert: %s', e)
+                else:
+                    self.alerts.sent(key, 'HttpSSLChecker', severity, value)
 
-            self.queue.task_done()
-            LOG.info('%s check complete.', self.getName())
-
-        self.queue.task_done()
-
-    @staticmethod
-    def urlmon(check):
+    async def urlmon(self, check):
 
         url = check['url']
-        post = check.get('post', None)
         count = check.get('count', 1)
-        headers = check.get('headers', {})
-        username = check.get('username', None)
-        password = check.get('password', None)
-        realm = check.get('realm', None)
-        uri = check.get('uri', None)
-        proxy = check.get('proxy', False)
 
         status = 0
         reason = None
         body = None
         rtt = 0
+        info = {}
 
         while True:
 
             count -= 1
-            start = time.time()
-
-            if username and password:
-                auth_handler = HTTPBasicAuthHandler()
-                auth_handler.add_password(realm=realm,
-                                          uri=uri,
-                                          user=username,
-                                          passwd=password)
-                if proxy:
-                    opener = build_opener(auth_handler, ProxyHandler(proxy))
-                else:
-                    opener = build_opener(auth_handler)
-            else:
-                if proxy:
-                    opener = build_opener(ProxyHandler(proxy))
-                else:
-                    opener = build_opener()
-            install_opener(opener)
-
-            if 'User-agent' not in headers:
-                headers['User-agent'] = 'alert-urlmon/%s' % (__version__)
-
-            try:
-                if post:
-                    req = Request(url, json.dumps(post), headers=headers)
-                else:
-                    req = Request(url, headers=headers)
-                response = urlopen(req, None, MAX_TIMEOUT)
-            except ValueError as e:
-                LOG.error('Request failed: %s' % e)
-            except URLError as e:
-                if hasattr(e, 'reason'):
-                    reason = str(e.reason)
-                    status = None
-                elif hasattr(e, 'code'):
-                    reason = None
-                    status = e.code  # pylint: disable=no-member
-            except Exception as e:
-                LOG.warning('Unexpected error: %s' % e)
-            else:
-                status = response.getcode()
-                body = response.read()
+            trace = {}
 
-            rtt = int((time.time() - start) * 1000)  # round-trip time
+            # wait for the host here, the connector's own wait would be timed
+            async with self.host_slot(url):
+                start = time.time()
+                status, reason, body, scan = await self.request(self.session, check, trace)
+                rtt = int((time.time() - start) * 1000)  # round-trip time
 
             if status:  # return result if any HTTP/S response is received
                 break
 
             if not count:
                 break
-            time.sleep(10)
+            await asyncio.sleep(10)
+
+        if status and trace.get('peercert'):
+            parsed = urlparse(url)
+            expires = self.certificates.expiry((parsed.hostname, parsed.port or 443), *trace['peercert'])
+            if expires:
+                info['sslExpires'] = expires.strftime(SSL_EXPIRES_FMT)
+
+        if status:
+            if scan:
+                info['searchMatched'], info['bytesScanned'] = scan
+            for phase, elapsed in phase_timings(trace).items():
+                info[phase + 'Time'] = elapsed
+            info['connectionReused'] = trace.get('reused', False)
+            if info['connectionReused']:
+                info['warmResponseTime'] = rtt
+            else:
+                info['coldResponseTime'] = rtt
+            if self.cold_session is not None and check.get('measure_cold', getattr(settings, 'MEASURE_COLD', MEASURE_COLD)) and \
+                    info['connectionReused']:
+                # the same request again on a new connection, with a full handshake
+                async with self.host_slot(url):
+                    start = time.time()
+                    if (await self.request(self.cold_session, check, {}))[0]:
+                        info['coldResponseTime'] = int((time.time() - start) * 1000)
 
-        return status, reason, body, rtt
+        return status, reason, body, rtt, info
 
+    @staticmethod
+    async def request(session, check, trace):
+        '''Make one request for a check, returns (status, reason, body, scan)
 
-class UrlmonDaemon(object):
+        For checks with a "search" pattern the body is scanned as it arrives
+        and not kept, scan is (found, bytes scanned), otherwise it is None.
+        '''
+
+        url = check['url']
+        post = check.get('post', None)
+        headers = dict(check.get('headers', {}))
+        username = check.get('username', None)
+        password = check.get('password', None)
+        proxy = check.get('proxy', False)
+        search_string = check.get('search', None)
+
+        status = 0
+        reason = None
+        body = None
+        scan = None
+
+        if 'User-agent' not in headers:
+            headers['User-agent'] = 'alert-urlmon/%s' % (__version__)
+
+        # credentials are sent up front, whatever realm and uri the check names
+        auth = aiohttp.BasicAuth(username, password) if username and password else None
+        if proxy:
+            # the same {scheme: proxy url} mapping that urllib's ProxyHandler takes
+            proxy = proxy.get(urlparse(url).scheme) if isinstance(proxy, dict) else proxy
+
+        token = _TRACE.set(trace)
+        try:
+            for retry in (True, False):
+                trace.clear()
+                if check.get('check_ssl'):
+                    trace['peercert'] = None  # filled in by TimingConnector.connect()
+                try:
+                    async with session.request(
+                            'POST' if post else 'GET', url,
+                            data=json.dumps(post) if post else None,
+                            headers=headers, auth=auth, proxy=proxy or None,
+                            timeout=aiohttp.ClientTimeout(total=MAX_TIMEOUT / 1000.0),
+                            trace_request_ctx=trace) as response:
+                        status = response.status
+                        if status < 400 and search_string:
+                            max_bytes = check.get('max_bytes', getattr(settings, 'MAX_SEARCH_BYTES', MAX_SEARCH_BYTES))
+                            scan = await search_body(response, search_pattern(search_string), max_bytes)
+                        elif status < 400:
+                            body = await response.text(errors='replace')
+                        trace['end'] = time.monotonic()
+                    break
+                except aiohttp.ServerDisconnectedError:
+                    # the server closed an idle pooled connection as we reused it
+                    if not (retry and trace.get('reused')):
+                        raise
+        except ValueError as e:
+            LOG.error('Request failed: %s' % e)
+        except asyncio.TimeoutError:
+            reason = 'timed out'
+            status = None
+        except aiohttp.ClientError as e:
+            reason = str(e)
+            status = None
+        except Exception as e:
+            LOG.warning('Unexpected error: %s' % e)
+        finally:
+            _TRACE.reset(token)
+
+        return status, reason, body, scan
+
+
+@functools.lru_cache(maxsize=None)
+def search_pattern(search_string):
+    '''Compile a search pattern once'''
+    return re.compile(search_string)
+
+
+async def search_body(response, pattern, max_bytes):
+    '''Search a response body chunk by chunk, stopping at the first match
+    or after max_bytes, returns (found, bytes scanned)
+
+    The pattern is matched against each line on its own, as it always
+    was, so it never matches across lines. The trailing partial line of a
+    chunk is carried over into the next, so no line is split by a chunk.
+    '''
+    try:
+        decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    scanned = 0
+    tail = ''
+    async for chunk in response.content.iter_chunked(SEARCH_CHUNK_SIZE):
+        chunk = chunk[:max_bytes - scanned]
+        scanned += len(chunk)
+        lines, newline, tail = (tail + decoder.decode(chunk)).rpartition('\n')
+        if newline and any(pattern.search(line) for line in lines.split('\n')):
+            return True, scanned
+        if len(tail) > SEARCH_OVERLAP:
+            if pattern.search(tail):
+                return True, scanned
+            tail = tail[-SEARCH_OVERLAP:]
+        if scanned >= max_bytes:
+            break
+    return bool(pattern.search(tail + decoder.decode(b'', final=True))), scanned
+
+
+class ChecksFile(object):
+    '''A JSON or YAML file holding a list of checks, read again whenever
+    its modification time or size changes
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._stat = None
+
+    def changed(self):
+        try:
+            st = os.stat(self.path)
+            stat = (st.st_mtime, st.st_size)
+        except OSError:
+            stat = None
+        if stat == self._stat:
+            return False
+        self._stat = stat
+        return True
+
+    def load(self):
+        '''Return the checks in the file, raises ValueError if it cannot be read'''
+        try:
+            with open(self.path) as f:
+                if self.path.endswith(('.yaml', '.yml')):
+                    if not YAML_AVAILABLE:
+                        raise ValueError('PyYAML is not installed')
+                    checks = yaml.safe_load(f)
+                else:
+                    checks = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError('Could not read %s: %s' % (self.path, e))
+        except Exception as e:  # yaml.YAMLError
+            raise ValueError('Could not parse %s: %s' % (self.path, e))
+        if not isinstance(checks, list) or not all(isinstance(c, dict) and 'resource' in c and 'url' in c for c in checks):
+            raise ValueError('%s is not a list of checks with a resource and url' % self.path)
+        return checks
+
+
+class MemoryLeaseStore(object):
+    '''In-process stand-in for a lease store, for tests and for running
+    several instances in one process
+    '''
 
     def __init__(self):
+        self._members = {}  # member -> lease expiry
+        self._lock = threading.Lock()
+
+    def heartbeat(self, member, expires):
+        with self._lock:
+            self._members[member] = expires
+
+    def leave(self, member):
+        with self._lock:
+            self._members.pop(member, None)
+
+    def members(self, now):
+        with self._lock:
+            return sorted(m for m, expires in self._members.items() if expires > now)
+
+
+class FileLeaseStore(object):
+    '''Leases as files in a directory shared by every instance, each one
+    holding the time its lease expires. A lease is written to a temporary
+    file and renamed into place, so it is never read half written.
+    '''
+
+    SUFFIX = '.lease'
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, member):
+        return os.path.join(self.directory, member + self.SUFFIX)
+
+    def heartbeat(self, member, expires):
+        path = self._path(member)
+        with open(path + '.tmp', 'w') as f:
+            f.write(repr(expires))
+        os.replace(path + '.tmp', path)
+
+    def leave(self, member):
+        try:
+            os.remove(self._path(member))
+        except OSError:
+            pass
+
+    def members(self, now):
+        members = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    expires = float(f.read())
+            except (OSError, ValueError):
+                continue
+            if expires > now:
+                members.append(name[:-len(self.SUFFIX)])
+        return sorted(members)
 
-        self.shuttingdown = False
 
-    def run(self):
+class HashRing(object):
+    '''Consistent hashing of check keys over instances, so that a change
+    in membership only moves the checks of the instances that came or went
+    '''
 
-        self.running = True
+    def __init__(self, members, replicas=64):
+        self.members = sorted(members)
+        ring = sorted((self._hash('%s#%d' % (member, i)), member)
+                      for member in self.members for i in range(replicas))
+        self._hashes = [h for h, _ in ring]
+        self._owners = [member for _, member in ring]
 
-        self.queue = queue.Queue()
-        self.api = Client(endpoint=settings.ENDPOINT, key=settings.API_KEY)
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        if not self._owners:
+            return None
+        return self._owners[bisect.bisect(self._hashes, self._hash(key)) % len(self._owners)]
+
+
+class Shard(object):
+    '''This instance's share of the checks.
+
+    Each instance holds a lease, renewed by heartbeat(), and the live
+    instances split the checks between them on a hash ring. When an
+    instance stops renewing its lease, its checks move to the others
+    once the lease expires. Every instance still schedules every check,
+    so a check that moves keeps its slot.
+    '''
+
+    def __init__(self, store, member, ttl=SHARD_LEASE_TTL, allowed=None):
+        self.store = store
+        self.member = member
+        self.ttl = ttl
+        self.allowed = set(allowed) if allowed else None
+        self.ring = None  # until the first heartbeat
+
+    def heartbeat(self, now=None):
+        '''Renew this instance's lease and pick up membership changes'''
+        now = now if now is not None else time.time()
+        self.store.heartbeat(self.member, now + self.ttl)
+        members = [m for m in self.store.members(now) if self.allowed is None or m in self.allowed]
+        if self.ring is None or members != self.ring.members:
+            LOG.info('URL monitors sharing checks changed to %s', ', '.join(members))
+            if self.member not in members:
+                LOG.warning('%s is not a member, it will run no checks', self.member)
+            self.ring = HashRing(members)
+
+    def leave(self):
+        self.store.leave(self.member)
+
+    def owns(self, check):
+        return self.ring is not None and self.ring.owner(check_key(check)) == self.member
+
+
+class AlertaClients(object):
+    '''Alerta API clients by (endpoint, key)
+
+    Every client sends through one requests session, which keeps a pool of
+    connections to each endpoint. The pool is as large as the number of
+    threads that send alerts, so no thread opens a connection of its own.
+    '''
+
+    def __init__(self, pool_size=REPORT_THREADS):
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def get(self, endpoint, key):
+
+        with self.lock:
+            client = self.clients.get((endpoint, key))
+            if client is None:
+                client = Client(endpoint=endpoint, key=key)
+                client.http.session = self.session  # authentication is sent per request
+                self.clients[(endpoint, key)] = client
+            return client
+
+
+class AlertState(object):
+    '''The last (event, severity, value bucket) sent for each check
+
+    An alert is only sent again when one of these changes, or after
+    refresh seconds so it does not time out in Alerta. Times in the value,
+    such as "5230ms", are bucketed to a power of two so a slow check is not
+    sent on every cycle. The certificate alert of a check is kept apart
+    from its HTTP alert.
+    '''
+
+    def __init__(self, refresh=ALERT_REFRESH_INTERVAL):
+
+        self.refresh = refresh
+        self.last = {}  # (check key, is certificate alert) -> (event, severity, value bucket, sent at)
+        self.lock = threading.Lock()  # alerts are sent from the report threads
+        self.sent_count = 0
+        self.suppressed_count = 0
 
-        # Start worker threads
-        LOG.debug('Starting %s worker threads...', SERVER_THREADS)
-        for i in range(SERVER_THREADS):
-            w = WorkerThread(self.queue, self.api)
+    @staticmethod
+    def bucket(value):
+        return re.sub(r'(\d+)ms', lambda m: '<%dms' % (1 << int(m.group(1)).bit_length()), str(value))
+
+    def due(self, key, event, severity, value):
+        '''True if the alert should be sent, otherwise counts it as suppressed'''
+        last = self.last.get((key, event == 'HttpSSLChecker'))
+        if last is None or last[:3] != (event, severity, self.bucket(value)) or time.time() - last[3] >= self.refresh:
+            return True
+        with self.lock:
+            self.suppressed_count += 1
+        return False
+
+    def sent(self, key, event, severity, value):
+        self.last[(key, event == 'HttpSSLChecker')] = (event, severity, self.bucket(value), time.time())
+        with self.lock:
+            self.sent_count += 1
+
+    def forget(self, key):
+        self.last.pop((key, False), None)
+        self.last.pop((key, True), None)
+
+    def counts(self):
+        '''Return and reset (sent, suppressed)'''
+        with self.lock:
+            counts = self.sent_count, self.suppressed_count
+            self.sent_count = self.suppressed_count = 0
+        return counts
+
+
+SSL_EXPIRES_FMT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+
+class CertificateCache(object):
+    '''Certificate expiry by (host, port)
+
+    The certificate comes from the check's own request, so the host name
+    sent for SNI and the address family are those of the request. Its
+    expiry is worked out again only when a different certificate is
+    served, or after ttl seconds.
+    '''
+
+    def __init__(self, ttl=SSL_CACHE_TTL):
+
+        self.ttl = ttl
+        self.entries = {}  # (host, port) -> (sha256 fingerprint, expires, parsed at)
+
+    def expiry(self, key, der, decoded):
+
+        fingerprint = hashlib.sha256(der).hexdigest()
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry and entry[0] == fingerprint and now - entry[2] < self.ttl:
+            return entry[1]
+
+        if not decoded or 'notAfter' not in decoded:
+            # only verified certificates are decoded
+            return None
+        expires = datetime.datetime.utcfromtimestamp(ssl.cert_time_to_seconds(decoded['notAfter']))
+        if entry and entry[0] != fingerprint:
+            LOG.info('Certificate for %s:%s changed, expires %s', key[0], key[1], expires)
+        self.entries[key] = (fingerprint, expires, now)
+        return expires
+
+
+class RuleError(ValueError):
+    pass
+
+
+class Rule(object):
+    '''A check's "rule", compiled once into a tree of closures
+
+    A rule compares fields of the response body, selected with a JSONPath
+    style path ("$.status", "$.checks[0].name") or the older
+    "body['status']" form, with literals or other fields:
+
+        $.status == "ok" and ($.queue.length < 100 or not $.queue.enabled)
+        $.version in ["2.1", "2.2"]
+
+    Nothing else, no calls, attributes or builtins, can be expressed.
+    '''
+
+    TOKEN = re.compile(r'''\s*(?:
+        (?P<number>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)|
+        (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|
+        (?P<name>[A-Za-z_][A-Za-z0-9_]*)|
+        (?P<op>==|!=|<=|>=|<|>|[$.\[\](),])
+        )''', re.VERBOSE)
+
+    COMPARISONS = {
+        '==': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+        'in': lambda a, b: a in b,
+        'not in': lambda a, b: a not in b
+    }
+
+    CONSTANTS = {'true': True, 'false': False, 'null': None, 'True': True, 'False': False, 'None': None}
+
+    def __init__(self, text):
+
+        self.text = text
+        self.tokens = self._tokenize(text)
+        self.pos = 0
+        self._evaluate = self._or()
+        if self.pos < len(self.tokens):
+            raise RuleError('unexpected %r' % self.tokens[self.pos][1])
+        del self.tokens
+
+    def evaluate(self, body):
+        '''True if the rule holds for body, raises LookupError for a missing field'''
+        return bool(self._evaluate(body))
+
+    def _tokenize(self, text):
+
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            m = self.TOKEN.match(text, pos)
+            if not m:
+                raise RuleError('unexpected %r at position %d' % (text[pos:].strip()[:10], pos))
+            tokens.append((m.lastgroup, m.group(m.lastgroup)))
+            pos = m.end()
+        return tokens
+
+    def _peek(self, *values):
+        if self.pos < len(self.tokens) and (not values or self.tokens[self.pos][1] in values):
+            return self.tokens[self.pos]
+
+    def _take(self, *values):
+        token = self._peek(*values)
+        if token is None:
+            found = self.tokens[self.pos][1] if self.pos < len(self.tokens) else 'end of rule'
+            raise RuleError('expected %s, found %r' % (' or '.join(values) or 'a value', found))
+        self.pos += 1
+        return token
+
+    def _or(self):
+        operands = [self._and()]
+        while self._peek('or'):
+            self._take('or')
+            operands.append(self._and())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda body: any(operand(body) for operand in operands)
+
+    def _and(self):
+        operands = [self._not()]
+        while self._peek('and'):
+            self._take('and')
+            operands.append(self._not())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda body: all(operand(body) for operand in operands)
+
+    def _not(self):
+        if self._peek('not'):
+            self._take('not')
+            operand = self._not()
+            return lambda body: not operand(body)
+        return self._comparison()
+
+    def _comparison(self):
+        left = self._operand()
+        op = self._peek('==', '!=', '<', '<=', '>', '>=', 'in', 'not')
+        if op is None:
+            return left
+        op = self._take()[1]
+        if op == 'not':
+            self._take('in')
+            op = 'not in'
+        compare = self.COMPARISONS[op]
+        right = self._operand()
+        return lambda body: compare(left(body), right(body))
+
+    def _operand(self):
+        kind, value = self._take()
+        if value == '(':
+            expr = self._or()
+            self._take(')')
+            return expr
+        if value == '[':
+            items = []
+            while not self._peek(']'):
+                items.append(self._literal())
+                if not self._peek(']'):
+                    self._take(',')
+            self._take(']')
+            return lambda body: items
+        if value in ('$', 'body'):
+            return self._path()
+        self.pos -= 1
+        constant = self._literal()
+        return lambda body: constant
+
+    def _literal(self):
+        kind, value = self._take()
+        if kind in ('number', 'string'):
+            return ast.literal_eval(value)
+        if kind == 'name' and value in self.CONSTANTS:
+            return self.CONSTANTS[value]
+        raise RuleError('unexpected %r' % value)
+
+    def _path(self):
+        steps = []
+        while self._peek('.', '['):
+            if self._take()[1] == '.':
+                kind, value = self._take()
+                if kind != 'name':
+                    raise RuleError('expected a field name after ".", found %r' % value)
+                steps.append(value)
+            else:
+                kind, value = self._take()
+                if kind not in ('number', 'string'):
+                    raise RuleError('expected an index or quoted field name, found %r' % value)
+                steps.append(ast.literal_eval(value))
+                self._take(']')
+
+        def select(body):
+            for step in steps:
+                if isinstance(body, list) and not isinstance(step, int):
+                    raise KeyError(step)
+                body = body[step]
+            return body
+        return select
+
+
+@functools.lru_cache(maxsize=None)
+def compile_rule(rule):
+    return Rule(rule)
+
+
+def valid_checks(checks):
+    '''Compile the rules of checks, logging and leaving out any that are invalid'''
+    valid = []
+    for check in checks:
+        if check.get('rule'):
             try:
-                w.start()
-            except Exception as e:
-                LOG.error('Worker thread #%s did not start: %s', i, e)
+                compile_rule(check['rule'])
+            except RuleError as e:
+                LOG.error('Not scheduling %s, invalid rule %r: %s', check_key(check), check['rule'], e)
                 continue
-            LOG.info('Started worker thread: %s', w.getName())
+        valid.append(check)
+    return valid
+
+
+def slow_phase(check, timings):
+    '''Return (severity, phase, elapsed, threshold) for the worst phase over
+    its threshold in the check's "thresholds", or None if none is
+    '''
+    worst = None
+    for phase, thresholds in check.get('thresholds', {}).items():
+        elapsed = timings.get(phase, 0)
+        for severity in ('critical', 'warning'):
+            threshold = thresholds.get(severity)
+            if threshold is not None and elapsed > threshold:
+                if worst is None:
+                    worst = (severity, phase, elapsed, threshold)
+                elif severity == 'critical' and worst[0] == 'warning':
+                    worst = (severity, phase, elapsed, threshold)
+                break
+    return worst
+
+
+# the trace_request_ctx of the request being made by the current task
+_TRACE = contextvars.ContextVar('urlmon_trace', default=None)
+
+PHASES = ['dns', 'connect', 'tls', 'ttfb', 'transfer']
+
+
+def trace_config():
+    '''Records in each request's trace_request_ctx when each phase of the
+    request ends, and whether it reused a pooled connection
+    '''
+
+    def stamp(name):
+        async def on_signal(session, context, params):
+            context.trace_request_ctx[name] = time.monotonic()
+        return on_signal
+
+    async def on_connection_reuseconn(session, context, params):
+        context.trace_request_ctx['reused'] = True
+        context.trace_request_ctx['connected'] = time.monotonic()
+
+    async def on_connection_create_end(session, context, params):
+        context.trace_request_ctx['reused'] = False
+        context.trace_request_ctx['connected'] = time.monotonic()
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(stamp('start'))
+    config.on_dns_resolvehost_start.append(stamp('dns_start'))
+    config.on_dns_resolvehost_end.append(stamp('dns_end'))
+    config.on_connection_create_start.append(stamp('connect_start'))
+    config.on_connection_reuseconn.append(on_connection_reuseconn)
+    config.on_connection_create_end.append(on_connection_create_end)
+    config.on_request_headers_sent.append(stamp('sent'))
+    config.on_request_end.append(stamp('headers'))
+    return config
+
+
+def phase_timings(trace):
+    '''Milliseconds spent in each phase of a traced request. Phases that
+    did not happen, like DNS on a cache hit or TLS on plain HTTP, are 0.
+    '''
+    def ms(start, end):
+        if start in trace and end in trace:
+            return max(0, int((trace[end] - trace[start]) * 1000))
+        return 0
+
+    dns = ms('dns_start', 'dns_end')
+    tls = ms('tls_start', 'tls_end')
+    # connection setup covers DNS and the TLS handshake, keep only TCP
+    connect = max(0, ms('connect_start', 'connected') - dns - tls)
+    return {
+        'dns': dns,
+        'connect': connect,
+        'tls': tls,
+        'ttfb': ms('sent' if 'sent' in trace else 'connected', 'headers'),
+        'transfer': ms('headers', 'end')
+    }
+
+
+class TimingConnector(aiohttp.TCPConnector):
+    '''TCPConnector that also records when the TLS handshake of a new
+    connection starts and ends. The protocol is created once the socket
+    is connected, and its connection_made() runs after the handshake.
+
+    It also records the server certificate, new connection or reused,
+    when the request asks for it.
+    '''
+
+    async def connect(self, req, traces, timeout):
+        connection = await super(TimingConnector, self).connect(req, traces, timeout)
+        trace = _TRACE.get()
+        if trace is not None and 'peercert' in trace and connection.transport is not None:
+            ssl_object = connection.transport.get_extra_info('ssl_object')
+            if ssl_object is not None:
+                trace['peercert'] = ssl_object.getpeercert(binary_form=True), ssl_object.getpeercert()
+        return connection
+
+    async def _wrap_create_connection(self, protocol_factory, *args, **kwargs):
+        trace = _TRACE.get()
+        if trace is None or not kwargs.get('ssl'):
+            return await super(TimingConnector, self)._wrap_create_connection(
+                protocol_factory, *args, **kwargs)
+
+        def timed_factory():
+            trace['tls_start'] = time.monotonic()
+            protocol = protocol_factory()
+            connection_made = protocol.connection_made
+
+            def timed_connection_made(transport):
+                trace['tls_end'] = time.monotonic()
+                connection_made(transport)
+            protocol.connection_made = timed_connection_made
+            return protocol
+
+        return await super(TimingConnector, self)._wrap_create_connection(
+            timed_factory, *args, **kwargs)
 
-        while not self.shuttingdown:
-            try:
-                for check in settings.checks:
-                    self.queue.put((check, time.time()))
 
-                LOG.debug('Send heartbeat...')
-                try:
-                    origin = '{}/{}'.format('urlmon', platform.uname()[1])
-                    self.api.heartbeat(origin, tags=[__version__], timeout=3600)
-                except Exception as e:
-                    LOG.warning('Failed to send heartbeat: %s', e)
+class UrlmonDaemon(object):
 
-                time.sleep(LOOP_EVERY)
-                LOG.info('URL check queue length is %d', self.queue.qsize())
+    def __init__(self):
 
-                if self.queue.qsize() > 100:
-                    severity = 'warning'
-                else:
-                    severity = 'ok'
-                try:
-                    self.api.send_alert(
-                        resource=origin,
-                        event='big queue for http checks',
-                        value=self.queue.qsize(),
-                        severity=severity,
-                        text='URL check queue length is %d' % self.queue.qsize(),
-                        event_type='serviceAlert',
-                    )
-                except Exception as e:
-                    LOG.warning('Failed to send alert: %s', e)
+        self.shuttingdown = False
+        self.shard = None
+
+    def run(self):
+
+        self.running = True
+
+        lease_dir = getattr(settings, 'SHARD_LEASE_DIR', SHARD_LEASE_DIR)
+        if lease_dir:
+            self.shard = Shard(FileLeaseStore(lease_dir), getattr(settings, 'SHARD_NAME', SHARD_NAME),
+                               getattr(settings, 'SHARD_LEASE_TTL', SHARD_LEASE_TTL),
+                               getattr(settings, 'SHARD_MEMBERS', SHARD_MEMBERS))
+            self.shard.heartbeat()
 
-            except (KeyboardInterrupt, SystemExit):
-                self.shuttingdown = True
+        self.clients = AlertaClients(REPORT_THREADS)
+        self.api = self.clients.get(settings.ENDPOINT, settings.API_KEY)
+
+        try:
+            asyncio.run(self.check_loop())
+        except (KeyboardInterrupt, SystemExit):
+            self.shuttingdown = True
 
         LOG.info('Shutdown request received...')
+        if self.shard:
+            self.shard.leave()
         self.running = False
 
-        for i in range(SERVER_THREADS):
-            self.queue.put(None)
-        w.join()
+    async def check_loop(self):
+
+        max_concurrency = getattr(settings, 'MAX_CONCURRENCY', MAX_CONCURRENCY)
+        # the per host limit is Checker.host_slot(), outside the timed request
+        connector = TimingConnector(
+            limit=max_concurrency,
+            # keep connections open from one check cycle to the next
+            keepalive_timeout=getattr(settings, 'KEEPALIVE_TIMEOUT', KEEPALIVE_TIMEOUT)
+        )
+        loop = asyncio.get_event_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=REPORT_THREADS))
+        tasks = {}  # check key -> task
+
+        # connections are pooled by scheme, host, port and proxy; headers
+        # and credentials are sent with each request, never shared
+        async with aiohttp.ClientSession(connector=connector, trace_configs=[trace_config()]) as session, \
+                aiohttp.ClientSession(connector=TimingConnector(force_close=True, limit=max_concurrency),
+                                      trace_configs=[trace_config()]) as cold_session:
+            checker = Checker(session, self.api, max_concurrency, cold_session, self.clients,
+                              getattr(settings, 'MAX_CONCURRENCY_PER_HOST', MAX_CONCURRENCY_PER_HOST))
+            LOG.debug('Running up to %d checks at once', max_concurrency)
+
+            checks_file = getattr(settings, 'CHECKS_FILE', CHECKS_FILE)
+            checks_file = ChecksFile(checks_file) if checks_file else None
+            reload_interval = getattr(settings, 'CHECKS_RELOAD_INTERVAL', CHECKS_RELOAD_INTERVAL)
+            scheduler = Scheduler()
+            await self.load_checks(scheduler, checker, tasks, checks_file)
+            next_heartbeat = time.time()
+            next_reload = time.time() + reload_interval if checks_file else float('inf')
+            next_lease = time.time() + (self.shard.ttl / 3.0 if self.shard else float('inf'))
+
+            while not self.shuttingdown:
+                if time.time() >= next_lease:
+                    next_lease = time.time() + self.shard.ttl / 3.0
+                    try:
+                        await loop.run_in_executor(None, self.shard.heartbeat)
+                    except Exception as e:
+                        LOG.warning('Failed to renew shard lease: %s', e)
+
+                for due, check in scheduler.pop_due():
+                    if self.shard and not self.shard.owns(check):
+                        continue
+                    if checker.busy(check):
+                        LOG.warning('Skipping %s, its previous check is still in progress', check_key(check))
+                        continue
+                    key = check_key(check)
+                    task = asyncio.ensure_future(checker.run(check, due))
+                    tasks[key] = task
+                    task.add_done_callback(lambda t, key=key: tasks.get(key) is t and tasks.pop(key))
+
+                if time.time() >= next_reload:
+                    next_reload = time.time() + reload_interval
+                    if checks_file.changed():
+                        await self.load_checks(scheduler, checker, tasks, checks_file)
+
+                if time.time() >= next_heartbeat:
+                    next_heartbeat = time.time() + LOOP_EVERY
+                    await self.heartbeat(checker, scheduler)
+
+                wake_at = min(next_heartbeat, next_lease, next_reload, scheduler.next_due() or next_heartbeat)
+                await asyncio.sleep(max(0, wake_at - time.time()))
+
+            for task in list(tasks.values()):
+                task.cancel()
+
+    async def load_checks(self, scheduler, checker, tasks, checks_file=None):
+        '''Bring the scheduler up to date with settings.checks and the checks file'''
+
+        checks = list(getattr(settings, 'checks', []))
+        if checks_file:
+            checks_file.changed()  # records the version about to be read
+            try:
+                checks += await asyncio.get_event_loop().run_in_executor(None, checks_file.load)
+            except ValueError as e:
+                LOG.error('%s, keeping the checks already running', e)
+                return
+        added, changed, removed = scheduler.update(valid_checks(unique_checks(checks)))
+        for key in removed:
+            task = tasks.pop(key, None)
+            if task:
+                task.cancel()
+            checker.alerts.forget(key)
+        LOG.info('Scheduled %d checks, %d added, %d changed and %d removed',
+                 len(scheduler), len(added), len(changed), len(removed))
+
+    async def heartbeat(self, checker, scheduler):
+
+        loop = asyncio.get_event_loop()
+        LOG.debug('Send heartbeat...')
+        origin = '{}/{}'.format('urlmon', getattr(settings, 'SHARD_NAME', SHARD_NAME))
+        if self.shard:
+            owned = sum(1 for check in scheduler.checks() if self.shard.owns(check))
+        else:
+            owned = len(scheduler)
+        try:
+            await loop.run_in_executor(None, lambda: self.api.heartbeat(
+                origin, tags=[__version__], attributes={'checks': owned}, timeout=3600))
+        except Exception as e:
+            LOG.warning('Failed to send heartbeat: %s', e)
+        LOG.info('Running %d of %d checks', owned, len(scheduler))
+
+        LOG.info('URL check queue length is %d', checker.waiting)
+        LOG.info('Alerts sent %d, unchanged and suppressed %d since the last heartbeat', *checker.alerts.counts())
+
+        if checker.waiting > 100:
+            severity = 'warning'
+        else:
+            severity = 'ok'
+        try:
+            await loop.run_in_executor(None, lambda: self.api.send_alert(
+                resource=origin,
+                event='big queue for http checks',
+                value=checker.waiting,
+                severity=severity,
+                text='URL check queue length is %d' % checker.waiting,
+                event_type='serviceAlert',
+            ))
+        except Exception as e:
+            LOG.warning('Failed to send alert: %s', e)
 
 
 def main():